@@ -34,8 +34,10 @@ from langchain_core.language_models import LLM, BaseChatModel
 from langchain_core.messages.chat import ChatMessage
 
 from rag.chains.base import BaseGenerationChain
-from rag.common.utils import get_prompt_template
-from rag.module.pre_generate.summery_content import generate_summery_content
+from rag.common.configuration import settings
+from rag.common.utils import get_prompt_template, logger
+from rag.module.pre_generate.context_assembly import assemble_context, get_token_counter
+from rag.module.pre_generate.summery_content import generate_summery_content, prefetch_query_keywords
 
 
 @dataclass
@@ -45,21 +47,37 @@ class GenerateChain(BaseGenerationChain):
     prompt_type: str = "rag"
     is_summary_prompt: bool = False
     keep_top_content: bool = False
+    max_prompt_tokens: int = settings.llm.max_prompt_tokens
+    prompt_tokens: int = 0  # 最近一次生成的prompt token数
 
-    def augment(self, query: str, docs: List[Document]):
+    def prefetch(self, query: str):
+        """
+        在检索开始前调用, 提前在后台执行与检索结果无关的llm请求(summary模式下的关键词抽取)
+        """
+        if self.is_summary_prompt:
+            prefetch_query_keywords(query)
+
+    def augment(self, query: str, docs: List[Document], reserved_tokens: int = 0):
+        """
+        组装问答prompt, 上下文按召回顺序填充, 总token数不超过 max_prompt_tokens
+        :param reserved_tokens: prompt之外占用的token数, 例如历史对话
+        """
+        count_tokens = get_token_counter()
+        prompt_template = PromptTemplate.from_template(get_prompt_template(type=self.prompt_type))
         if self.is_summary_prompt:
             context = generate_summery_content(query, docs)
+            if self.keep_top_content: # 最相关的尽量保留因为可能其中的重要信息被删除
+                context = f"{docs[0].page_content}\n\n{context}"
         else:
-            context = ""
-            for i, doc in enumerate(docs, start=1):
-                context += f"\n\n片段{i}:\n{doc.page_content}"
-        if self.keep_top_content: # 最相关的尽量保留因为可能其中的重要信息被删除
-            context = f"{docs[0].page_content}\n\n{context}"
+            budget = 0
+            if self.max_prompt_tokens > 0:
+                overhead = count_tokens(prompt_template.format(query=query, context="")) + reserved_tokens
+                budget = max(1, self.max_prompt_tokens - overhead)
+            context, _ = assemble_context(docs, budget, count_tokens=count_tokens,
+                                          keep_top_content=self.keep_top_content)
 
-        prompt_template = get_prompt_template(type=self.prompt_type)
-        context = PromptTemplate.from_template(prompt_template).format(
-            query=query, context=context
-        )
+        context = prompt_template.format(query=query, context=context)
+        self.prompt_tokens = count_tokens(context) + reserved_tokens
         return context
 
     def generate(self, prompt):
@@ -74,15 +92,28 @@ class GenerateChain(BaseGenerationChain):
             for res in iter([result]):
                 yield res
 
+    async def agenerate(self, prompt):
+        """
+        generate的异步版本, 协程被取消(如客户端断开)时推理服务随之中止生成
+        """
+        if self.stream:
+            result = ""
+            async for res in self.llm.astream(prompt):
+                result += res.content if isinstance(self.llm, BaseChatModel) else res
+                yield result
+        else:
+            result = await self.llm.ainvoke(prompt)
+            yield result.content if isinstance(self.llm, BaseChatModel) else result
 
-
-    def chain(self, query: str, docs: List[Document], history: List[Tuple[str, str]]):
+    def build_prompt(self, query: str, docs: List[Document], history: List[Tuple[str, str]]):
         """
-        生成答案
+        构建生成答案的prompt
         """
         message_list = [ChatMessage(role=h[0], content=h[1]) for h in history]
-        # 1. 生成问答上下文prompt
-        content = self.augment(query, docs)
+        # 1. 生成问答上下文prompt, 历史对话占用的token从上下文预算中扣除
+        history_tokens = sum(get_token_counter()(h[1]) for h in history)
+        content = self.augment(query, docs, reserved_tokens=history_tokens)
+        logger.info(f"prompt token数: {self.prompt_tokens}")
         # 2. 构建langchain prompt
         prompt = (
         ChatPromptTemplate.from_messages(
@@ -91,5 +122,19 @@ class GenerateChain(BaseGenerationChain):
             .format_prompt()
             .to_string()
         )
+        return prompt
+
+    def chain(self, query: str, docs: List[Document], history: List[Tuple[str, str]]):
+        """
+        生成答案
+        """
+        prompt = self.build_prompt(query, docs, history)
         # 3. 生成答案
         return self.generate(prompt)
+
+    def achain(self, query: str, docs: List[Document], history: List[Tuple[str, str]]):
+        """
+        异步生成答案, 返回异步生成器
+        """
+        prompt = self.build_prompt(query, docs, history)
+        return self.agenerate(prompt)
@@ -27,7 +27,8 @@
 import os
 import uuid
 from dataclasses import dataclass
-from typing import Dict, List, Tuple, Union
+import itertools
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
 from langchain_core.documents import Document
 from langchain_text_splitters import TextSplitter
@@ -41,13 +42,21 @@ from rag.connector.database.repository.knowledge_file_repository import (
 )
 from rag.connector.database.utils import KnowledgeFile
 from rag.connector.vectorstore.base import VectorStoreBase
+from rag.module.generate.answer_cache import invalidate_answer_cache
+from rag.module.pre_retrieval.route_query import invalidate_file_catalogue
+from rag.module.indexing.dedup import get_chunk_index
 from rag.module.indexing.multi_vector import (
     generate_contextual,
     generate_text_summaries,
     split_smaller_chunks,
 )
 from rag.module.indexing.splitter import SPLITER_MAPPING
-from rag.module.indexing.splitter.utils import merge_small_chunks
+from rag.module.indexing.splitter.utils import (
+    fit_chunk_size,
+    get_length_function,
+    merge_small_chunks,
+    split_documents_stream,
+)
 from rag.module.indexing.utils import save_chunks_to_file
 
 
@@ -64,6 +73,7 @@ class IndexingChain(BaseIndexingChain):
         splitter: 文本分割器
         embedding_filename: 是否在文档内容中嵌入文件名
         add_context: 是否添加上下文信息
+        context_window_size: 文档级上下文每次请求包含的chunk数, 为0时逐个chunk生成上下文
         knowledge_path_enhance: 是否增强知识路径
         is_merge_small_chunks: 是否合并小块
     """
@@ -76,11 +86,12 @@ class IndexingChain(BaseIndexingChain):
     splitter: TextSplitter = None
     embedding_filename: str = True
     add_context = False
+    context_window_size = 8
     knowledge_path_enhance = True
     is_merge_small_chunks = True
     is_save_chunks = False
 
-    def load(self, file: KnowledgeFile, loader: None):
+    def load(self, file: KnowledgeFile, loader: None) -> Iterator[Document]:
         """加载文件内容
         
         Args:
@@ -88,14 +99,13 @@ class IndexingChain(BaseIndexingChain):
             loader: 文档加载器,如果为None则根据文件后缀自动选择
             
         Returns:
-            加载的文档列表
+            按页/段惰性生成的文档迭代器, 不会先把整个文件读成一个文档
         """
         if loader is None:
             loader_class = file.document_loader
         else:
             loader_class = loader
         file_path = file.filename if os.path.exists(file.filename) else file.filepath
-        # 这里只返回的list只有一个document
         from langchain_community.document_loaders import (
             PDFPlumberLoader,
             UnstructuredFileLoader,
@@ -103,21 +113,23 @@ class IndexingChain(BaseIndexingChain):
 
         # 判断loader_class是否为UnstructuredFileLoader的子类
         if issubclass(loader_class, UnstructuredFileLoader) and file.ext in ["ppt", "pptx"]:
-            docs = loader_class(file_path, mode="paged").load()
+            docs = loader_class(file_path, mode="paged").lazy_load()
         elif issubclass(loader_class, PDFPlumberLoader):
             docs = loader_class(
                 file_path, extract_images=True, text_kwargs={"layout": False}
-            ).load()
+            ).lazy_load()
         else:
-            docs = loader_class(file_path).load()
+            docs = loader_class(file_path).lazy_load()
         return docs
 
-    def split(self, docs: List[Document], splitter: Union[str, TextSplitter]) -> List[Document]:
+    def split(self, docs: Iterable[Document], splitter: Union[str, TextSplitter],
+              file: KnowledgeFile = None) -> List[Document]:
         """将文档切分成小块
         
         Args:
-            docs: 待切分的文档列表
+            docs: 待切分的文档, 可以是加载器生成的文档迭代器, 边加载边切分
             splitter: 文本分割器,可以是预定义分割器名称或TextSplitter实例
+            file: 文档所属的知识文件, 开启入库去重时用于在知识库内去除近似重复的chunk
             
         Returns:
             切分后的文档块列表
@@ -125,27 +137,34 @@ class IndexingChain(BaseIndexingChain):
         处理流程:
         1. 对PPT文件特殊处理,不进行分割
         2. 使用分割器对文档进行切分
-        3. 为每个chunk添加唯一ID
+        3. 为每个chunk添加唯一ID, 跳过与知识库中已有chunk近似重复的chunk(如果启用)
         4. 根据multi_vector_param参数进行二次切分和摘要生成
         5. 合并过小的chunks(如果启用)
         """
         # 如果splitter是字符串，从预定义映射中获取对应的分割器类
         chunks = []
+        docs = iter(docs)
+        first_doc = next(docs, None)
+        if first_doc is None:
+            return []
+        docs = itertools.chain([first_doc], docs)
+        # 按token计长时chunk_size按embedding模型的tokenizer计算, 合并小块时使用相同的长度单位和上限
+        length_function = get_length_function()
+        chunk_size, chunk_overlap = self.chunk_size, self.chunk_overlap
+        if length_function is not len:
+            chunk_size, chunk_overlap = fit_chunk_size(self.chunk_size, self.chunk_overlap, length_function)
         # PPT就不分了
-        file_name = docs[0].metadata.get("file_name")
+        file_name = first_doc.metadata.get("file_name")
         if file_name and file_name.endswith(".pptx"):
-            chunks = docs
+            chunks = list(docs)
         else:
             if isinstance(splitter, str):
                 splitter = SPLITER_MAPPING[splitter]
-                # 使用分割器对文档进行切分
-                chunks = splitter(
-                    chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
-                ).split_documents(documents=docs)
-            else:
-                chunks = splitter(
-                    chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
-                ).split_documents(documents=docs)
+            # 使用分割器对文档流进行切分
+            splitter_kwargs = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+            if length_function is not len:
+                splitter_kwargs["length_function"] = length_function
+            chunks = list(split_documents_stream(docs, splitter(**splitter_kwargs)))
             # 如果切分结果为空则返回空列表
             if not chunks:
                 return []
@@ -154,6 +173,11 @@ class IndexingChain(BaseIndexingChain):
         for chunk in chunks:
             chunk.metadata["id"] = str(uuid.uuid4())
 
+        # 近似重复的chunk不再生成多向量、不再向量化入库
+        chunk_index = get_chunk_index(file.kb_name) if file is not None else None
+        if chunk_index is not None:
+            chunks = chunk_index.deduplicate(file.filename, chunks)
+
         # 获取多向量参数
         smaller_chunk_size = self.multi_vector_param.get("smaller_chunk_size")
         summary = self.multi_vector_param.get("summary")
@@ -168,7 +192,11 @@ class IndexingChain(BaseIndexingChain):
             multi_vector_chunks.extend(generate_text_summaries(chunks))
         final_chunks = chunks + multi_vector_chunks
         if self.is_merge_small_chunks:
-            final_chunks = merge_small_chunks(final_chunks)
+            final_chunks = merge_small_chunks(final_chunks, length_function=length_function,
+                                              max_chunk_size=chunk_size)
+        # 以合并后的chunk暂存签名, 入库成功后才写入去重索引
+        if chunk_index is not None:
+            chunk_index.stage(file.filename, final_chunks)
         return final_chunks
 
     def __add_knowledge_path(self, chunk):
@@ -202,7 +230,7 @@ class IndexingChain(BaseIndexingChain):
         try:
             logger.info(f"加载文件 {file.filename} 开始")
             docs = self.load(file=file, loader=None)
-            chunks = self.split(docs=docs, splitter=file.text_splitter)
+            chunks = self.split(docs=docs, splitter=file.text_splitter, file=file)
             if self.knowledge_path_enhance:
                 for chunk in chunks:
                     self.__add_knowledge_path(chunk)
@@ -211,7 +239,7 @@ class IndexingChain(BaseIndexingChain):
                     filename = os.path.splitext(file.filename)[0]
                     chunk.page_content = f"{filename}: \n{chunk.page_content}"
             if self.add_context:
-                chunks = generate_contextual(chunks)
+                chunks = generate_contextual(chunks, window_size=self.context_window_size)
             # NOTE 保存文档内容到文件, 用于方便调试查看chunk的, 排查问题
             if self.is_save_chunks:
                 save_chunks_to_file(chunks, file.filename)
@@ -219,6 +247,9 @@ class IndexingChain(BaseIndexingChain):
         except Exception as e:
             msg = f"从文件 {file.filename} 加载文档时出错：{e}"
             logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+            chunk_index = get_chunk_index(file.kb_name)
+            if chunk_index is not None:
+                chunk_index.discard(file.filename)
             return False, (file, msg)
 
     def store(self, file: KnowledgeFile, chunks: List[Document]):
@@ -235,15 +266,26 @@ class IndexingChain(BaseIndexingChain):
         1. 删除数据库中该文件的旧记录
         2. 更新向量数据库
         3. 将新的文件和文档信息添加到数据库
+        4. 将实际入库的chunk签名写入去重索引(如果启用)
         """
-        # step 1. 删除db中该文件相关记录, 及其相关文档
-        del_status = delete_file_from_db(file)
+        chunk_index = get_chunk_index(file.kb_name)
+        try:
+            # step 1. 删除db中该文件相关记录, 及其相关文档
+            del_status = delete_file_from_db(file)
 
-        # step 2. 将docs更新到向量数据库，同样需要将老记录删除
-        doc_infos = self.vectorstore.update_doc(file=file, docs=chunks)
+            # step 2. 将docs更新到向量数据库，同样需要将老记录删除
+            doc_infos = self.vectorstore.update_doc(file=file, docs=chunks)
+        except Exception:
+            if chunk_index is not None:
+                chunk_index.discard(file.filename)
+            raise
+        if chunk_index is not None:
+            chunk_index.commit(file.filename, [chunk.metadata["id"] for chunk in chunks])
+        invalidate_answer_cache(file.kb_name, [file.filename])
 
         # step 3. 将更新后的信息添加到db
         add_file_status = add_file_to_db(file, docs_count=len(chunks))
+        invalidate_file_catalogue(file.kb_name)
         add_docs_status = add_docs_to_db(file.kb_name, file.filename, doc_infos=doc_infos)
         # add_keyword_status = add_chuncks_keyword_to_db(doc_infos, file.kb_name)
         add_db_status = add_file_status and add_docs_status
@@ -280,4 +322,41 @@ class IndexingChain(BaseIndexingChain):
             else:
                 file, error = result
                 failed_files[file.filename] = error
+        failed_files.update(self.reindex_orphaned_files({file.kb_name for file in files}))
+        return failed_files
+
+    def reindex_orphaned_files(self, kb_names: Iterable[str]) -> Dict[str, str]:
+        """重新入库重复chunk已失效的文件
+
+        开启入库去重时, 文件重新入库会移除其原有chunk, 其他文件中指向这些chunk而被跳过的重复chunk随之失效,
+        这些文件需要重新入库一次。
+
+        Returns:
+            处理失败的文件及错误信息
+        """
+        failed_files = {}
+        orphaned_files = []
+        for kb_name in kb_names:
+            chunk_index = get_chunk_index(kb_name)
+            if chunk_index is None:
+                continue
+            for filename in sorted(chunk_index.pop_orphaned_files()):
+                try:
+                    orphaned_files.append(KnowledgeFile(filename=filename, knowledge_base_name=kb_name))
+                except Exception as e:
+                    msg = f"加载文档 {filename} 时出错：{e}"
+                    logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+                    failed_files[filename] = msg
+        if not orphaned_files:
+            return failed_files
+
+        logger.info(f"重新入库重复chunk已失效的文件: {[file.filename for file in orphaned_files]}")
+        for status, result in run_in_thread_pool(func=self.file2chunks,
+                                                  params=[{"file": file} for file in orphaned_files]):
+            if status:
+                file, chunks = result
+                self.store(file, chunks)
+            else:
+                file, error = result
+                failed_files[file.filename] = error
         return failed_files
@@ -25,8 +25,11 @@
 # OF SUCH DAMAGE.
 
 
+import time
 from collections import defaultdict
 from collections.abc import Hashable
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from dataclasses import dataclass
 from itertools import chain
 from typing import Callable, Dict, Iterable, Iterator, List, Optional, TypeVar, Union
@@ -38,13 +41,19 @@ from rag.chains.base import BaseRetrievalChain
 from rag.common.configuration import settings
 from rag.common.utils import logger
 from rag.connector.vectorstore.base import VectorStoreBase
-from rag.module.pre_retrieval.hyde_qyery import generate_hyde
+from rag.module.indexing.dedup import get_canonical_ids
+from rag.module.pre_retrieval.hyde_qyery import generate_hyde, generate_hyde_rewrites
 from rag.module.pre_retrieval.multi_query import generate_queries
+from rag.module.pre_retrieval.rewrite_cache import normalize_query
+from rag.module.pre_retrieval.route_query import route_query_to_files
 from rag.module.utils import get_reranker
 
 T = TypeVar("T")
 H = TypeVar("H", bound=Hashable)
 
+# 推测检索时在后台执行查询改写
+_rewrite_executor = ThreadPoolExecutor(max_workers=4)
+
 
 class DocumentWithVSId(Document):
     """
@@ -74,7 +83,10 @@ class RetrievalChain(BaseRetrievalChain):
         top_k (int): 返回的最大文档数量。
         score_threshold (Union[None, float]): 文档相似度阈值。
         multi_query (bool): 是否启用多查询模式。
-        route_query (bool): 是否启用查询路由。 TODO: 未实现
+        route_query (bool): 是否启用查询路由，路由到的文件作为向量检索的过滤条件。
+        hyde (bool): 是否启用hyde查询改写。
+        speculative (bool): 是否启用推测检索，查询改写与原始查询的检索并行执行，改写完成后只补充检索改写后的查询。
+        rewrite_timeout (float): 推测检索时等待查询改写的时间（秒，从检索开始计时），超时则只使用原始查询的检索结果。
 
     方法:
         __post_init__(): 初始化重排序模型。
@@ -93,6 +105,8 @@ class RetrievalChain(BaseRetrievalChain):
     multi_query: bool = False  # 默认关闭多查询
     route_query: bool = False
     hyde: bool = False
+    speculative: bool = False
+    rewrite_timeout: float = 3.0
 
     def __post_init__(self):
         """ "
@@ -151,7 +165,20 @@ class RetrievalChain(BaseRetrievalChain):
             return generate_queries(query)
         return []
 
-    def retrieval(self, query: str) -> Dict[str, List[Document]]:
+    def route(self, query: str) -> List[str]:
+        """
+        将查询路由到知识库中的文件，未开启路由或无法路由时返回空列表。
+        """
+        if not (self.route_query and self.vectorstore):
+            return []
+        try:
+            return route_query_to_files(query, self.vectorstore.knowledge_base_name) or []
+        except Exception as e:
+            msg = f"查询路由出错：{e}"
+            logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+            return []
+
+    def retrieval(self, query: str, file_names: Optional[List[str]] = None) -> Dict[str, List[Document]]:
         """
         执行文档检索操作。
 
@@ -159,6 +186,7 @@ class RetrievalChain(BaseRetrievalChain):
 
         参数:
             query (str): 用于检索文档的查询字符串。
+            file_names (Optional[List[str]]): 只在这些文件中进行向量检索，为空时检索整个知识库。
 
         返回:
             Dict[str, List[Document]]: 一个字典，其中键是检索方法的标识符，值是检索到的文档列表。
@@ -171,7 +199,11 @@ class RetrievalChain(BaseRetrievalChain):
         ensemble_docs = {}
         # 使用向量数据库的召回
         if self.vectorstore:
-            kwargs = {}
+            kwargs = {"file_names": file_names} if file_names else {}
+            # 开启入库去重时, 文件中被跳过的近似重复chunk以其指向的保留chunk参与检索
+            extra_ids = get_canonical_ids(self.vectorstore.knowledge_base_name, file_names) if file_names else []
+            if extra_ids:
+                kwargs["extra_ids"] = extra_ids
             documents = []
             docs = self.vectorstore.search_docs(
                 query, self.vectorstore_top_k, self.score_threshold, **kwargs
@@ -240,6 +272,39 @@ class RetrievalChain(BaseRetrievalChain):
             f_documents = [{"document": doc} for doc in f_documents]
         return f_documents
 
+    def speculative_retrieval(self, query: str, file_names: Optional[List[str]] = None):
+        """
+        推测检索：在后台改写查询的同时检索原始查询，改写在 rewrite_timeout 内完成时只补充检索改写后与原始查询不同的查询。
+
+        返回:
+            Tuple[str, Dict[str, List[Document]]]: 用于重排序的查询（hyde时为改写后的查询）及检索结果。
+        """
+        start = time.monotonic()
+        rewrite = _rewrite_executor.submit(generate_hyde_rewrites if self.hyde else generate_queries, query)
+        docs = self.retrieval(query, file_names=file_names)
+        try:
+            result = rewrite.result(timeout=max(0.0, self.rewrite_timeout - (time.monotonic() - start)))
+        except FutureTimeoutError:
+            # 改写在后台继续执行，结果写入缓存供后续相同的问题使用
+            logger.warning(f"查询改写超过 {self.rewrite_timeout}s, 只使用原始查询的检索结果")
+            return query, docs
+        except Exception as e:
+            msg = f"查询改写出错：{e}"
+            logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+            return query, docs
+
+        seen = {normalize_query(query)}
+        for i, q in enumerate([result] if self.hyde else result):
+            if not q.strip() or normalize_query(q) in seen:
+                continue
+            seen.add(normalize_query(q))
+            q_docs = self.retrieval(q, file_names=file_names)
+            for r_k in q_docs:
+                docs[str(i + 1) + "_" + r_k] = q_docs[r_k]
+        if self.hyde:
+            query = query + "\n" + result
+        return query, docs
+
     def chain(self, query: str):
         """
         执行检索链的主要流程。
@@ -248,7 +313,7 @@ class RetrievalChain(BaseRetrievalChain):
         query (str): 用户输入的查询字符串。
 
         流程:
-        1. 预处理查询，可能生成多个查询变体。
+        1. 预处理查询，可能生成多个查询变体，开启路由时确定检索的文件范围。
         2. 对原始查询进行检索。
         3. 对每个查询变体进行检索，并将结果合并到主文档集中。
         4. 对检索到的文档进行后处理（重新排序）。
@@ -257,16 +322,20 @@ class RetrievalChain(BaseRetrievalChain):
         返回:
         List[Dict]: 包含重新排序后的文档及其相关信息的列表。
         """
-        queries = self.pre_retrieval(query)
-        if self.hyde:  # hyde直接转换,不需要多查询
-            query = generate_hyde(query)
-            print("hyde query: ", query)
-        docs = self.retrieval(query)
-        # 多查询处理
-        for i, q in enumerate(queries):
-            q_docs = self.retrieval(q)
-            for r_k in q_docs:
-                docs[str(i + 1) + "_" + r_k] = q_docs[r_k]
+        file_names = self.route(query)
+        if self.speculative and (self.hyde or self.multi_query):
+            query, docs = self.speculative_retrieval(query, file_names=file_names)
+        else:
+            queries = self.pre_retrieval(query)
+            if self.hyde:  # hyde直接转换,不需要多查询
+                query = generate_hyde(query)
+                print("hyde query: ", query)
+            docs = self.retrieval(query, file_names=file_names)
+            # 多查询处理
+            for i, q in enumerate(queries):
+                q_docs = self.retrieval(q, file_names=file_names)
+                for r_k in q_docs:
+                    docs[str(i + 1) + "_" + r_k] = q_docs[r_k]
         docs = self.post_retrieval(query, docs)  # 重新排序
         for d in docs:
             print(d)
@@ -108,6 +108,36 @@ class LLMConfig(ConfigWizard):
         default="teco",
         help_txt="The server type of the hosted model. Allowed values are triton-trt-llm and nemo-infer",
     )
+    max_concurrency: int = configfield(
+        "max_concurrency",
+        default=8,
+        help_txt="The max number of in-flight llm requests when indexing.",
+    )
+    max_retries: int = configfield(
+        "max_retries",
+        default=3,
+        help_txt="The number of retries of a failed llm request when indexing.",
+    )
+    cache_max_size: int = configfield(
+        "cache_max_size",
+        default=512,
+        help_txt="The max size (MB) of the disk cache of llm outputs when indexing, 0 to disable.",
+    )
+    tokenizer_path: str = configfield(
+        "tokenizer_path",
+        default="",
+        help_txt="The name or local path of the tokenizer of the llm, used to count prompt tokens.",
+    )
+    max_prompt_tokens: int = configfield(
+        "max_prompt_tokens",
+        default=6144,
+        help_txt="The max number of prompt tokens of rag generation, 0 for no limit.",
+    )
+    scheduler: dict = configfield(
+        "scheduler",
+        default_factory=dict,
+        help_txt="Concurrency and queue limits of llm requests of each priority class.",
+    )
 
 
 @configclass
@@ -116,6 +146,7 @@ class TextSplitterConfig(ConfigWizard):
 
     :cvar chunk_size: Chunk size for text splitter. Tokens per chunk in token-based splitters.
     :cvar chunk_overlap: Text overlap in text splitter.
+    :cvar length_unit: Unit of chunk_size/chunk_overlap, char or token (embedding model's tokenizer).
     """
 
     splitter_name: str = configfield(
@@ -134,6 +165,12 @@ class TextSplitterConfig(ConfigWizard):
         default=200,
         help_txt="Overlapping text length for splitting.",
     )
+    length_unit: str = configfield(
+        "length_unit",
+        default="char",
+        help_txt="Unit of chunk_size and chunk_overlap. Allowed values are {char, token}. "
+                 "token measures chunks with the tokenizer of the embedding model.",
+    )
 
     smaller_chunk_size: int = configfield(
         "smaller_chunk_size",
@@ -299,6 +336,94 @@ class KnowledgeGraphConfig(ConfigWizard):
     )
 
 
+@configclass
+class AnswerCacheConfig(ConfigWizard):
+    """Configuration class for the semantic answer cache."""
+
+    enable: bool = configfield(
+        "enable",
+        default=False,
+        help_txt="Whether to reuse answers of semantically similar questions.",
+    )
+    threshold: float = configfield(
+        "threshold",
+        default=0.95,
+        help_txt="The min cosine similarity between questions to hit the cache.",
+    )
+    max_entries: int = configfield(
+        "max_entries",
+        default=1000,
+        help_txt="The max number of cached answers of each knowledge base.",
+    )
+    stream_chunk_size: int = configfield(
+        "stream_chunk_size",
+        default=16,
+        help_txt="The number of characters of each chunk when streaming a cached answer.",
+    )
+
+
+@configclass
+class OCRConfig(ConfigWizard):
+    """Configuration class for OCR of images in documents."""
+
+    num_workers: int = configfield(
+        "num_workers",
+        default=2,
+        help_txt="The number of OCR workers, each with its own OCR instance.",
+    )
+    batch_size: int = configfield(
+        "batch_size",
+        default=8,
+        help_txt="The number of images sent to an OCR worker at a time.",
+    )
+    max_side: int = configfield(
+        "max_side",
+        default=1600,
+        help_txt="Images are downscaled so that the longest side is at most this many pixels, 0 to disable.",
+    )
+    time_budget: float = configfield(
+        "time_budget",
+        default=300,
+        help_txt="The OCR time budget in seconds of each document, 0 for unlimited.",
+    )
+    text_density_threshold: float = configfield(
+        "text_density_threshold",
+        default=2.0,
+        help_txt="Pages whose native text has fewer non-blank characters per 100x100pt are OCR'd.",
+    )
+    image_coverage_threshold: float = configfield(
+        "image_coverage_threshold",
+        default=0.8,
+        help_txt="Pages with an image covering at least this fraction of the page are OCR'd as scanned pages.",
+    )
+
+
+@configclass
+class ChunkDedupConfig(ConfigWizard):
+    """Configuration class for near-duplicate chunk elimination during indexing."""
+
+    enable: bool = configfield(
+        "enable",
+        default=False,
+        help_txt="Skip chunks that are near-duplicates of chunks already in the knowledge base.",
+    )
+    threshold: float = configfield(
+        "threshold",
+        default=0.9,
+        help_txt="Chunks whose estimated Jaccard similarity to an indexed chunk reaches this value are skipped.",
+    )
+    num_perm: int = configfield(
+        "num_perm",
+        default=128,
+        help_txt="The number of MinHash permutations of each chunk signature.",
+    )
+    ngram_size: int = configfield(
+        "ngram_size",
+        default=5,
+        help_txt="The size of character n-gram shingles.",
+    )
+
+
 @configclass
 class RagConfig(ConfigWizard):
     """Configuration class for the application.
@@ -369,6 +494,24 @@ class RagConfig(ConfigWizard):
         help_txt="The configuration of the graph db.",
         default=KnowledgeGraphConfig(),
     )
+    answer_cache: AnswerCacheConfig = configfield(
+        "answer_cache",
+        env=False,
+        help_txt="The configuration of the semantic answer cache.",
+        default=AnswerCacheConfig(),
+    )
+    ocr: OCRConfig = configfield(
+        "ocr",
+        env=False,
+        help_txt="The configuration of OCR of images in documents.",
+        default=OCRConfig(),
+    )
+    chunk_dedup: ChunkDedupConfig = configfield(
+        "chunk_dedup",
+        env=False,
+        help_txt="The configuration of near-duplicate chunk elimination during indexing.",
+        default=ChunkDedupConfig(),
+    )
 
 
 @lru_cache
@@ -26,6 +26,7 @@
 
 
 from rag.common.configuration import settings
+from rag.connector.llm.scheduler import LLMScheduler, ScheduledLLM
 from rag.connector.utils import get_llm, get_embedding_model, get_vectorstore
 
 embedding_model = get_embedding_model(settings.embeddings.model_name_or_path,
@@ -33,8 +34,14 @@ embedding_model = get_embedding_model(settings.embeddings.model_name_or_path,
 
 
 llm_kwargs = {"grpc_port": settings.llm.grpc_port, "api_key": settings.llm.api_key}
-llm = get_llm(model_name=settings.llm.model_name,
-              model_engine=settings.llm.model_engine,
-              ip=settings.llm.ip,
-              port=settings.llm.port,
-              **llm_kwargs)
+# 在线问答、查询改写、构建知识库共用同一个推理服务, 按优先级调度
+llm_scheduler = LLMScheduler.from_config(settings.llm.scheduler)
+llm = ScheduledLLM(llm=get_llm(model_name=settings.llm.model_name,
+                               model_engine=settings.llm.model_engine,
+                               ip=settings.llm.ip,
+                               port=settings.llm.port,
+                               **llm_kwargs),
+                   scheduler=llm_scheduler,
+                   priority="interactive")
+rewrite_llm = llm.with_priority("rewrite")
+batch_llm = llm.with_priority("batch")
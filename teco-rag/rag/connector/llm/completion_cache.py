@@ -0,0 +1,184 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+构建知识库时llm输出的磁盘缓存
+
+摘要、表格摘要、chunk上下文只取决于模型、采样参数和prompt, 重建知识库时直接复用上一次的输出。
+缓存保存在 KB_ROOT_PATH/llm_cache.db (sqlite), 总大小超过上限时按最近访问时间淘汰。
+多个入库线程、多个服务进程会同时读写同一个缓存文件; OCR结果缓存(loader/utils/ocr.py)也复用该实现。
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Optional
+
+from langchain_core.language_models.llms import BaseLLM
+
+from rag.common.configuration import settings
+from rag.connector.database.base import KB_ROOT_PATH
+
+LLM_CACHE_PATH = os.path.join(KB_ROOT_PATH, "llm_cache.db")
+
+# 推理服务地址等字段不影响输出, 不参与缓存key
+_EXCLUDE_PARAMS = {"ip", "port", "grpc_port", "api_key", "protocol"}
+
+
+def llm_params(llm: BaseLLM) -> dict:
+    """取llm上影响输出的标量参数(model_name、temperature、top_p等)"""
+    # ScheduledLLM 取被调度的llm
+    llm = getattr(llm, "llm", llm)
+    return {
+        name: getattr(llm, name)
+        for name in sorted(type(llm).model_fields)
+        if name not in _EXCLUDE_PARAMS
+        and isinstance(getattr(llm, name, None), (str, int, float, bool))
+    }
+
+
+class CompletionCache:
+    """prompt -> completion 的持久化缓存, 线程安全, 可由多个进程同时读写同一个文件
+
+    sqlite使用WAL模式并设置忙等待超时, 读写互不阻塞; 缓存总字节数记录在库内的 stats 表中, 与写入在同一个事务里更新,
+    各进程看到的总大小一致。读取时只在内存中记录访问时间, 攒够一批或写入时再批量更新, 命中缓存不会每次都写库。
+
+    Args:
+        path (str): sqlite文件路径
+        max_size (int): 缓存总字节数上限, 超过后淘汰最久未访问的记录至上限的90%
+        timeout (float): 等待其他进程释放写锁的最长时间(秒)
+    """
+
+    # 攒够这么多条访问记录后批量更新 accessed
+    TOUCH_BATCH_SIZE = 256
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_size: int = 512 * 1024 * 1024, timeout: float = 30.0):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._touched: Dict[str, float] = {}  # key: 最近一次读取的时间, 尚未写入库
+        # isolation_level=None: 自行用 BEGIN IMMEDIATE 开启写事务, 避免读锁升级为写锁时直接报 database is locked
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completion ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON completion (accessed)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                               "size INTEGER NOT NULL)")
+            # 旧版本的缓存文件没有 stats 表, 按现有记录初始化
+            self._conn.execute("INSERT OR IGNORE INTO stats (id, size) "
+                               "SELECT 0, COALESCE(SUM(size), 0) FROM completion")
+        # 全部命中缓存时没有写入, 退出前把攒下的访问时间写入库, 否则淘汰时会误删最常用的记录
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    @staticmethod
+    def make_key(params: dict, template: str, prompt: str) -> str:
+        """缓存key: (模型及采样参数, prompt模板, 渲染后的prompt) 的sha256"""
+        raw = json.dumps([params, template, prompt], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM completion WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._touched[key] = time.time()
+            if len(self._touched) >= self.TOUCH_BATCH_SIZE:
+                with self._transaction():
+                    self._flush_touched()
+            return row[0]
+
+    def set(self, key: str, value: str):
+        size = len(key) + len(value.encode("utf-8"))
+        with self._lock, self._transaction():
+            self._flush_touched()
+            old = self._conn.execute("SELECT size FROM completion WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO completion (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                               (key, value, size, time.time()))
+            self._conn.execute("UPDATE stats SET size = size + ? WHERE id = 0", (size - (old[0] if old else 0),))
+            total = self._conn.execute("SELECT size FROM stats WHERE id = 0").fetchone()[0]
+            if total > self.max_size:
+                self._evict(total, int(self.max_size * 0.9))
+
+    def flush(self):
+        """把内存中攒下的访问时间写入库"""
+        with self._lock:
+            if self._touched:
+                with self._transaction():
+                    self._flush_touched()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany("UPDATE completion SET accessed = ? WHERE key = ?",
+                                   [(accessed, key) for key, accessed in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self, total: int, target_size: int):
+        evicted, freed = [], 0
+        for key, size in self._conn.execute("SELECT key, size FROM completion ORDER BY accessed"):
+            if total - freed <= target_size:
+                break
+            evicted.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM completion WHERE key = ?", evicted)
+        self._conn.execute("UPDATE stats SET size = size - ? WHERE id = 0", (freed,))
+
+    def clear(self):
+        with self._lock, self._transaction():
+            self._touched.clear()
+            self._conn.execute("DELETE FROM completion")
+            self._conn.execute("UPDATE stats SET size = 0 WHERE id = 0")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM completion").fetchone()[0]
+
+
+@lru_cache
+def get_completion_cache() -> Optional[CompletionCache]:
+    """按 settings.llm.cache_max_size (MB) 创建缓存, 配置为0时不启用"""
+    if not settings.llm.cache_max_size:
+        return None
+    return CompletionCache(max_size=int(settings.llm.cache_max_size) * 1024 * 1024)
@@ -24,11 +24,12 @@
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
-from typing import List, Any, Optional
+from typing import List, Any, AsyncIterator, Optional
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from pydantic import PrivateAttr
 from langchain_core.language_models import LLM
-from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain_core.outputs import GenerationChunk
 
 from rag.common.utils import logger
@@ -45,17 +46,35 @@ class OpenaiCompatibleLLM(LLM):
     port: str
     output_len: int = 1024
 
+    # 复用客户端及其连接池, 不在每次请求时新建
+    _client: Optional[OpenAI] = PrivateAttr(default=None)
+    _async_client: Optional[AsyncOpenAI] = PrivateAttr(default=None)
+
+    @property
+    def client(self) -> OpenAI:
+        if self._client is None:
+            self._client = OpenAI(
+                api_key="EMPTY",
+                base_url="http://" + self.ip + ":" + self.port + "/v1",
+            )
+        return self._client
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(
+                api_key="EMPTY",
+                base_url="http://" + self.ip + ":" + self.port + "/v1",
+            )
+        return self._async_client
+
     def _stream(self,
                 prompt: str,
                 stop: Optional[List[str]] = None,
                 run_manager: Optional[CallbackManagerForLLMRun] = None,
                 **kwargs: Any, ):
-        client = OpenAI(
-            api_key="EMPTY",
-            base_url="http://"+self.ip+":"+self.port+"/v1",
-        )
         try:
-            response = client.chat.completions.create(
+            response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant."},
@@ -78,12 +97,55 @@ class OpenaiCompatibleLLM(LLM):
               stop: Optional[List[str]] = None,
               run_manager: Optional[CallbackManagerForLLMRun] = None,
               **kwargs: Any, ):
-        client = OpenAI(
-            api_key="EMPTY",
-            base_url="http://" + self.ip + ":" + self.port + "/v1",
-        )
         try:
-            response = client.chat.completions.create(
+            response = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+        except Exception as e:
+            msg = f'inference request error'
+            logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
+            return ''
+
+        return response.choices[0].message.content
+
+    async def _astream(self,
+                       prompt: str,
+                       stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any, ) -> AsyncIterator[GenerationChunk]:
+        try:
+            response = await self.async_client.chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=True
+            )
+        except Exception as e:
+            msg = f'inference request error'
+            logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
+            return
+
+        try:
+            async for res in response:
+                token = res.choices[0].delta.content
+                if token: yield GenerationChunk(text=token)
+        finally:
+            # 协程被取消(如客户端断开)时关闭连接, 推理服务随之中止生成
+            await response.close()
+
+    async def _acall(self,
+                     prompt: str,
+                     stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                     **kwargs: Any, ) -> str:
+        try:
+            response = await self.async_client.chat.completions.create(
                 model=self.model_name,
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant."},
@@ -0,0 +1,297 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+大模型请求调度
+
+同一个推理服务同时承担在线问答、查询改写和构建知识库时的批量请求, 按优先级分类限流:
+- interactive: 在线问答生成
+- rewrite: 查询改写、关键词抽取、文件路由等检索前的请求
+- batch: 构建知识库时的摘要、上下文生成
+每类请求有独立的并发上限、排队上限和排队超时, 队列已满或排队超时时抛出 LLMOverloadedError;
+interactive 请求的首token延迟超过目标值时自动降低 batch 的并发上限, 恢复后逐步放开;
+一段时间内没有新的 interactive 延迟样本时, 由 batch 请求的完成逐步放开。
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import LLM
+from langchain_core.outputs import GenerationChunk
+
+PRIORITIES = ("interactive", "rewrite", "batch")
+
+DEFAULT_CLASSES = {
+    "interactive": {"max_concurrency": 8, "max_queue": 64},
+    "rewrite": {"max_concurrency": 4, "max_queue": 64},
+    # 构建知识库的请求只排队不丢弃
+    "batch": {"max_concurrency": 8, "max_queue": 100000, "queue_timeout": 0},
+}
+
+
+
+def total_concurrency(config: Optional[dict]) -> int:
+    """各类请求并发上限之和, 即同时在途的大模型请求数上限"""
+    config = config or {}
+    return sum(max(1, {**DEFAULT_CLASSES[p], **config.get(p, {})}["max_concurrency"]) for p in PRIORITIES)
+
+# 异步请求在该线程池中排队等待
+_wait_executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="llm_scheduler")
+
+
+class LLMOverloadedError(RuntimeError):
+    """大模型调度队列已满或排队超时"""
+
+
+class _PriorityClass:
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.limit = max(1, max_concurrency)
+        self.effective_limit = self.limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+
+class LLMScheduler:
+    """
+    Args:
+        classes (Dict[str, dict]): 每类请求的 {"max_concurrency", "max_queue", "queue_timeout"}
+        queue_timeout (float): 未单独配置时的最长排队时间(秒), 为0时不限制
+        latency_target (float): interactive 请求首token延迟(秒)的目标值, 为0时不自动限流batch请求
+        latency_window (float): 超过该时间(秒)没有interactive延迟样本时, 认为延迟已过期,
+            每完成一个batch请求将batch并发上限加1
+    """
+
+    def __init__(self, classes: Dict[str, dict], queue_timeout: float = 60.0, latency_target: float = 0.0,
+                 latency_window: float = 30.0):
+        self._cond = threading.Condition()
+        self.classes = {
+            name: _PriorityClass(name, c.get("max_concurrency", 8), c.get("max_queue", 64),
+                                 c.get("queue_timeout", queue_timeout))
+            for name, c in classes.items()
+        }
+        self.latency_target = latency_target
+        self.latency_window = latency_window
+        self.interactive_latency: Optional[float] = None  # 首token延迟的指数滑动平均
+        self._latency_observed_at = 0.0  # 最近一次interactive延迟样本的时间
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]) -> "LLMScheduler":
+        config = config or {}
+        classes = {p: {**DEFAULT_CLASSES[p], **config.get(p, {})} for p in PRIORITIES}
+        return cls(classes,
+                   queue_timeout=config.get("queue_timeout", 60.0),
+                   latency_target=config.get("interactive_latency_target", 0.0),
+                   latency_window=config.get("interactive_latency_window", 30.0))
+
+    def _get_class(self, priority: str) -> _PriorityClass:
+        if priority not in self.classes:
+            raise ValueError(f"未知的请求优先级 {priority}, 可选项: {list(self.classes)}")
+        return self.classes[priority]
+
+    def check_admission(self, priority: str):
+        """不排队, 只检查该类请求的队列是否已满, 用于在接收请求时尽早拒绝"""
+        c = self._get_class(priority)
+        with self._cond:
+            if c.waiting >= c.max_queue:
+                c.rejected += 1
+                raise LLMOverloadedError(f"大模型服务繁忙: {priority} 队列已满({c.max_queue}), 请稍后重试")
+
+    def acquire(self, priority: str):
+        c = self._get_class(priority)
+        start = time.monotonic()
+        with self._cond:
+            if c.waiting == 0 and c.running < c.effective_limit:
+                c.running += 1
+                return
+            if c.waiting >= c.max_queue:
+                c.rejected += 1
+                raise LLMOverloadedError(f"大模型服务繁忙: {priority} 队列已满({c.max_queue}), 请稍后重试")
+            c.waiting += 1
+            try:
+                granted = self._cond.wait_for(lambda: c.running < c.effective_limit,
+                                              timeout=c.queue_timeout or None)
+            finally:
+                c.waiting -= 1
+            if not granted:
+                c.rejected += 1
+                raise LLMOverloadedError(f"大模型服务繁忙: {priority} 排队超过 {c.queue_timeout}s, 请稍后重试")
+            c.running += 1
+            c.total_wait += time.monotonic() - start
+
+    def release(self, priority: str, latency: Optional[float] = None):
+        c = self._get_class(priority)
+        with self._cond:
+            c.running -= 1
+            c.completed += 1
+            if priority == "interactive" and latency is not None:
+                self._observe_latency(latency)
+            elif priority == "batch":
+                self._recover_batch()
+            self._cond.notify_all()
+
+    def _observe_latency(self, latency: float):
+        """根据interactive延迟调整batch并发: 超过目标值时减半, 否则每次加1直到配置的上限"""
+        self.interactive_latency = latency if self.interactive_latency is None \
+            else 0.8 * self.interactive_latency + 0.2 * latency
+        self._latency_observed_at = time.monotonic()
+        batch = self.classes.get("batch")
+        if not self.latency_target or batch is None:
+            return
+        if self.interactive_latency > self.latency_target:
+            batch.effective_limit = max(1, batch.effective_limit // 2)
+        else:
+            batch.effective_limit = min(batch.limit, batch.effective_limit + 1)
+
+    def _recover_batch(self):
+        """interactive请求停止后不会再有延迟样本, 超过 latency_window 时丢弃过期的滑动平均, 并按batch完成逐步放开"""
+        batch = self.classes["batch"]
+        if batch.effective_limit >= batch.limit or \
+                time.monotonic() - self._latency_observed_at < self.latency_window:
+            return
+        # 过期的高延迟不再参与下一次滑动平均, 否则新样本到来时会立即再次减半
+        self.interactive_latency = None
+        batch.effective_limit += 1
+
+    @contextmanager
+    def slot(self, priority: str):
+        """占用一个并发名额, 返回的dict中可以写入 "latency"(首token延迟)
+
+        只有流式请求会记录首token延迟; 非流式请求的耗时包含整个生成过程, 不计入interactive延迟, 也不影响batch并发。
+        """
+        self.acquire(priority)
+        stats = {"latency": None}
+        try:
+            yield stats
+        finally:
+            self.release(priority, stats["latency"])
+
+    @asynccontextmanager
+    async def aslot(self, priority: str):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_wait_executor, self.acquire, priority)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 排队时被取消, 之后拿到的名额立即归还
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or self.release(priority))
+            raise
+        stats = {"latency": None}
+        try:
+            yield stats
+        finally:
+            self.release(priority, stats["latency"])
+
+    def metrics(self) -> dict:
+        """各类请求的并发、排队及拒绝数量"""
+        with self._cond:
+            return {
+                "interactive_latency": self.interactive_latency,
+                "classes": {
+                    name: {
+                        "running": c.running,
+                        "waiting": c.waiting,
+                        "max_concurrency": c.limit,
+                        "effective_concurrency": c.effective_limit,
+                        "max_queue": c.max_queue,
+                        "completed": c.completed,
+                        "rejected": c.rejected,
+                        "avg_wait": c.total_wait / c.completed if c.completed else 0.0,
+                    }
+                    for name, c in self.classes.items()
+                },
+            }
+
+
+class ScheduledLLM(LLM):
+    """在调度器中按优先级执行请求的llm"""
+
+    llm: LLM
+    scheduler: Any
+    priority: str = "interactive"
+
+    def with_priority(self, priority: str) -> "ScheduledLLM":
+        return ScheduledLLM(llm=self.llm, scheduler=self.scheduler, priority=priority)
+
+    def _call(self,
+              prompt: str,
+              stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None,
+              **kwargs: Any, ) -> str:
+        with self.scheduler.slot(self.priority):
+            return self.llm._call(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(self,
+                prompt: str,
+                stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any, ) -> Iterator[GenerationChunk]:
+        if type(self.llm)._stream is LLM._stream:
+            # 未实现流式接口的llm, 一次性返回
+            yield GenerationChunk(text=self._call(prompt, stop=stop, run_manager=run_manager, **kwargs))
+            return
+        with self.scheduler.slot(self.priority) as stats:
+            start = time.monotonic()
+            for chunk in self.llm._stream(prompt, stop=stop, run_manager=run_manager, **kwargs):
+                if stats["latency"] is None:
+                    stats["latency"] = time.monotonic() - start
+                yield chunk
+
+    async def _acall(self,
+                     prompt: str,
+                     stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                     **kwargs: Any, ) -> str:
+        async with self.scheduler.aslot(self.priority):
+            return await self.llm._acall(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _astream(self,
+                       prompt: str,
+                       stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any, ) -> AsyncIterator[GenerationChunk]:
+        async with self.scheduler.aslot(self.priority) as stats:
+            start = time.monotonic()
+            async for chunk in self.llm._astream(prompt, stop=stop, run_manager=run_manager, **kwargs):
+                if stats["latency"] is None:
+                    stats["latency"] = time.monotonic() - start
+                yield chunk
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled_{self.priority}"
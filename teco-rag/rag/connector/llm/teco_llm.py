@@ -25,21 +25,45 @@
 # OF SUCH DAMAGE.
 
 
-from typing import List, Any, Optional
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any, AsyncIterator, Iterator, Optional
 
 from teco_client_toolkits import ClientRequest, TritonRequestParams, ApiType
 from rag.connector.llm.prompt_templates import build_input
+from rag.connector.llm.scheduler import total_concurrency
 
+from rag.common.configuration import settings
 from rag.common.utils import logger
 
 from langchain_core.language_models import LLM
-from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain_core.outputs import GenerationChunk
 
 """
 基于Langchain和Teco-Modelzoo-LLM-infer实现大模型接口
 """
 
+# 异步流式请求的后台读取线程, 每个进行中的流占用一个线程, 与默认线程池隔离。
+# 流式请求都在调度器的并发名额内发起, 线程数取各类请求并发上限之和即可
+_stream_executor = ThreadPoolExecutor(max_workers=total_concurrency(settings.llm.scheduler),
+                                      thread_name_prefix="teco_llm_stream")
+
+
+def _log_background_error(future: asyncio.Future, msg: str = 'triton stream producer error'):
+    """后台线程在协程结束(包括被取消)后抛出的异常只能记录日志"""
+    if not future.cancelled() and future.exception() is not None:
+        e = future.exception()
+        logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
+
+
+def _close_stream(result):
+    """关闭grpc流, 中止服务端的生成"""
+    close = getattr(result, "close", None)
+    if close is not None:
+        close()
+
 
 class TecoLLM(LLM):
     """
@@ -62,17 +86,14 @@ class TecoLLM(LLM):
     start_id: int = 1
     end_id: int = 2
     protocol: str = 'grpc'
+    stream_buffer_size: int = 32  # 异步流式输出时缓存的最大token段数, 消费方跟不上时暂停读取上游
 
     # class Config:
     #     """Configuration for this pydantic object."""
     #     extra = Extra.forbid
 
-    def _stream(self,
-                prompt: str,
-                stop: Optional[List[str]] = None,
-                run_manager: Optional[CallbackManagerForLLMRun] = None,
-                **kwargs: Any, ):
-
+    def _request_stream(self, prompt: str):
+        """发起流式请求, 返回teco_client_toolkits的流(同步迭代器)"""
         if self.model_name in ["Qwen-7B-Chat", "Qwen-72B"]:
             self.stop_word = "<|im_end|>"
             self.end_id = 151643
@@ -92,17 +113,15 @@ class TecoLLM(LLM):
                                     stop_words_list=[[self.stop_word]],
                                     protocol=self.protocol)  # 构造请求参数，triton区分ensemble格式和non-ensemble格式
 
-        try:
-            res = client.request(prompts=build_input(prompt, model_name=self.model_name),
-                                 api_type=ApiType.TRITON,
-                                 stream=True,
-                                 params=param)
-            result = res.streamer
-        except Exception as e:
-            msg = f'triton stream request error'
-            logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
-            return ''
+        res = client.request(prompts=build_input(prompt, model_name=self.model_name),
+                             api_type=ApiType.TRITON,
+                             stream=True,
+                             params=param)
+        return res.streamer
 
+    @staticmethod
+    def _iter_chunks(result) -> Iterator[GenerationChunk]:
+        """服务端每次返回截至当前的完整输出, 转换为增量的token段"""
         split_size = 0
         for out in result:
             token = out['outputs'][split_size:]
@@ -113,6 +132,96 @@ class TecoLLM(LLM):
             split_size += len(token)
             yield GenerationChunk(text=token)
 
+    def _stream(self,
+                prompt: str,
+                stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any, ):
+        try:
+            result = self._request_stream(prompt)
+        except Exception as e:
+            msg = f'triton stream request error'
+            logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
+            return ''
+
+        try:
+            yield from self._iter_chunks(result)
+        finally:
+            # 提前结束(调用方关闭生成器)时关闭grpc流, 中止服务端的生成
+            _close_stream(result)
+
+    async def _astream(self,
+                       prompt: str,
+                       stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any, ) -> AsyncIterator[GenerationChunk]:
+        """
+        teco_client_toolkits 只提供同步的流式接口(请求格式由其内部封装, 无法直接改用grpc.aio),
+        在专用线程池的后台线程中读取grpc流, 通过有界队列交给事件循环:
+        - 队列满时后台线程阻塞, 不再读取上游(背压)
+        - 协程被取消(如客户端断开)时立即在事件循环侧关闭grpc流, 取消服务端的生成,
+          不等待后台线程收到下一个token; 阻塞在读取上的后台线程随之退出
+        - 后台线程的异常在其结束时记录日志, 协程已结束时也不会丢失
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.stream_buffer_size)
+        stopped = threading.Event()
+        lock = threading.Lock()
+        streams = []
+        end = object()
+
+        def produce():
+            try:
+                result = self._request_stream(prompt)
+                with lock:
+                    streams.append(result)
+                    cancelled = stopped.is_set()
+                if cancelled:
+                    # 协程在请求发起前已结束
+                    _close_stream(result)
+                    return
+                for chunk in self._iter_chunks(result):
+                    if stopped.is_set():
+                        break
+                    asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+            except Exception as e:
+                if not stopped.is_set():
+                    msg = f'triton stream request error'
+                    logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
+            finally:
+                if not stopped.is_set():
+                    asyncio.run_coroutine_threadsafe(queue.put(end), loop).result()
+
+        producer = loop.run_in_executor(_stream_executor, produce)
+        producer.add_done_callback(_log_background_error)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is end:
+                    break
+                yield chunk
+        finally:
+            with lock:
+                stopped.set()
+                result = streams[0] if streams else None
+            if result is not None:
+                # 关闭可能阻塞, 不占用事件循环
+                closing = loop.run_in_executor(None, _close_stream, result)
+                closing.add_done_callback(lambda f: _log_background_error(f, 'triton stream close error'))
+            # 清空队列, 唤醒可能阻塞在put上的后台线程
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def _acall(self,
+                     prompt: str,
+                     stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                     **kwargs: Any, ) -> str:
+        output = ""
+        async for chunk in self._astream(prompt, stop=stop, run_manager=run_manager, **kwargs):
+            output += chunk.text
+        return output
+
     def _call(self,
               prompt: str,
               stop: Optional[List[str]] = None,
@@ -27,9 +27,11 @@
 
 from abc import ABC, abstractmethod
 import operator
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from langchain_core.documents import Document
 
+from rag.common.utils import logger
+
 
 class VectorStoreBase(ABC):
     """向量存储的基类实现"""
@@ -89,11 +91,70 @@ class VectorStoreBase(ABC):
             text: 搜索查询文本
             top_k: 返回的最大结果数
             threshold: 相似度阈值
-            **kwargs: 其他可选参数
+            **kwargs: 其他可选参数，file_names: 只在这些文件中检索，extra_ids: 与file_names一起指定时这些chunk也参与检索
 
         Returns:
             List[Tuple[Document, float]]: 搜索结果列表，每个元素为(文档, 相似度分数)的元组
         """
         pass
 
+    def batch_search_docs(self, texts, top_k, threshold, **kwargs) -> List[List[Tuple[Document, float]]]:
+        """批量检索多个查询，默认逐条调用search_docs，支持批量计算的向量存储可覆盖该方法
+
+        Args:
+            texts: 搜索查询文本列表
+            top_k: 每个查询返回的最大结果数
+            threshold: 相似度阈值
+            **kwargs: 其他可选参数
+
+        Returns:
+            List[List[Tuple[Document, float]]]: 与texts一一对应的搜索结果列表
+        """
+        return [self.search_docs(text, top_k, threshold, **kwargs) for text in texts]
+
+    @abstractmethod
+    def _get_parent_docs(self, ids: List[str]) -> Dict[str, Document]:
+        """按id取父文档(multi_vector的原始chunk)
+
+        Args:
+            ids: 父文档id列表
+
+        Returns:
+            Dict[str, Document]: parent_id: parent_doc
+        """
+        pass
 
+    def _post_process(self, docs, top_k, threshold):
+        if threshold is not None:
+            docs = self._score_threshold_process(docs, threshold, top_k)
+
+        # 兼容multi_vector，召回父文档
+        parent_doc_map = {}         # retrieval_index: parent_id
+        for i, tp in enumerate(docs):
+            parent_id = tp[0].metadata.get("parent_id")
+            if parent_id is not None: parent_doc_map[i] = parent_id
+
+        if len(parent_doc_map) > 0:
+            try:
+                # parent_id: parent_doc
+                parent_docs = self._get_parent_docs(list(set(parent_doc_map.values())))
+                for doc_index in parent_doc_map:
+                    docs[doc_index] = tuple([parent_docs[parent_doc_map[doc_index]], docs[doc_index][1]])
+
+            except Exception as e:
+                msg = f"路由到parent chunk失败：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
+
+        return docs
+
+    def _score_threshold_process(self, docs, score_threshold, k):
+        if score_threshold is not None:
+            cmp = (
+                operator.ge
+            )
+            docs = [
+                (doc, similarity)
+                for doc, similarity in docs
+                if cmp(similarity, score_threshold)
+            ]
+        return docs[:k]
@@ -91,16 +91,19 @@ class ChromaVectorStore(VectorStoreBase):
 
             doc_id = doc.metadata.get("id", str(uuid.uuid4()))
             doc_ids.append(doc_id)
+        if len(doc_ids) == 0:
+            return []
         embeddings = self.embeddings.embed_documents(doc_text)
 
-        print("doc_ids:", doc_ids)
-        print("documents", doc_text)
-        print("metadatas", doc_metadata)
-        print("embeddings", self.embeddings.embed_documents(doc_text))
-        self.collection.add(ids=doc_ids, documents=doc_text,
-                            metadatas=doc_metadata,
-                            embeddings=embeddings)
-        doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(doc_ids, docs)]
+        # 单次写入不能超过client的max_batch_size, 按id upsert保证重复写入幂等
+        batch_size = self.client.get_max_batch_size()
+        for start in range(0, len(doc_ids), batch_size):
+            end = start + batch_size
+            self.collection.upsert(ids=doc_ids[start:end], documents=doc_text[start:end],
+                                   metadatas=doc_metadata[start:end],
+                                   embeddings=embeddings[start:end])
+        doc_infos = [{"id": id, "metadata": doc.metadata, "page_content": doc.page_content}
+                     for id, doc in zip(doc_ids, docs)]
         return doc_infos
 
     def delete_doc(self, filename):
@@ -128,11 +131,33 @@ class ChromaVectorStore(VectorStoreBase):
         :param text:
         :param top_k:
         :param threshold:
+        :param kwargs: file_names限定检索的文件范围, extra_ids为file_names之外一并检索的chunk id,
+            where为chroma的metadata过滤条件
         :return: List[Tuple[Document, float]]: Result doc and score.
         """
         text_embeddings = self.embeddings.embed_query(text)
-        query_result: QueryResult = self.collection.query(query_embeddings=text_embeddings, n_results=top_k)
-        return self._results_to_docs_and_scores(query_result)
+        where = kwargs.get("where")
+        file_names = kwargs.get("file_names")
+        if file_names:
+            file_filter = {"source": {"$in": [md5_encryption(f) for f in file_names]}}
+            extra_ids = kwargs.get("extra_ids")
+            if extra_ids:
+                file_filter = {"$or": [file_filter, {"id": {"$in": list(extra_ids)}}]}
+            where = {"$and": [where, file_filter]} if where else file_filter
+        query_result: QueryResult = self.collection.query(query_embeddings=text_embeddings,
+                                                          n_results=top_k,
+                                                          where=where)
+        docs = self._results_to_docs_and_scores(query_result)
+        return self._post_process(docs, top_k, threshold)
+
+    def _get_parent_docs(self, ids):
+        result: GetResult = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        return {
+            p_id: Document(page_content=p_text, metadata=p_metadata or {})
+            for p_id, p_text, p_metadata in zip(result["ids"],
+                                                result["documents"],
+                                                result["metadatas"])
+        }
 
     def _results_to_docs_and_scores(self, results) -> List[Tuple[Document, float]]:
         """
@@ -0,0 +1,422 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+
+import copy
+import tempfile
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+# 估计候选倍数时使用的query数和top_k
+CALIBRATION_QUERIES = 128
+CALIBRATION_TOP_K = 10
+MAX_RESCORE_FACTOR = 64
+
+
+def l2_normalize(embeddings) -> np.ndarray:
+    """转换为连续的float32矩阵并按行归一化，归一化后内积即余弦相似度"""
+    vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class FlatIndex:
+    """进程内的精确向量检索引擎（等价于Milvus的FLAT索引 + COSINE度量）
+
+    - 向量归一化后保存在一块连续的float32矩阵中，余弦相似度即内积
+    - 一批query按块与向量矩阵做一次矩阵乘（GEMM），每块用argpartition取top-k后再归并
+    - 写入时只追加到预分配的空闲行，删除时生成新矩阵，检索线程拿到的快照不会被修改
+    - 配置量化器时，内存中只保存压缩编码，全精度向量追加写入磁盘上的临时文件（np.memmap），
+      检索时先用编码召回候选，再从该文件读取候选的全精度向量重新打分，不经过网络
+    - 向量数达到训练样本数之前内存中保存float32原始向量并精确检索；达到后在蓄水池采样的原始向量上训练量化器，
+      之后向量数每增长 retrain_factor 倍重新训练。训练在锁外进行，不阻塞检索和写入，
+      重新编码始终使用磁盘上的全精度向量，误差不会随重新训练累积
+    - 每次训练后在样本上估计达到 recall_target 所需的候选倍数，作为默认的 rescore_factor
+
+    Attributes:
+        block_size: 每次参与矩阵乘的向量行数，控制单次打分矩阵的内存占用
+        quantizer: 量化器（见 quantization.py），为None时保存float32原始向量
+        group_key: 用于分组过滤的元数据字段，默认按文件(source)分组
+        train_size: 训练量化器的样本数，不小于量化器要求的最少样本数(quantizer.min_train_size)
+        retrain_factor: 向量数相对上次训练时增长到该倍数时重新训练
+        recall_target: 重打分前候选集对精确top-k的期望召回率
+        original_dir: 全精度向量临时文件所在目录，为None时使用系统临时目录
+        rescore_factor: 根据 recall_target 估计的候选倍数，训练前为1
+    """
+
+    def __init__(self, block_size: int = 65536, quantizer=None, group_key: str = "source",
+                 train_size: int = 20000, retrain_factor: float = 2.0, recall_target: float = 0.95,
+                 original_dir: Optional[str] = None, seed: int = 0):
+        self.block_size = block_size
+        self.quantizer = quantizer
+        self.group_key = group_key
+        self.train_size = max(train_size, getattr(quantizer, "min_train_size", 0))
+        self.retrain_factor = retrain_factor
+        self.recall_target = recall_target
+        self.original_dir = original_dir
+        self.rescore_factor = 1
+        self._rng = np.random.default_rng(seed)
+        self._sample: Optional[np.ndarray] = None  # 蓄水池采样的原始向量, 用于训练量化器
+        self._seen = 0  # 参与采样的向量总数
+        self._trained_size = 0  # 上次训练时的向量数, 0表示尚未训练
+        self._training = False
+        self._dirty = set()  # 训练期间写入的id, 训练结束时用新量化器重新编码
+        self._generation = 0  # clear时递增, 训练结束时据此丢弃过期的结果
+        self._originals: Optional[np.ndarray] = None  # 磁盘上的全精度向量(np.memmap), 仅量化时使用
+        self._original_size = 0  # _originals 中已写入的行数, 包括已删除的行
+        self._original_rows = np.empty(0, dtype=np.int64)  # 每行向量在 _originals 中的行号
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None   # 容量 >= self._size 的连续矩阵（或编码矩阵）
+        self._groups = np.empty(0, dtype=np.int32)  # 每行所属分组的编号
+        self._group2code: Dict[str, int] = {}
+        self._size = 0
+        self._ids: List[str] = []
+        self._docs: List[Document] = []
+        self._id2row: Dict[str, int] = {}
+
+    def __len__(self):
+        return self._size
+
+    def add(self, ids: Sequence[str], embeddings, docs: Sequence[Document]):
+        """追加向量，已存在的id会先被删除（upsert语义）"""
+        if len(ids) == 0:
+            return
+        vectors = l2_normalize(embeddings)
+        train_args = None
+        with self._lock:
+            stale = [i for i in ids if i in self._id2row]
+            if stale:
+                self._remove_rows([self._id2row[i] for i in stale])
+
+            n = self._size
+            if self.quantizer is not None:
+                self._reservoir_add(vectors)
+                original_rows = self._append_originals(vectors)
+                self._original_rows = np.concatenate([self._original_rows[:n], original_rows])
+                if self._training:
+                    self._dirty.update(ids)
+                if self._trained_size:
+                    vectors = self.quantizer.encode(vectors)
+
+            if self._vectors is None or self._vectors.shape[0] < n + len(vectors):
+                capacity = max(1024, 2 * (n + len(vectors)))
+                grown = np.empty((capacity, vectors.shape[1]), dtype=vectors.dtype)
+                if n > 0:
+                    grown[:n] = self._vectors[:n]
+                self._vectors = grown
+            self._vectors[n: n + len(vectors)] = vectors
+            groups = [self._group2code.setdefault(doc.metadata.get(self.group_key),
+                                                  len(self._group2code))
+                      for doc in docs]
+            self._groups = np.concatenate([self._groups[:n], np.asarray(groups, dtype=np.int32)])
+
+            for offset, (doc_id, doc) in enumerate(zip(ids, docs)):
+                self._id2row[doc_id] = n + offset
+                self._ids.append(doc_id)
+                self._docs.append(doc)
+            self._size = n + len(vectors)
+
+            if self.quantizer is not None and not self._training and self._size >= self.train_size and \
+                    self._size >= self.retrain_factor * self._trained_size:
+                self._training, self._dirty = True, set()
+                train_args = (self._sample[:min(self._seen, self.train_size)].copy(), self._originals,
+                              self._original_rows[:self._size].copy(), list(self._ids), self._generation)
+        if train_args is not None:
+            self._train(*train_args)
+
+    def _reservoir_add(self, vectors: np.ndarray):
+        """蓄水池采样: 样本始终是已写入向量的均匀采样, 最多 train_size 条"""
+        if self._sample is None:
+            self._sample = np.empty((self.train_size, vectors.shape[1]), dtype=np.float32)
+        fill = min(max(self.train_size - self._seen, 0), len(vectors))
+        self._sample[self._seen: self._seen + fill] = vectors[:fill]
+        if fill < len(vectors):
+            positions = np.arange(self._seen + fill, self._seen + len(vectors))
+            slots = self._rng.integers(0, positions + 1)
+            replace = slots < self.train_size
+            self._sample[slots[replace]] = vectors[fill:][replace]
+        self._seen += len(vectors)
+
+    def _append_originals(self, vectors: np.ndarray) -> np.ndarray:
+        """把全精度向量追加写入磁盘文件，返回写入的行号
+
+        容量不足时新建一个两倍大小的文件，只拷贝仍在使用的行，已删除的行随之回收；
+        旧文件的映射由正在检索或训练的线程持有，不再被修改
+        """
+        if self._originals is None or self._original_size + len(vectors) > len(self._originals):
+            live = self._original_rows[:self._size]
+            capacity = max(1024, 2 * (len(live) + len(vectors)))
+            grown = np.memmap(tempfile.TemporaryFile(dir=self.original_dir), dtype=np.float32,
+                              mode="w+", shape=(capacity, vectors.shape[1]))
+            for start in range(0, len(live), self.block_size):
+                rows = live[start: start + self.block_size]
+                grown[start: start + len(rows)] = self._originals[rows]
+            self._originals, self._original_size = grown, len(live)
+            self._original_rows = np.arange(len(live), dtype=np.int64)
+        rows = np.arange(self._original_size, self._original_size + len(vectors), dtype=np.int64)
+        self._originals[rows[0]: rows[-1] + 1] = vectors
+        self._original_size += len(vectors)
+        return rows
+
+    def _encode_originals(self, quantizer, originals: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        codes = [quantizer.encode(np.asarray(originals[rows[start: start + self.block_size]]))
+                 for start in range(0, len(rows), self.block_size)]
+        return np.concatenate(codes) if codes else np.empty((0, 0), dtype=np.uint8)
+
+    def _train(self, sample: np.ndarray, originals: np.ndarray, original_rows: np.ndarray,
+               ids: List[str], generation: int):
+        """在锁外训练新的量化器并编码训练开始时的全部向量，最后在锁内替换
+
+        训练期间写入的向量(_dirty)和新增的行用新量化器补编码，期间删除的行直接跳过；
+        替换前正在检索的线程仍使用旧的量化器和矩阵
+        """
+        try:
+            quantizer = copy.deepcopy(self.quantizer)
+            quantizer.reset()
+            quantizer.train(sample)
+            codes = self._encode_originals(quantizer, originals, original_rows)
+            rescore_factor = self._calibrate(quantizer, codes, originals, original_rows)
+            with self._lock:
+                if generation != self._generation:
+                    return
+                position = {doc_id: i for i, doc_id in enumerate(ids)}
+                src = np.asarray([-1 if doc_id in self._dirty else position.get(doc_id, -1)
+                                  for doc_id in self._ids], dtype=np.int64)
+                found = src >= 0
+                new_codes = np.empty((self._vectors.shape[0], codes.shape[1]), dtype=np.uint8)
+                new_codes[:self._size][found] = codes[src[found]]
+                missing = np.flatnonzero(~found)
+                if len(missing):
+                    new_codes[missing] = self._encode_originals(quantizer, self._originals,
+                                                                self._original_rows[missing])
+                self._vectors = new_codes
+                self.quantizer = quantizer
+                self.rescore_factor = rescore_factor
+                self._trained_size = self._size
+        finally:
+            with self._lock:
+                self._training, self._dirty = False, set()
+
+    def _calibrate(self, quantizer, codes: np.ndarray, originals: np.ndarray, original_rows: np.ndarray) -> int:
+        """估计召回率达到 recall_target 所需的最小候选倍数
+
+        随机取已写入的向量作为query，在全量数据上统计精确top-k近邻在量化打分中的名次。
+        近邻的名次随数据规模增长，因此不能只在训练样本上估计；query数远小于码本大小，
+        耗时低于重新编码
+        """
+        n = len(codes)
+        k = min(CALIBRATION_TOP_K, n - 1)
+        if k <= 0:
+            return 1
+        picked = self._rng.choice(n, min(CALIBRATION_QUERIES, n), replace=False)
+        queries = np.asarray(originals[original_rows[picked]])
+        query_index = np.arange(len(picked))
+
+        def blocks():
+            for start in range(0, n, self.block_size):
+                end = min(start + self.block_size, n)
+                # query自身不算近邻
+                own = (picked >= start) & (picked < end)
+                yield start, end, (query_index[own], picked[own] - start)
+
+        # 第一遍: 精确top-k
+        truth_scores = np.full((len(picked), 0), -np.inf, dtype=np.float32)
+        truth_rows = np.empty((len(picked), 0), dtype=np.int64)
+        for start, end, own in blocks():
+            scores = queries @ np.asarray(originals[original_rows[start:end]]).T
+            scores[own] = -np.inf
+            truth_scores = np.concatenate([truth_scores, scores], axis=1)
+            truth_rows = np.concatenate([truth_rows, np.broadcast_to(np.arange(start, end), scores.shape)], axis=1)
+            part = np.argpartition(-truth_scores, k - 1, axis=1)[:, :k]
+            truth_scores = np.take_along_axis(truth_scores, part, axis=1)
+            truth_rows = np.take_along_axis(truth_rows, part, axis=1)
+
+        # 第二遍: 每个近邻的量化分数排在第几
+        approx_truth = np.stack([quantizer.score(queries[[q]], codes[truth_rows[q]])[0]
+                                 for q in range(len(picked))])
+        ranks = np.zeros(approx_truth.shape, dtype=np.int64)
+        for start, end, own in blocks():
+            scores = quantizer.score(queries, codes[start:end])
+            scores[own] = -np.inf
+            ranks += (scores[:, None, :] > approx_truth[:, :, None]).sum(axis=2)
+
+        for factor in range(1, MAX_RESCORE_FACTOR + 1):
+            if (ranks < k * factor).mean() >= self.recall_target:
+                return factor
+        return MAX_RESCORE_FACTOR
+
+    def _scaled_rescore_factor(self) -> int:
+        """上次训练后新增的向量会挤占近邻在量化打分中的名次, 候选倍数按向量数的增长比例放大"""
+        if not self._trained_size:
+            return self.rescore_factor
+        growth = max(self._size / self._trained_size, 1.0)
+        return min(int(np.ceil(self.rescore_factor * growth)), MAX_RESCORE_FACTOR)
+
+    def delete(self, ids: Sequence[str]) -> int:
+        """删除指定id的向量，返回实际删除的条数"""
+        with self._lock:
+            rows = [self._id2row[i] for i in ids if i in self._id2row]
+            if rows:
+                self._remove_rows(rows)
+            return len(rows)
+
+    def _remove_rows(self, rows: List[int]):
+        keep = np.ones(self._size, dtype=bool)
+        keep[rows] = False
+        # 生成新矩阵而不是原地压缩，正在检索的线程仍持有旧矩阵的视图
+        self._vectors = np.ascontiguousarray(self._vectors[:self._size][keep])
+        self._groups = self._groups[:self._size][keep]
+        if self.quantizer is not None:
+            # 磁盘上的行只在文件扩容时回收
+            self._original_rows = self._original_rows[:self._size][keep]
+        self._ids = [doc_id for doc_id, k in zip(self._ids, keep) if k]
+        self._docs = [doc for doc, k in zip(self._docs, keep) if k]
+        self._id2row = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        self._size = len(self._ids)
+
+    def clear(self):
+        with self._lock:
+            self._vectors = None
+            self._groups = np.empty(0, dtype=np.int32)
+            self._group2code = {}
+            if self.quantizer is not None:
+                self.quantizer.reset()
+            self._sample, self._seen, self._trained_size = None, 0, 0
+            self._originals, self._original_size = None, 0
+            self._original_rows = np.empty(0, dtype=np.int64)
+            self.rescore_factor = 1
+            self._generation += 1
+            self._size = 0
+            self._ids, self._docs, self._id2row = [], [], {}
+
+    def _group_mask(self, groups: Sequence[str], groups_array: np.ndarray) -> np.ndarray:
+        codes = [self._group2code[g] for g in groups if g in self._group2code]
+        return np.isin(groups_array, codes)
+
+    def ids_in_groups(self, groups: Sequence[str]) -> List[str]:
+        """查找属于指定分组的id，例如 ids_in_groups([md5(filename)])"""
+        with self._lock:
+            rows = np.flatnonzero(self._group_mask(groups, self._groups[:self._size]))
+            return [self._ids[row] for row in rows.tolist()]
+
+    def get(self, ids: Sequence[str]) -> Dict[str, Document]:
+        with self._lock:
+            return {i: self._docs[self._id2row[i]] for i in ids if i in self._id2row}
+
+    def search(
+        self,
+        query_embeddings,
+        top_k: int,
+        rescore: bool = True,
+        rescore_factor: Optional[int] = None,
+        groups: Optional[Sequence[str]] = None,
+        ids: Optional[Sequence[str]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """批量检索
+
+        Args:
+            query_embeddings: 形如 (num_queries, dim) 的query向量
+            top_k: 每个query返回的最大结果数
+            rescore: 启用量化时是否先召回 top_k * rescore_factor 个候选，再用磁盘上的全精度向量重新计算相似度；
+                为False时直接返回量化后的近似分数
+            rescore_factor: 候选集相对top_k的放大倍数，为None时使用按 recall_target 估计的 self.rescore_factor，
+                并按上次训练后向量数的增长比例放大
+            groups: 只在这些分组（例如文件的source）内检索，为None时检索全部
+            ids: 与groups同时指定时，这些id的向量也参与检索（取并集）
+
+        Returns:
+            List[List[Tuple[Document, float]]]: 每个query按相似度降序排列的 (文档, 余弦相似度)
+        """
+        queries = l2_normalize(query_embeddings)
+        with self._lock:
+            n, vectors, docs = self._size, self._vectors, self._docs
+            quantizer = self.quantizer if self._trained_size else None
+            originals, original_rows = self._originals, self._original_rows
+            factor = rescore_factor or self._scaled_rescore_factor()
+            mask = self._group_mask(groups, self._groups[:n]) if groups is not None else None
+            if mask is not None and ids:
+                mask[[self._id2row[i] for i in ids if i in self._id2row]] = True
+        if n == 0 or top_k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        rescore = rescore and quantizer is not None
+        k = min(top_k * factor if rescore else top_k, n)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, n, self.block_size):
+            block = vectors[start: min(start + self.block_size, n)]
+            scores = queries @ block.T if quantizer is None else quantizer.score(queries, block)
+            if mask is not None:
+                scores[:, ~mask[start: start + len(block)]] = -np.inf
+            rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            if scores.shape[1] > k:
+                part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, part, axis=1)
+                rows = np.take_along_axis(rows, part, axis=1)
+            # 与之前各块的top-k归并
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            if best_scores.shape[1] > k:
+                part = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, part, axis=1)
+                best_rows = np.take_along_axis(best_rows, part, axis=1)
+
+        if rescore:
+            best_scores = self._rescore(queries, best_rows, best_scores, originals, original_rows)
+            k = min(top_k, k)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")[:, :k]
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [
+            [(docs[row], float(score)) for row, score in zip(q_rows, q_scores)
+             if score != -np.inf]
+            for q_rows, q_scores in zip(best_rows.tolist(), best_scores.tolist())
+        ]
+
+    @staticmethod
+    def _rescore(queries, rows, approx_scores, originals, original_rows) -> np.ndarray:
+        """从磁盘读取候选的全精度向量重新计算相似度
+
+        近似分数为-inf的候选（被分组过滤掉或候选数不足时的占位）保持-inf，不参与重算
+        """
+        scores = np.full(rows.shape, -np.inf, dtype=np.float32)
+        valid = np.isfinite(approx_scores)
+        if not valid.any():
+            return scores
+        # 多个query共享的候选只读取一次
+        unique_rows, inverse = np.unique(rows[valid], return_inverse=True)
+        full_vectors = np.asarray(originals[original_rows[unique_rows]])
+        full_scores = full_vectors @ queries.T
+        scores[valid] = full_scores[inverse, np.nonzero(valid)[0]]
+        return scores
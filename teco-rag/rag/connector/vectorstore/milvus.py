@@ -28,19 +28,28 @@
 from __future__ import annotations
 
 import hashlib
-import operator
+import json
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
+import numpy as np
 from langchain.docstore.document import Document
 from langchain_community.vectorstores import Milvus
 from langchain_core.embeddings import Embeddings
-from pymilvus import MilvusClient
+from pymilvus import Collection, CollectionSchema, DataType, FieldSchema, MilvusClient
 
 from rag.common.configuration import settings
 from rag.common.utils import logger
 from rag.connector.database.utils import KnowledgeFile
 from rag.connector.vectorstore.base import VectorStoreBase
+from rag.connector.vectorstore.flat_index import FlatIndex, l2_normalize
+from rag.connector.vectorstore.quantization import get_quantizer
+
+
+# 以文件名md5作为partition key的标量字段, 按文件检索/删除时只扫描相关分区
+SOURCE_FIELD = "source"
 
 
 def md5_encryption(data):
@@ -59,6 +68,14 @@ class MilvusVectorStore(VectorStoreBase):
         self.collection_name = collection_name
         self.config = settings.vector_store
         self.milvus = None
+        # 小知识库在进程内保留一份向量镜像, 检索时直接本地精确计算, 不走网络
+        self.local_index_config = self.config.kwargs.get("local_index", {})
+        self.local_index = None
+        # Milvus压缩索引(IVF_PQ/IVF_SQ8)召回 top_k * factor 个候选后用全精度向量重新打分
+        self.rescore_config = self.config.kwargs.get("rescore", {})
+        self.partition_key_config = self.config.kwargs.get("partition_key", {})
+        # 写入按行数和字节数分批, 避免单次请求超过gRPC消息大小限制
+        self.insert_config = self.config.kwargs.get("insert", {})
 
         self._load_milvus()
 
@@ -83,21 +100,95 @@ class MilvusVectorStore(VectorStoreBase):
         self.pyclient = MilvusClient(
             uri="http://"+self.config.host+":"+self.config.port
         )
+        self._load_local_index()
+
+    def _load_local_index(self):
+        """从Milvus全量拉取向量构建进程内镜像, 超过 max_entities 时不启用"""
+        self.local_index = None
+        if not self.local_index_config.get("enable", False):
+            return
+        max_entities = self.local_index_config.get("max_entities", 200000)
+        quantizer = get_quantizer(self.local_index_config.get("quantization"))
+        # 量化器在向量数达到 train_size 后训练, 之前保存原始向量
+        local_index = FlatIndex(block_size=self.local_index_config.get("block_size", 65536),
+                                quantizer=quantizer,
+                                train_size=self.local_index_config.get("train_size", 20000),
+                                recall_target=self.local_index_config.get("recall_target", 0.95),
+                                original_dir=self.local_index_config.get("original_dir"))
+        if isinstance(self.milvus.col, Collection):
+            if self.milvus.col.num_entities > max_entities:
+                logger.warning(f"{self.collection_name} 向量数量超过 {max_entities}, 不启用本地检索")
+                return
+            iterator = self.milvus.col.query_iterator(
+                batch_size=self.local_index_config.get("load_batch_size", 1000),
+                expr="",
+                output_fields=[self.milvus._primary_field, self.milvus._text_field,
+                               self.milvus._vector_field, self.milvus._metadata_field])
+            try:
+                while rows := iterator.next():
+                    self._add_rows_to_local_index(local_index, rows)
+            finally:
+                iterator.close()
+        self.local_index = local_index
+        logger.info(f"{self.collection_name} 本地检索已启用, 共 {len(local_index)} 条向量")
+
+    def _add_rows_to_local_index(self, local_index: FlatIndex, rows):
+        if not rows:
+            return
+        local_index.add(ids=[row[self.milvus._primary_field] for row in rows],
+                        embeddings=[row[self.milvus._vector_field] for row in rows],
+                        docs=[Document(page_content=row[self.milvus._text_field],
+                                       metadata=row[self.milvus._metadata_field])
+                              for row in rows])
 
     def create_vectorstore(self):
         """ 注意langchain.milvus 初始化时不会真正创建Collection
         """
-        init_kwargs = {"embeddings": self.embeddings.embed_documents(["初始化"]),
-                       "metadatas": [{}],
-                       "partition_names": None,
-                       "replica_number": 1,
-                       "timeout": None}
-        self.milvus._init(**init_kwargs)
+        self._init_collection(embeddings=self.embeddings.embed_documents(["初始化"]),
+                              metadatas=[{}])
+
+    def _init_collection(self, embeddings, metadatas):
+        """创建Collection, 开启partition_key时额外创建source标量字段作为partition key"""
+        if not self.partition_key_config.get("enable", False):
+            self.milvus._init(embeddings=embeddings, metadatas=metadatas)
+            return
+        if not isinstance(self.milvus.col, Collection):
+            fields = [
+                FieldSchema(self.milvus._metadata_field, DataType.JSON),
+                FieldSchema(self.milvus._text_field, DataType.VARCHAR, max_length=65_535),
+                FieldSchema(self.milvus._primary_field, DataType.VARCHAR, is_primary=True,
+                            auto_id=False, max_length=65_535),
+                FieldSchema(self.milvus._vector_field, DataType.FLOAT_VECTOR,
+                            dim=len(embeddings[0])),
+                FieldSchema(SOURCE_FIELD, DataType.VARCHAR, max_length=64,
+                            is_partition_key=True),
+            ]
+            self.milvus.col = Collection(
+                name=self.collection_name,
+                schema=CollectionSchema(fields),
+                consistency_level=self.milvus.consistency_level,
+                using=self.milvus.alias,
+                num_partitions=self.partition_key_config.get("num_partitions", 64))
+        self.milvus._init()
+
+    @property
+    def _has_partition_key(self):
+        return SOURCE_FIELD in self.milvus.fields
+
+    def _file_filter(self, filenames):
+        """按文件过滤的表达式, 有partition key时milvus会据此裁剪分区"""
+        sources = [md5_encryption(filename) for filename in filenames]
+        field = SOURCE_FIELD if self._has_partition_key else f'{self.milvus._metadata_field}["source"]'
+        if len(sources) == 1:
+            return f'{field} == "{sources[0]}"'
+        return f'{field} in {sources}'
 
     def drop_vectorstore(self):
         if self.pyclient.has_collection(self.collection_name):
             self.pyclient.release_collection(self.collection_name)
             self.pyclient.drop_collection(self.collection_name)
+        if self.local_index is not None:
+            self.local_index.clear()
 
     def clear_vectorstore(self):
         if self.pyclient.has_collection(self.collection_name):
@@ -112,14 +203,19 @@ class MilvusVectorStore(VectorStoreBase):
         :return:
         """
         if self.pyclient.has_collection(self.collection_name):
+            file_filter = self._file_filter([filename])
             delete_list = [item.get("pk") for item in
                            self.pyclient.query(collection_name=self.collection_name,
-                                               filter=f'metadata["source"] == "{md5_encryption(filename)}"',
+                                               filter=file_filter,
                                                output_fields=["pk"])]
 
             if len(delete_list) > 0:
+                # 有partition key时按source删除只会触及该文件所在的分区
+                delete_filter = file_filter if self._has_partition_key else f'pk in {delete_list}'
                 self.pyclient.delete(collection_name=self.collection_name,
-                                     filter=f'pk in {delete_list}')
+                                     filter=delete_filter)
+                if self.local_index is not None:
+                    self.local_index.delete(delete_list)
                 logger.warning(f"成功删除文件 {filename} {str(len(delete_list))} 条记录")
             else:
                 logger.warning(f"vs中不存在文件 {filename} 相关的记录，不需要删除")
@@ -176,14 +272,29 @@ class MilvusVectorStore(VectorStoreBase):
             doc_id = doc.metadata.get("id", str(uuid.uuid4()))
             doc_ids.append(doc_id)
             
-        # 将文档添加到milvus,如果没有指定ID则由milvus自动生成
-        # 如果没有指定文档ID,则由milvus自动生成
         if len(doc_ids) == 0:
-            ids = self.milvus.add_documents(docs)
-        # 否则使用指定的文档ID
-        else:
-            ids = self.milvus.add_documents(docs, ids=doc_ids)
-            
+            return []
+
+        # 双缓冲: 第k批在后台线程写入milvus时, 主线程向量化第k+1批
+        # 每批只向量化一次, 同时用于写入milvus和本地镜像; 本地镜像只在当前线程中更新
+        ids = []
+        try:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                pending = None
+                for start, end in self._split_batches(docs):
+                    batch = docs[start:end]
+                    embeddings = self.embeddings.embed_documents([doc.page_content for doc in batch])
+                    if pending is not None:
+                        ids.extend(self._add_to_local_index(pending))
+                    pending = (pool.submit(self._insert_batch, batch, embeddings, doc_ids[start:end]),
+                               embeddings, batch)
+                if pending is not None:
+                    ids.extend(self._add_to_local_index(pending))
+        except Exception:
+            # 之前的批次已经写入, 删除该文件本次写入的全部记录, 避免文件只入库一部分
+            self._rollback(file.filename, doc_ids)
+            raise
+
         # 组装返回结果
         # 将文档ID和元数据组装成字典列表返回
         doc_infos = []
@@ -196,54 +307,158 @@ class MilvusVectorStore(VectorStoreBase):
             doc_infos.append(doc_info)
 
         return doc_infos
-    
+
+    def _split_batches(self, docs):
+        """按行数(batch_size)和预估字节数(max_batch_bytes)切分写入批次, 返回[start, end)区间"""
+        batch_size = self.insert_config.get("batch_size", 512)
+        max_batch_bytes = self.insert_config.get("max_batch_bytes", 16 * 1024 * 1024)
+        vector_bytes = 4 * (settings.embeddings.dimensions or 1024)
+        start, batch_bytes = 0, 0
+        for i, doc in enumerate(docs):
+            doc_bytes = (len(doc.page_content.encode("utf-8")) + vector_bytes
+                         + len(json.dumps(doc.metadata, ensure_ascii=False).encode("utf-8")))
+            if i > start and (i - start >= batch_size or batch_bytes + doc_bytes > max_batch_bytes):
+                yield start, i
+                start, batch_bytes = i, 0
+            batch_bytes += doc_bytes
+        if start < len(docs):
+            yield start, len(docs)
+
+    def _insert_batch(self, docs, embeddings, doc_ids):
+        """写入一个批次, 失败时按指数退避重试, 返回写入的id"""
+        max_retries = self.insert_config.get("max_retries", 3)
+        backoff = self.insert_config.get("retry_backoff", 1.0)
+        texts = [doc.page_content for doc in docs]
+        metadatas = [doc.metadata for doc in docs]
+        for attempt in range(max_retries + 1):
+            try:
+                # 重试时用upsert, 避免上一次部分写入成功导致的重复数据
+                ids = self._insert(texts, embeddings, metadatas, doc_ids, upsert=attempt > 0)
+                break
+            except Exception as e:
+                if attempt == max_retries:
+                    raise e
+                wait = backoff * 2 ** attempt
+                logger.warning(f"写入 {self.collection_name} 失败({e.__class__.__name__}: {e}), "
+                               f"{wait:.1f}s 后第{attempt + 1}次重试")
+                time.sleep(wait)
+
+        return ids
+
+    def _add_to_local_index(self, pending):
+        """等待一个批次写入完成, 写入成功后同步本地镜像"""
+        future, embeddings, docs = pending
+        ids = future.result()
+        if self.local_index is not None:
+            self.local_index.add(ids, embeddings, docs)
+            if len(self.local_index) > self.local_index_config.get("max_entities", 200000):
+                logger.warning(f"{self.collection_name} 向量数量超过上限, 关闭本地检索")
+                self.local_index = None
+        return ids
+
+    def _rollback(self, filename, doc_ids):
+        """删除写入失败的文件已经写入的记录, 失败的批次可能部分写入, 按本次全部id删除"""
+        batch_size = self.insert_config.get("batch_size", 512)
+        try:
+            for start in range(0, len(doc_ids), batch_size):
+                self.pyclient.delete(collection_name=self.collection_name,
+                                     ids=doc_ids[start: start + batch_size])
+            if self.local_index is not None:
+                self.local_index.delete(doc_ids)
+            logger.warning(f"文件 {filename} 写入 {self.collection_name} 失败, 已删除本次写入的记录")
+        except Exception as e:
+            msg = f"文件 {filename} 写入失败后删除已写入的记录失败"
+            logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
+
+    def _insert(self, texts, embeddings, metadatas, ids, upsert=False):
+        """写入已向量化的数据, 等价于 langchain Milvus.add_texts 去掉向量化的部分"""
+        if not isinstance(self.milvus.col, Collection):
+            self._init_collection(embeddings=embeddings, metadatas=metadatas)
+        insert_dict = {
+            self.milvus._text_field: texts,
+            self.milvus._vector_field: embeddings,
+            self.milvus._primary_field: ids,
+            self.milvus._metadata_field: metadatas,
+            SOURCE_FIELD: [metadata.get("source", "") for metadata in metadatas],
+        }
+        # _init可能被调用多次, fields中会有重复的字段名
+        fields = dict.fromkeys(self.milvus.fields)
+        insert_list = [insert_dict[x] for x in fields if x in insert_dict]
+        if upsert:
+            res = self.milvus.col.upsert(insert_list)
+        else:
+            res = self.milvus.col.insert(insert_list)
+        return res.primary_keys
+
     def search_docs(self, text, top_k, threshold, **kwargs):
         """
         :param text:
         :param top_k:
         :param threshold:
+        :param file_names: 只在这些文件中检索(可选)
+        :param extra_ids: 与file_names一起指定时, 这些chunk也参与检索(可选)
         :return: List[Tuple[Document, float]]: Result doc and score.
         """
+        return self.batch_search_docs([text], top_k, threshold, **kwargs)[0]
 
-        docs = self.milvus.similarity_search_with_score(query=text,
-                                                        k=top_k,
-                                                        **kwargs)
-        if threshold is not None:
-            docs = self._score_threshold_process(docs, threshold, top_k)
+    def batch_search_docs(self, texts, top_k, threshold, file_names=None, extra_ids=None, **kwargs):
+        """批量检索, 启用本地镜像且没有milvus专属参数(expr/param等)时一次矩阵乘完成全部query"""
+        if self.local_index is not None and not kwargs:
+            query_embeddings = [self.embeddings.embed_query(text) for text in texts]
+            groups = [md5_encryption(f) for f in file_names] if file_names else None
+            # 本地量化镜像用磁盘上的全精度向量重打分, 候选倍数默认按 recall_target 估计
+            results = self.local_index.search(query_embeddings, top_k,
+                                              rescore_factor=self.local_index_config.get("rescore_factor"),
+                                              groups=groups, ids=extra_ids)
+            return [self._post_process(docs, top_k, threshold) for docs in results]
 
-        # 兼容multi_vector，召回父文档
-        parent_doc_map = {}         # retrieval_index: parent_id
-        for i, tp in enumerate(docs):
-            parent_id = tp[0].metadata.get("parent_id")
-            if parent_id is not None: parent_doc_map[i] = parent_id
+        if file_names:
+            file_filter = self._file_filter(file_names)
+            if extra_ids:
+                file_filter = f'({file_filter} or {self.milvus._primary_field} in {list(extra_ids)})'
+            kwargs["expr"] = f'({kwargs["expr"]}) and {file_filter}' if kwargs.get("expr") \
+                else file_filter
+        if self.rescore_config.get("enable", False):
+            factor = self.rescore_config.get("factor", 4)
+            results = [self._rescore_search(text, top_k, factor, **kwargs) for text in texts]
+        else:
+            results = [self.milvus.similarity_search_with_score(query=text, k=top_k, **kwargs)
+                       for text in texts]
+        return [self._post_process(docs, top_k, threshold) for docs in results]
 
-        if len(parent_doc_map) > 0:
-            try:
-                ids = list(set(parent_doc_map.values()))
-                parent_docs = {}        # parent_id: parent_doc
-                for p_doc in self.pyclient.get(collection_name=self.collection_name,
-                                               ids=ids,
-                                               output_fields=["pk", "text", "metadata"]):
-                    parent_docs[p_doc["pk"]] = Document(page_content=p_doc["text"],
-                                                        metadata=p_doc["metadata"])
-                for doc_index in parent_doc_map:
-                    docs[doc_index] = tuple([parent_docs[parent_doc_map[doc_index]], docs[doc_index][1]])
+    def _rescore_search(self, text, top_k, factor, param=None, expr=None, **kwargs):
+        """在压缩索引上召回 top_k * factor 个候选(连同原始向量), 按全精度余弦相似度重新排序"""
+        if self.milvus.col is None:
+            return []
+        embedding = self.embeddings.embed_query(text)
+        res = self.milvus.col.search(data=[embedding],
+                                     anns_field=self.milvus._vector_field,
+                                     param=param or self.milvus.search_params,
+                                     limit=top_k * factor,
+                                     expr=expr,
+                                     output_fields=[self.milvus._text_field,
+                                                    self.milvus._metadata_field,
+                                                    self.milvus._vector_field],
+                                     **kwargs)
+        hits = list(res[0])
+        if not hits:
+            return []
+        vectors = l2_normalize([hit.entity.get(self.milvus._vector_field) for hit in hits])
+        scores = vectors @ l2_normalize(embedding)[0]
+        return [(Document(page_content=hits[i].entity.get(self.milvus._text_field),
+                          metadata=hits[i].entity.get(self.milvus._metadata_field)),
+                 float(scores[i]))
+                for i in np.argsort(-scores, kind="stable")[:top_k]]
 
-            except Exception as e:
-                msg = f"路由到parent chunk失败：{e}"
-                logger.error(f'{e.__class__.__name__}: {msg}', exc_info=e)
-
-        return docs
-
-    def _score_threshold_process(self, docs, score_threshold, k):
-        if score_threshold is not None:
-            cmp = (
-                operator.ge
-            )
-            docs = [
-                (doc, similarity)
-                for doc, similarity in docs
-                if cmp(similarity, score_threshold)
-            ]
-        return docs[:k]
+    def _get_parent_docs(self, ids):
+        """优先从本地镜像中取父文档, 取不到的再查询milvus"""
+        parent_docs = self.local_index.get(ids) if self.local_index is not None else {}
+        missing_ids = [i for i in ids if i not in parent_docs]
+        if missing_ids:
+            for p_doc in self.pyclient.get(collection_name=self.collection_name,
+                                           ids=missing_ids,
+                                           output_fields=["pk", "text", "metadata"]):
+                parent_docs[p_doc["pk"]] = Document(page_content=p_doc["text"],
+                                                    metadata=p_doc["metadata"])
+        return parent_docs
 
@@ -0,0 +1,161 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+"""向量压缩（量化）实现，用于降低本地向量镜像的内存占用
+
+压缩后的打分只用于粗排召回候选，最终分数由全精度向量重新计算（见 FlatIndex.search 的 rescore）。
+"""
+
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class ScalarQuantizer:
+    """SQ8：每个维度按训练数据的取值范围线性量化到 uint8，内存为float32的1/4"""
+
+    # 取值范围由少量样本估计会偏窄, 训练样本至少需要这么多条
+    min_train_size = 256
+
+    def __init__(self):
+        self.vmin: Optional[np.ndarray] = None
+        self.scale: Optional[np.ndarray] = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self.vmin is not None
+
+    def reset(self):
+        self.vmin, self.scale = None, None
+
+    def train(self, vectors: np.ndarray):
+        self.vmin = vectors.min(axis=0)
+        self.scale = (vectors.max(axis=0) - self.vmin) / 255.0
+        self.scale[self.scale == 0] = 1.0
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((vectors - self.vmin) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale + self.vmin
+
+    def score(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # q·(c*scale + vmin) = (q*scale)·c + q·vmin，无需还原整块向量
+        return (queries * self.scale) @ codes.T.astype(np.float32) + (queries @ self.vmin)[:, None]
+
+
+class ProductQuantizer:
+    """PQ：向量切成m段，每段用k-means码本（最多256个中心）编码为1个字节
+
+    Attributes:
+        m: 子空间个数，需能整除向量维度，每条向量压缩为m个字节
+        n_iter: k-means迭代次数
+    """
+
+    def __init__(self, m: int = 64, n_iter: int = 20, seed: int = 0):
+        self.m = m
+        self.n_iter = n_iter
+        self.seed = seed
+        self.codebooks: Optional[np.ndarray] = None     # (m, n_centroids, sub_dim)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.codebooks is not None
+
+    @property
+    def min_train_size(self) -> int:
+        """每个子空间训练256个中心, 样本数至少为 256 * m"""
+        return 256 * self.m
+
+    def reset(self):
+        self.codebooks = None
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        n, dim = vectors.shape
+        if dim % self.m != 0:
+            raise ValueError(f"PQ子空间个数 m={self.m} 无法整除向量维度 {dim}")
+        return vectors.reshape(n, self.m, dim // self.m)
+
+    def train(self, vectors: np.ndarray):
+        rng = np.random.default_rng(self.seed)
+        sub_vectors = self._split(vectors)
+        n_centroids = min(256, len(vectors))
+        codebooks = []
+        for j in range(self.m):
+            x = sub_vectors[:, j, :]
+            centroids = x[rng.choice(len(x), n_centroids, replace=False)].copy()
+            for _ in range(self.n_iter):
+                assign = self._nearest(x, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assign, x)
+                counts = np.bincount(assign, minlength=n_centroids)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+            codebooks.append(centroids)
+        self.codebooks = np.stack(codebooks).astype(np.float32)
+
+    @staticmethod
+    def _nearest(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        dists = (x ** 2).sum(axis=1, keepdims=True) - 2 * x @ centroids.T \
+            + (centroids ** 2).sum(axis=1)[None, :]
+        return dists.argmin(axis=1)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        sub_vectors = self._split(vectors)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = self._nearest(sub_vectors[:, j, :], self.codebooks[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        parts = [self.codebooks[j][codes[:, j]] for j in range(self.m)]
+        return np.concatenate(parts, axis=1)
+
+    def score(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # 非对称距离计算(ADC)：先算query每段与码本中心的内积表，再按编码查表累加
+        lut = np.einsum("qjd,jcd->qjc", self._split(queries), self.codebooks)
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j in range(self.m):
+            scores += lut[:, j, :][:, codes[:, j]]
+        return scores
+
+
+def get_quantizer(config: Dict):
+    """根据配置创建量化器，config为空或type为空时不压缩
+
+    Args:
+        config: 例如 {"type": "sq8"} 或 {"type": "pq", "m": 64}
+    """
+    quantizer_type = (config or {}).get("type")
+    if not quantizer_type:
+        return None
+    if quantizer_type.lower() == "sq8":
+        return ScalarQuantizer()
+    elif quantizer_type.lower() == "pq":
+        return ProductQuantizer(m=config.get("m", 64), n_iter=config.get("n_iter", 20))
+    raise ValueError(f"{quantizer_type} quantizer is not supported")
@@ -0,0 +1,184 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+语义答案缓存
+
+将历史问题的向量、答案以及答案引用的文件缓存在知识库维度的内存索引中，新问题与历史问题的相似度
+超过阈值且检索参数相同时直接返回缓存的答案，跳过检索和大模型生成。文件重新入库或被删除时，引用该文件的缓存失效。
+
+检索和生成期间文件可能被重新入库，调用方在检索前通过 version() 取得版本号并在写入时传入，
+期间被失效过的文件对应的答案不会写入缓存。
+"""
+
+import threading
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from langchain_core.documents import Document
+
+from rag.common.configuration import settings
+from rag.connector.vectorstore.flat_index import FlatIndex
+
+# 查找时取最相似的若干条历史问题, 依次匹配检索参数
+LOOKUP_CANDIDATES = 8
+
+
+class AnswerCache:
+    """单个知识库的语义答案缓存, 线程安全
+
+    Args:
+        threshold (float): 命中缓存的最低余弦相似度
+        max_entries (int): 缓存条数上限, 超过后淘汰最早写入的记录
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._index = FlatIndex()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()  # entry_id: entry
+        self._file2entries: Dict[str, set] = {}  # filename: {entry_id}
+        self._version = 0  # 每次失效时递增
+        self._invalidated_at: Dict[str, int] = {}  # filename: 最近一次失效时的版本号
+        self._cleared_at = 0  # 最近一次清空时的版本号
+
+    def __len__(self):
+        return len(self._entries)
+
+    def version(self) -> int:
+        """当前版本号, 在检索前获取并传给 add"""
+        with self._lock:
+            return self._version
+
+    def lookup(self, query_embedding: List[float], params: Optional[dict] = None) -> Optional[dict]:
+        """返回超过阈值且检索参数相同的最相似缓存记录: {"query", "answer", "docs"}, 未命中返回None
+
+        Args:
+            query_embedding: 问题的向量
+            params: 影响检索结果的请求参数(top_k、相似度阈值、文件范围等), 只命中参数完全相同的记录
+        """
+        if len(self._index) == 0:
+            return None
+        hits = self._index.search([query_embedding], top_k=LOOKUP_CANDIDATES)[0]
+        with self._lock:
+            for doc, score in hits:
+                if score < self.threshold:
+                    break
+                entry = self._entries.get(doc.metadata["id"])
+                if entry is not None and entry["params"] == (params or {}):
+                    return entry
+        return None
+
+    def add(self, query: str, query_embedding: List[float], answer: str, docs: Sequence[Document],
+            params: Optional[dict] = None, version: Optional[int] = None) -> bool:
+        """写入一条缓存, docs为生成答案时使用的文档, 用于失效判断和返回检索结果
+
+        Args:
+            params: 与 lookup 相同的检索参数
+            version: 检索前通过 version() 取得的版本号, 之后缓存被清空或docs中的文件被失效过时不写入
+
+        Returns:
+            bool: 是否写入
+        """
+        entry_id = str(uuid.uuid4())
+        filenames = {doc.metadata.get("filename") for doc in docs} - {None}
+        with self._lock:
+            if version is not None and (self._cleared_at > version or any(
+                    self._invalidated_at.get(filename, 0) > version for filename in filenames)):
+                return False
+            self._entries[entry_id] = {"query": query, "answer": answer, "docs": list(docs),
+                                       "filenames": filenames, "params": params or {}}
+            for filename in filenames:
+                self._file2entries.setdefault(filename, set()).add(entry_id)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._pop(next(iter(self._entries))))
+        self._index.add([entry_id], [query_embedding],
+                        [Document(page_content=query, metadata={"id": entry_id})])
+        self._index.delete(evicted)
+        return True
+
+    def invalidate(self, filenames: Sequence[str]) -> int:
+        """删除引用了指定文件的缓存, 返回删除的条数"""
+        with self._lock:
+            self._version += 1
+            entry_ids = set()
+            for filename in filenames:
+                self._invalidated_at[filename] = self._version
+                entry_ids |= self._file2entries.get(filename, set())
+            for entry_id in entry_ids:
+                self._pop(entry_id)
+        self._index.delete(list(entry_ids))
+        return len(entry_ids)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._cleared_at = self._version
+            self._invalidated_at.clear()
+            self._entries.clear()
+            self._file2entries.clear()
+        self._index.clear()
+
+    def _pop(self, entry_id: str) -> str:
+        entry = self._entries.pop(entry_id)
+        for filename in entry["filenames"]:
+            ids = self._file2entries.get(filename)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._file2entries[filename]
+        return entry_id
+
+
+def stream_answer(answer: str, chunk_size: int) -> Iterator[str]:
+    """按chunk_size个字符分段输出缓存的答案, 与GenerateChain.generate一致, 每次输出截至当前的完整内容"""
+    chunk_size = max(1, chunk_size)
+    for end in range(chunk_size, len(answer) + chunk_size, chunk_size):
+        yield answer[:end]
+
+
+@lru_cache
+def get_answer_cache(knowledge_base_name: str) -> Optional[AnswerCache]:
+    """每个知识库一个缓存实例, 未开启时返回None"""
+    if not settings.answer_cache.enable:
+        return None
+    return AnswerCache(threshold=settings.answer_cache.threshold,
+                       max_entries=settings.answer_cache.max_entries)
+
+
+def invalidate_answer_cache(knowledge_base_name: str, filenames: Optional[Sequence[str]] = None):
+    """文件重新入库/删除时使缓存失效, filenames为None时清空整个知识库的缓存"""
+    cache = get_answer_cache(knowledge_base_name)
+    if cache is None:
+        return
+    if filenames is None:
+        cache.clear()
+    else:
+        cache.invalidate(filenames)
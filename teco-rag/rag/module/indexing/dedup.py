@@ -0,0 +1,358 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+入库时的近似重复chunk去除
+
+为每个chunk计算字符n-gram的MinHash签名, 按LSH分段(band)分桶后保存在知识库目录下的 minhash.db (sqlite)。
+新chunk只与落入同一个桶的已入库chunk比较签名, 估计Jaccard相似度达到阈值的chunk不再向量化入库,
+只记录其指向的保留(canonical)chunk, 限定文件检索时该文件指向的保留chunk一并参与检索。签名在切分时暂存, 文件成功写入向量库后才写入索引, 处理失败时丢弃;
+文件重新入库时替换该文件原有的签名, 指向这些chunk的其他文件需要重新入库。
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from rag.common.configuration import settings
+from rag.common.utils import logger
+from rag.connector.database.utils import get_kb_path
+
+MINHASH_DB_NAME = "minhash.db"
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+class MinHasher:
+    """字符n-gram的MinHash签名
+
+    Args:
+        num_perm (int): 签名长度(哈希函数个数)
+        ngram_size (int): n-gram长度, 计算前去掉全部空白字符
+        seed (int): 生成哈希函数的随机种子, 同一知识库的签名必须使用相同的参数
+    """
+
+    def __init__(self, num_perm: int = 128, ngram_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.ngram_size = ngram_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """返回uint32签名, 去掉空白后为空的文本返回None"""
+        text = _WHITESPACE_PATTERN.sub("", text)
+        if not text:
+            return None
+        n = self.ngram_size
+        shingles = {text[i: i + n] for i in range(max(1, len(text) - n + 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64,
+                             count=len(shingles))
+        # (a * h + b) mod p: a < 2^31, h < 2^32, 乘积不会溢出uint64
+        return ((np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+
+def lsh_bands(num_perm: int, threshold: float, recall: float = 0.99) -> Tuple[int, int]:
+    """选择LSH的 (band数, 每个band的行数)
+
+    相似度为threshold的两个chunk至少以recall的概率落入同一个桶, 满足条件时每个band的行数取最大, 候选最少。
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            best = (bands, rows)
+    return best
+
+
+class _PendingFile:
+    """一个文件切分后、入库前暂存的去重结果"""
+
+    def __init__(self):
+        self.signatures: Dict[str, Tuple[str, np.ndarray]] = {}  # 保留chunk的id: (文本, 签名)
+        self.canonical_ids: Set[str] = set()  # 重复chunk指向的其他文件的chunk
+
+
+class ChunkIndex:
+    """单个知识库的MinHash/LSH索引, 持久化在sqlite中, 线程安全
+
+    Args:
+        path (str): sqlite文件路径
+        threshold (float): 判定为近似重复的最低估计Jaccard相似度
+        num_perm (int): MinHash签名长度
+        ngram_size (int): 字符n-gram长度
+    """
+
+    def __init__(self, path: str, threshold: float = 0.9, num_perm: int = 128, ngram_size: int = 5):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm, ngram_size=ngram_size)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self._lock = threading.Lock()
+        self._orphaned_files: Set[str] = set()
+        self._pending: Dict[str, _PendingFile] = {}  # filename: 尚未入库的签名
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS signature ("
+            "chunk_id TEXT PRIMARY KEY, filename TEXT NOT NULL, signature BLOB NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_signature_filename ON signature (filename);"
+            "CREATE TABLE IF NOT EXISTS bucket (band INTEGER NOT NULL, key INTEGER NOT NULL, chunk_id TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_bucket_key ON bucket (band, key);"
+            "CREATE INDEX IF NOT EXISTS idx_bucket_chunk ON bucket (chunk_id);"
+            "CREATE TABLE IF NOT EXISTS duplicate (filename TEXT NOT NULL, canonical_id TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_duplicate_filename ON duplicate (filename);"
+            "CREATE INDEX IF NOT EXISTS idx_duplicate_canonical ON duplicate (canonical_id);"
+        )
+        # 签名参数变化后旧签名不可比较, 清空重建
+        params = f"{num_perm},{ngram_size},{self.rows}"
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'params'").fetchone()
+        if row is None or row[0] != params:
+            self._clear()
+            self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('params', ?)", (params,))
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM signature").fetchone()[0]
+
+    def deduplicate(self, filename: str, chunks: List[Document]) -> List[Document]:
+        """返回需要入库的chunk, 不写入索引
+
+        chunk与已入库的其他文件的chunk、或同一文件中更早的chunk近似重复时跳过; 该文件原有的签名会在重新入库后被替换,
+        不参与比较。保留chunk的签名和重复chunk指向的保留chunk暂存在内存中, 入库成功后由 commit 写入索引。
+        """
+        kept, duplicate_ids = [], set()
+        pending = _PendingFile()
+        # 同一文件内的去重只在内存中进行, 不读写sqlite
+        local_buckets: Dict[Tuple[int, int], List[str]] = {}
+        with self._lock:
+            for chunk in chunks:
+                signature = self.hasher.signature(chunk.page_content)
+                if signature is None:
+                    kept.append(chunk)
+                    continue
+                keys = self._band_keys(signature)
+                local_candidates = {chunk_id for key in keys for chunk_id in local_buckets.get(key, ())}
+                if self._best_match(signature, ((chunk_id, pending.signatures[chunk_id][1])
+                                                for chunk_id in local_candidates)) is not None:
+                    duplicate_ids.add(chunk.metadata["id"])
+                    continue
+                canonical_id = self._find_duplicate(signature, keys, exclude_filename=filename)
+                if canonical_id is not None:
+                    pending.canonical_ids.add(canonical_id)
+                    duplicate_ids.add(chunk.metadata["id"])
+                    continue
+                chunk_id = chunk.metadata["id"]
+                pending.signatures[chunk_id] = (chunk.page_content, signature)
+                for key in keys:
+                    local_buckets.setdefault(key, []).append(chunk_id)
+                kept.append(chunk)
+            self._pending[filename] = pending
+        if duplicate_ids:
+            logger.info(f"文件 {filename} 共 {len(chunks)} 个chunk, 跳过近似重复chunk {len(duplicate_ids)} 个")
+        return kept
+
+    def stage(self, filename: str, chunks: List[Document]):
+        """以切分流程最终输出的chunk(合并过小chunk之后)更新暂存的签名, 被合并掉的chunk不再暂存"""
+        with self._lock:
+            pending = self._pending.get(filename)
+            if pending is None:
+                return
+            signatures = {}
+            for chunk in chunks:
+                chunk_id = chunk.metadata.get("id")
+                if chunk_id not in pending.signatures:
+                    continue
+                text, signature = pending.signatures[chunk_id]
+                if chunk.page_content != text:
+                    signature = self.hasher.signature(chunk.page_content)
+                    if signature is None:
+                        continue
+                signatures[chunk_id] = (chunk.page_content, signature)
+            pending.signatures = signatures
+
+    def commit(self, filename: str, chunk_ids: Iterable[str]):
+        """文件入库成功后替换其在索引中的签名, 只写入实际入库的chunk
+
+        该文件原有chunk被移除后, 重复项指向这些chunk的其他文件记为需要重新入库; 本文件的重复项指向的chunk
+        在暂存期间被移除(其所在文件先一步重新入库)时, 本文件也记为需要重新入库。
+        """
+        chunk_ids = set(chunk_ids)
+        with self._lock:
+            pending = self._pending.pop(filename, None)
+            if pending is None:
+                return
+            self._orphaned_files |= self._remove_file(filename)
+            for chunk_id, (_, signature) in pending.signatures.items():
+                if chunk_id not in chunk_ids:
+                    continue
+                self._conn.execute("INSERT OR REPLACE INTO signature (chunk_id, filename, signature) VALUES (?, ?, ?)",
+                                   (chunk_id, filename, signature.tobytes()))
+                self._conn.executemany("INSERT INTO bucket (band, key, chunk_id) VALUES (?, ?, ?)",
+                                       [(band, key, chunk_id) for band, key in self._band_keys(signature)])
+            canonical_ids = list(pending.canonical_ids)
+            existing = set()
+            for start in range(0, len(canonical_ids), 500):
+                batch = canonical_ids[start: start + 500]
+                existing.update(row[0] for row in self._conn.execute(
+                    f"SELECT chunk_id FROM signature WHERE chunk_id IN ({','.join('?' * len(batch))})", batch
+                ))
+            if len(existing) < len(canonical_ids):
+                self._orphaned_files.add(filename)
+            self._conn.executemany("INSERT INTO duplicate (filename, canonical_id) VALUES (?, ?)",
+                                   [(filename, canonical_id) for canonical_id in existing])
+            self._conn.commit()
+
+    def canonical_ids(self, filenames: Iterable[str]) -> List[str]:
+        """返回这些文件中被跳过的重复chunk指向的保留chunk id, 按文件检索时这些chunk也要一并检索"""
+        filenames = list(filenames)
+        canonical_ids = set()
+        with self._lock:
+            for start in range(0, len(filenames), 500):
+                batch = filenames[start: start + 500]
+                canonical_ids.update(row[0] for row in self._conn.execute(
+                    f"SELECT DISTINCT canonical_id FROM duplicate WHERE filename IN ({','.join('?' * len(batch))})",
+                    batch
+                ))
+        return sorted(canonical_ids)
+
+    def discard(self, filename: str):
+        """文件处理或入库失败时丢弃暂存的签名, 索引保持不变"""
+        with self._lock:
+            self._pending.pop(filename, None)
+
+    def pop_orphaned_files(self) -> Set[str]:
+        """返回并清空重复项已失效(指向的保留chunk被移除)、需要重新入库的文件"""
+        with self._lock:
+            orphaned, self._orphaned_files = self._orphaned_files, set()
+            return orphaned
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, int]]:
+        """每个band的签名片段哈希为一个64位整数作为桶的key"""
+        keys = []
+        for band in range(self.bands):
+            digest = hashlib.blake2b(signature[band * self.rows: (band + 1) * self.rows].tobytes(),
+                                     digest_size=8).digest()
+            keys.append((band, int.from_bytes(digest, "big", signed=True)))
+        return keys
+
+    def _best_match(self, signature: np.ndarray,
+                    candidates: Iterable[Tuple[str, np.ndarray]]) -> Optional[str]:
+        """返回候选中估计相似度最高且达到阈值的chunk id"""
+        best_id, best_similarity = None, self.threshold
+        for chunk_id, candidate in candidates:
+            similarity = float(np.mean(candidate == signature))
+            if similarity >= best_similarity:
+                best_id, best_similarity = chunk_id, similarity
+        return best_id
+
+    def _find_duplicate(self, signature: np.ndarray, keys: List[Tuple[int, int]],
+                        exclude_filename: str) -> Optional[str]:
+        """在索引中同桶的候选chunk(不含exclude_filename的chunk)中找近似重复的chunk, 返回其id"""
+        condition = " OR ".join(["(band = ? AND key = ?)"] * len(keys))
+        candidates = [row[0] for row in self._conn.execute(
+            f"SELECT DISTINCT chunk_id FROM bucket WHERE {condition}", [v for key in keys for v in key]
+        )]
+        signatures = []
+        for start in range(0, len(candidates), 500):
+            batch = candidates[start: start + 500]
+            rows = self._conn.execute(
+                f"SELECT chunk_id, signature FROM signature WHERE chunk_id IN ({','.join('?' * len(batch))}) "
+                f"AND filename != ?", batch + [exclude_filename]
+            )
+            signatures.extend((chunk_id, np.frombuffer(blob, dtype=np.uint32)) for chunk_id, blob in rows)
+        return self._best_match(signature, signatures)
+
+    def _remove_file(self, filename: str) -> Set[str]:
+        """删除文件的签名和重复记录, 返回重复项指向该文件chunk的其他文件"""
+        orphaned = {row[0] for row in self._conn.execute(
+            "SELECT DISTINCT d.filename FROM duplicate d JOIN signature s ON d.canonical_id = s.chunk_id "
+            "WHERE s.filename = ? AND d.filename != ?", (filename, filename)
+        )}
+        chunk_ids = "SELECT chunk_id FROM signature WHERE filename = ?"
+        self._conn.execute(f"DELETE FROM duplicate WHERE canonical_id IN ({chunk_ids}) OR filename = ?",
+                           (filename, filename))
+        self._conn.execute(f"DELETE FROM bucket WHERE chunk_id IN ({chunk_ids})", (filename,))
+        self._conn.execute("DELETE FROM signature WHERE filename = ?", (filename,))
+        return orphaned
+
+    def _clear(self):
+        for table in ("signature", "bucket", "duplicate"):
+            self._conn.execute(f"DELETE FROM {table}")
+
+
+_chunk_indexes: Dict[str, ChunkIndex] = {}
+_chunk_indexes_lock = threading.Lock()
+
+
+def get_chunk_index(knowledge_base_name: str) -> Optional[ChunkIndex]:
+    """每个知识库一个去重索引, 保存在知识库目录下, 未开启时返回None"""
+    if not settings.chunk_dedup.enable:
+        return None
+    with _chunk_indexes_lock:
+        chunk_index = _chunk_indexes.get(knowledge_base_name)
+        if chunk_index is None:
+            kb_path = get_kb_path(knowledge_base_name)
+            os.makedirs(kb_path, exist_ok=True)
+            chunk_index = ChunkIndex(os.path.join(kb_path, MINHASH_DB_NAME),
+                                     threshold=settings.chunk_dedup.threshold,
+                                     num_perm=settings.chunk_dedup.num_perm,
+                                     ngram_size=settings.chunk_dedup.ngram_size)
+            _chunk_indexes[knowledge_base_name] = chunk_index
+        return chunk_index
+
+
+def get_canonical_ids(knowledge_base_name: str, filenames: Iterable[str]) -> List[str]:
+    """限定文件检索时需要一并检索的保留chunk id, 未开启去重时返回空列表"""
+    chunk_index = get_chunk_index(knowledge_base_name)
+    if chunk_index is None:
+        return []
+    return chunk_index.canonical_ids(filenames)
+
+
+def reset_chunk_index(knowledge_base_name: str):
+    """清空或删除知识库时删除其去重索引"""
+    with _chunk_indexes_lock:
+        chunk_index = _chunk_indexes.pop(knowledge_base_name, None)
+    if chunk_index is not None:
+        chunk_index.close()
+    path = os.path.join(get_kb_path(knowledge_base_name), MINHASH_DB_NAME)
+    if os.path.exists(path):
+        os.remove(path)
@@ -1,24 +1,92 @@
 import re
 import time
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Dict, List, Optional
 
 import pdfplumber
 
 
+class SharedPDF:
+    """按需打开的共享PDF句柄
+
+    智能加载器在分类和解析时共用同一个句柄: 文件只在第一次访问时打开一次,
+    前几页的文本探针也只提取一次, 各个转换器的判断规则都读取这份缓存。
+    pdfplumber 会在页面对象上缓存解析结果, 后续整篇解析时不必重新排版这些页面。
+    """
+
+    # 分类时探测的页数
+    PROBE_PAGES = 2
+
+    def __init__(self, file_path: str) -> None:
+        """初始化共享句柄
+
+        Args:
+            file_path: PDF文件路径
+        """
+        self.file_path = file_path
+        self._pdf: Optional[pdfplumber.PDF] = None
+        self._page_texts: Dict[int, str] = {}
+
+    @property
+    def pdf(self) -> pdfplumber.PDF:
+        """PDF文档对象, 第一次访问时才打开文件"""
+        if self._pdf is None:
+            self._pdf = pdfplumber.open(self.file_path)
+        return self._pdf
+
+    @property
+    def total_pages(self) -> int:
+        return len(self.pdf.pages)
+
+    def page_text(self, index: int) -> str:
+        """第 index 页的文本(带缓存), 页码越界时返回空串"""
+        if index not in self._page_texts:
+            if index >= self.total_pages:
+                self._page_texts[index] = ""
+            else:
+                self._page_texts[index] = self.pdf.pages[index].extract_text() or ""
+        return self._page_texts[index]
+
+    def probe_text(self, pages: int = PROBE_PAGES) -> str:
+        """前 pages 页拼接后的文本探针"""
+        return "".join(self.page_text(i) for i in range(min(pages, self.PROBE_PAGES)))
+
+    def close(self) -> None:
+        if self._pdf is not None:
+            self._pdf.close()
+            self._pdf = None
+
+    def __enter__(self) -> "SharedPDF":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
 class BaseConverter(ABC):
     """基础转换器抽象类
     
     用于将不同格式的文件转换为Markdown格式
     """
     
-    def __init__(self, file_path: str) -> None:
+    def __init__(self, file_path: str, pdf: Optional[SharedPDF] = None) -> None:
         """初始化转换器
         
         Args:
             file_path: 待转换文件路径
+            pdf: 共享的PDF句柄, 不传时由转换器自己按需打开并负责关闭
         """
         self.file_path = file_path
+        self._owns_pdf = pdf is None
+        self.pdf = pdf if pdf is not None else SharedPDF(file_path)
+
+    @property
+    def pdf_file(self) -> pdfplumber.PDF:
+        return self.pdf.pdf
+
+    @property
+    def total_pages(self) -> int:
+        return self.pdf.total_pages
 
     @abstractmethod 
     def convert_to_markdown(self) -> str:
@@ -29,14 +97,31 @@ class BaseConverter(ABC):
         """
         pass
 
+    @classmethod
     @abstractmethod
+    def match(cls, file_path: str, pdf: SharedPDF) -> bool:
+        """分类规则: 只根据文件名和前几页的文本探针判断, 不做整篇解析
+
+        Args:
+            file_path: 待转换文件路径
+            pdf: 共享的PDF句柄
+
+        Returns:
+            bool: 是否可以处理该文件
+        """
+        pass
+
     def is_my_file(self) -> bool:
         """判断文件是否可以由该转换器处理
         
         Returns:
             bool: 是否可以处理该文件
         """
-        pass
+        return self.match(self.file_path, self.pdf)
+
+    def __del__(self):
+        if getattr(self, "_owns_pdf", False):
+            self.pdf.close()
 
 
 class HandbookToMarkdownConverter(BaseConverter):
@@ -45,18 +130,13 @@ class HandbookToMarkdownConverter(BaseConverter):
     用于将产品手册类PDF文件转换为Markdown格式,通过字体大小和格式特征识别标题层级
     """
 
-    def __init__(self, file_path: str) -> None:
-        super().__init__(file_path)
-        self.pdf_file = pdfplumber.open(self.file_path)
-        self.total_pages = len(self.pdf_file.pages)
-
     def convert_to_markdown(self) -> str:
         # with open('text.md', 'r', encoding='utf-8') as f:
         #     return f.read()
 
         # 实现 PDF 内容到 Markdown 的转换逻辑
         start_time = time.time()
-        all_text = ""
+        all_text = []
         print(f"开始转换PDF文件 {self.file_path}")
         print(f"总页数: {self.total_pages}")
 
@@ -66,22 +146,22 @@ class HandbookToMarkdownConverter(BaseConverter):
             bottom = page.height * 0.95
             page = page.crop(bbox=(0, top, page.width, bottom))
             lines = page.extract_text_lines(layout=True, y_tolerance=7)
-            text = ""
             for line in lines:
-                text += self.__add_title_level(line) + "\n"
-            all_text += text + "\n"
+                all_text.append(self.__add_title_level(line) + "\n")
+            all_text.append("\n")
 
         end_time = time.time()
         print(f"PDF文件 {self.file_path} 转换完成, 耗时: {end_time - start_time:.2f}秒")
         # with open("./text.md", 'w') as f:
         #     f.write(all_text)
-        return all_text
+        return "".join(all_text)
 
-    def is_my_file(self) -> bool:
+    @classmethod
+    def match(cls, file_path: str, pdf: SharedPDF) -> bool:
         """太初的手册第一页都会有产品版本号, 发布日期"""
-        if not self.file_path.endswith(".pdf"):
+        if not file_path.endswith(".pdf"):
             return False
-        page_1_content = self.pdf_file.pages[0].extract_text()
+        page_1_content = pdf.page_text(0)
         if "产品版本号" in page_1_content and "发布日期" in page_1_content:
             return True
         return False
@@ -113,9 +193,6 @@ class HandbookToMarkdownConverter(BaseConverter):
         else:  # 正文
             return line["text"]
 
-    def __del__(self):
-        self.pdf_file.close()
-
 
 class GovernmentPolicyPDFConverter(BaseConverter):
     """政府政策文件PDF转Markdown转换器
@@ -127,11 +204,6 @@ class GovernmentPolicyPDFConverter(BaseConverter):
 
     y_tolerance = 15
 
-    def __init__(self, file_path: str) -> None:
-        super().__init__(file_path)
-        self.pdf_file = pdfplumber.open(self.file_path)
-        self.total_pages = len(self.pdf_file.pages)
-
     def __is_footer(self, text: str) -> bool:
         pattern = r"^—\s*\d+\s*—$"
         return bool(re.match(pattern, text))
@@ -142,7 +214,7 @@ class GovernmentPolicyPDFConverter(BaseConverter):
 
         # 实现 PDF 内容到 Markdown 的转换逻辑
         start_time = time.time()
-        all_text = ""
+        all_text = []
         print(f"开始转换PDF文件 {self.file_path}")
         print(f"总页数: {self.total_pages}")
 
@@ -152,38 +224,31 @@ class GovernmentPolicyPDFConverter(BaseConverter):
             bottom = page.height * 0.88
             page = page.crop(bbox=(0, top, page.width, bottom))
             lines = page.extract_text_lines(y_tolerance=self.y_tolerance)
-            text = ""
             # last_line = lines[-1]
             # if self.__is_footer(last_line["text"]):
             # lines.pop()
             for line in lines:
                 # 筛选, ��除页眉页脚
-                text += self.__add_title_level(line) + "\n"
-            all_text += text
+                all_text.append(self.__add_title_level(line) + "\n")
 
         end_time = time.time()
         print(f"PDF文件 {self.file_path} 转换完成, 耗时: {end_time - start_time:.2f}秒")
         # with open("./text.md", "w") as f:
         #     f.write(all_text)
-        return all_text
+        return "".join(all_text)
 
-    def is_my_file(self) -> bool:
-        """政策手册第一页都会有产品版本号, 发布日期"""
-        if not self.file_path.endswith(".pdf"):
+    @classmethod
+    def match(cls, file_path: str, pdf: SharedPDF) -> bool:
+        """政策文件的文件名中带有政策文号"""
+        if not file_path.endswith(".pdf"):
             return False
-        # 单层pdf, 无法使用原生解析器, 需要使用ocr
-        content = self.pdf_file.pages[0].extract_text(y_tolerance=self.y_tolerance)
-        if not content:
-            return False
-        # 匹配文件名中的政策文号格式
-
+        # 匹配文件名中的政策文号格式, 先做文件名判断, 不匹配时无需读取页面
         policy_number_pattern1 = r"[^\s]+[〔［\[](\d{4})[〕］\]]\s*\d+\s*号"
         policy_number_pattern2 = r"〔[２0][０0][２0][０-９0-9]〕[０-９0-9]+号"
-        if re.search(policy_number_pattern1, self.file_path) or re.search(
-            policy_number_pattern2, self.file_path
-        ):
-            return True
-        return False
+        if not (re.search(policy_number_pattern1, file_path) or re.search(policy_number_pattern2, file_path)):
+            return False
+        # 单层pdf, 无法使用原生解析器, 需要使用ocr
+        return bool(pdf.page_text(0))
 
     def __add_title_level(self, line):
         """
@@ -205,9 +270,6 @@ class GovernmentPolicyPDFConverter(BaseConverter):
         # else:  # 正文
         # return text
 
-    def __del__(self):
-        self.pdf_file.close()
-
 
 class TablePDFConverter(BaseConverter):
     """表格类PDF转Markdown转换器
@@ -215,11 +277,6 @@ class TablePDFConverter(BaseConverter):
     专门用于处理以表格为主的PDF文件,将表格转换为Markdown格式
     """
 
-    def __init__(self, file_path: str) -> None:
-        super().__init__(file_path)
-        self.pdf_file = pdfplumber.open(self.file_path)
-        self.total_pages = len(self.pdf_file.pages)
-
     def list_to_markdown_table(self, data: List[List[str]]) -> str:
         """将二维列表转换为Markdown表格
         
@@ -280,16 +337,12 @@ class TablePDFConverter(BaseConverter):
 
         return md_text
 
-    def is_my_file(self) -> bool:
-        if not self.file_path.endswith(".pdf"):
+    @classmethod
+    def match(cls, file_path: str, pdf: SharedPDF) -> bool:
+        """前两页出现明细表"""
+        if not file_path.endswith(".pdf"):
             return False
-        page_number = min(2, self.total_pages)
-        content = ""
-        for i in range(page_number):
-            content += self.pdf_file.pages[i].extract_text()
-        if "明细表" in content:
-            return True
-        return False
+        return "明细表" in pdf.probe_text(2)
 
 
 from typing import List
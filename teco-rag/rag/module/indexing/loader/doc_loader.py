@@ -25,7 +25,7 @@
 # OF SUCH DAMAGE.
 
 from io import BytesIO
-from typing import List
+from typing import Iterator, List
 
 import numpy as np
 import tqdm
@@ -35,9 +35,10 @@ from docx.oxml.text.paragraph import CT_P
 from docx.table import Table, _Cell
 from docx.text.paragraph import Paragraph
 from langchain_community.document_loaders import UnstructuredFileLoader
+from langchain_core.documents import Document as LCDocument
 from PIL import Image
 
-from rag.module.indexing.loader.utils.ocr import get_rapid_ocr
+from rag.module.indexing.loader.utils.ocr import ocr_deadline, ocr_image
 
 
 class CustomizedOcrDocLoader(UnstructuredFileLoader):
@@ -46,6 +47,9 @@ class CustomizedOcrDocLoader(UnstructuredFileLoader):
     这个类用于加载和处理包含文本和图像的文档，并使用OCR技术识别图像中的文本。
     """
 
+    # lazy_load 每段文档的最小字数, 段落和表格不会被拆开
+    section_size = 4000
+
     def _is_paragraph_end(self, text):
         """
         判断给定文本是否为段落结束。
@@ -58,89 +62,104 @@ class CustomizedOcrDocLoader(UnstructuredFileLoader):
         """
         return text.strip()[-1] in ["。", "？"]
 
-    def _get_elements(self) -> List:
+    def _iter_sections(self, filepath) -> Iterator[str]:
         """
-        获取文档中的所有元素（文本和图像）。
+        将文档按块顺序转换为文本，包括OCR识别图像中的文本。
+        累计文本达到 section_size 后在块边界处输出一段, 不在内存中拼接整篇文本。
 
-        Returns:
-            List: 包含文档所有元素的列表。
+        Args:
+            filepath (str): 文档文件路径。
+
+        Yields:
+            str: 一段提取的文本内容。
         """
+        doc = Document(filepath)  # 无法读取doc文件, 只能读取docx文件
+        resp = []
+        # 整篇文档共用一个OCR截止时间, 超时后只保留原生文本
+        deadline = ocr_deadline()
 
-        def doc2text(filepath):
+        def iter_block_items(parent):
             """
-            将文档转换为文本，包括OCR识别图像中的文本。
+            迭代文档中的块元素（段落和表格）。
 
             Args:
-                filepath (str): 文档文件路径。
+                parent: 父元素（文档或单元格）。
 
-            Returns:
-                str: 提取的文本内容。
+            Yields:
+                Paragraph 或 Table: 文档中的段落或表格元素。
             """
-            ocr = get_rapid_ocr()
-
-            doc = Document(filepath)  # 无法读取doc文件, 只能读取docx文件
-            resp = ""
-
-            def iter_block_items(parent):
-                """
-                迭代文档中的块元素（段落和表格）。
-
-                Args:
-                    parent: 父元素（文档或单元格）。
-
-                Yields:
-                    Paragraph 或 Table: 文档中的段落或表格元素。
-                """
-                from docx.document import Document
-
-                if isinstance(parent, Document):
-                    parent_elm = parent.element.body
-                elif isinstance(parent, _Cell):
-                    parent_elm = parent._tc
-                else:
-                    raise ValueError("CustomizedOcrDocLoader parse fail")
-
-                for child in parent_elm.iterchildren():
-                    if isinstance(child, CT_P):
-                        yield Paragraph(child, parent)
-                    elif isinstance(child, CT_Tbl):
-                        yield Table(child, parent)
-
-            b_unit = tqdm.tqdm(
-                total=len(doc.paragraphs) + len(doc.tables),
-                desc="CustomizedOcrDocLoader block index: 0",
+            from docx.document import Document
+
+            if isinstance(parent, Document):
+                parent_elm = parent.element.body
+            elif isinstance(parent, _Cell):
+                parent_elm = parent._tc
+            else:
+                raise ValueError("CustomizedOcrDocLoader parse fail")
+
+            for child in parent_elm.iterchildren():
+                if isinstance(child, CT_P):
+                    yield Paragraph(child, parent)
+                elif isinstance(child, CT_Tbl):
+                    yield Table(child, parent)
+
+        b_unit = tqdm.tqdm(
+            total=len(doc.paragraphs) + len(doc.tables),
+            desc="CustomizedOcrDocLoader block index: 0",
+        )
+        for i, block in enumerate(iter_block_items(doc)):
+            b_unit.set_description(
+                "CustomizedOcrDocLoader block index: {}".format(i)
             )
-            for i, block in enumerate(iter_block_items(doc)):
-                b_unit.set_description(
-                    "CustomizedOcrDocLoader block index: {}".format(i)
-                )
-                b_unit.refresh()
-                if isinstance(block, Paragraph):
-                    resp += block.text.strip() + "\n"
-
-                    images = block._element.xpath(".//pic:pic")  # 获取所有图片
-                    for image in images:
-                        for img_id in image.xpath(".//a:blip/@r:embed"):  # 获取图片id
-                            part = doc.part.related_parts[
-                                img_id
-                            ]  # 根据图片id获取对应的图片
-                            if isinstance(part, ImagePart):
-                                image = Image.open(BytesIO(part._blob))
-                                result, _ = ocr(np.array(image))
-                                if result:
-                                    ocr_result = [line[1] for line in result]
-                                    resp += "\n".join(ocr_result)
-
-                elif isinstance(block, Table):
-                    for row in block.rows:
-                        for cell in row.cells:
-                            for paragraph in cell.paragraphs:
-                                resp += paragraph.text.strip() + "\n"
-
-                b_unit.update(1)
-            return resp
-
-        text = doc2text(self.file_path)
+            b_unit.refresh()
+            if isinstance(block, Paragraph):
+                resp.append(block.text.strip() + "\n")
+
+                images = block._element.xpath(".//pic:pic")  # 获取所有图片
+                for image in images:
+                    for img_id in image.xpath(".//a:blip/@r:embed"):  # 获取图片id
+                        part = doc.part.related_parts[
+                            img_id
+                        ]  # 根据图片id获取对应的图片
+                        if isinstance(part, ImagePart):
+                            image = Image.open(BytesIO(part._blob))
+                            result = ocr_image(np.array(image), deadline)
+                            if result:
+                                ocr_result = [line[1] for line in result]
+                                resp.append("\n".join(ocr_result))
+
+            elif isinstance(block, Table):
+                for row in block.rows:
+                    for cell in row.cells:
+                        for paragraph in cell.paragraphs:
+                            resp.append(paragraph.text.strip() + "\n")
+
+            b_unit.update(1)
+            if sum(map(len, resp)) >= self.section_size:
+                yield "".join(resp)
+                resp = []
+        b_unit.close()
+        if resp:
+            yield "".join(resp)
+
+    def _get_elements(self) -> List:
+        """
+        获取文档中的所有元素（文本和图像）。
+
+        Returns:
+            List: 包含文档所有元素的列表。
+        """
+        text = "".join(self._iter_sections(self.file_path))
         from unstructured.partition.text import partition_text
 
         return partition_text(text=text, **self.unstructured_kwargs)
+
+    def lazy_load(self) -> Iterator[LCDocument]:
+        """按段生成文档, 不在内存中拼接整篇文本"""
+        from unstructured.partition.text import partition_text
+
+        for i, section in enumerate(self._iter_sections(self.file_path)):
+            elements = partition_text(text=section, **self.unstructured_kwargs)
+            content = "\n\n".join(str(el) for el in elements)
+            if content:
+                yield LCDocument(page_content=content, metadata={"source": self.file_path, "section": i})
@@ -26,64 +26,85 @@
 
 
 import os
-from typing import List
+from typing import Iterator, List, Tuple
 
 import cv2
 import numpy as np
 import tqdm
 from langchain_community.document_loaders import UnstructuredFileLoader
+from langchain_core.documents import Document
 
-from rag.module.indexing.loader.utils.ocr import get_rapid_ocr
+from rag.module.indexing.loader.utils.ocr import (
+    get_ocr_service,
+    ocr_deadline,
+    record_ocr_pages,
+    should_ocr_page,
+)
 
 # PDF OCR 控制：只对宽高超过页面一定比例（图片宽/页面宽，图片高/页面高）的图片进行 OCR。
 # 这样可以避免 PDF 中一些小图片的干扰，提高非扫描版 PDF 处理速度
 PDF_OCR_THRESHOLD = (0.6, 0.6)
 
 
+def _rotate_img(img, angle):
+    """
+    img   --image
+    angle --rotation angle
+    return--rotated img
+    """
+
+    h, w = img.shape[:2]
+    rotate_center = (w / 2, h / 2)
+    # 获取旋转矩阵
+    # 参数1为旋转中心点;
+    # 参数2为旋转角度,正值-逆时针旋转;负值-顺时针旋转
+    # 参数3为各向同性的比例因子,1.0原图，2.0变成原来的2倍，0.5变成原来的0.5倍
+    M = cv2.getRotationMatrix2D(rotate_center, angle, 1.0)
+    # 计算图像新边界
+    new_w = int(h * np.abs(M[0, 1]) + w * np.abs(M[0, 0]))
+    new_h = int(h * np.abs(M[0, 0]) + w * np.abs(M[0, 1]))
+    # 调整旋转矩阵以考虑平移
+    M[0, 2] += (new_w - w) / 2
+    M[1, 2] += (new_h - h) / 2
+
+    rotated_img = cv2.warpAffine(img, M, (new_w, new_h))
+    return rotated_img
+
+
 class CustomizedOcrPdfLoader(UnstructuredFileLoader):
-    def _get_elements(self) -> List:
-        def rotate_img(img, angle):
-            """
-            img   --image
-            angle --rotation angle
-            return--rotated img
-            """
-
-            h, w = img.shape[:2]
-            rotate_center = (w / 2, h / 2)
-            # 获取旋转矩阵
-            # 参数1为旋转中心点;
-            # 参数2为旋转角度,正值-逆时针旋转;负值-顺时针旋转
-            # 参数3为各向同性的比例因子,1.0原图，2.0变成原来的2倍，0.5变成原来的0.5倍
-            M = cv2.getRotationMatrix2D(rotate_center, angle, 1.0)
-            # 计算图像新边界
-            new_w = int(h * np.abs(M[0, 1]) + w * np.abs(M[0, 0]))
-            new_h = int(h * np.abs(M[0, 0]) + w * np.abs(M[0, 1]))
-            # 调整旋转矩阵以考虑平移
-            M[0, 2] += (new_w - w) / 2
-            M[1, 2] += (new_h - h) / 2
-
-            rotated_img = cv2.warpAffine(img, M, (new_w, new_h))
-            return rotated_img
-
-        def pdf2text(filepath):
-            import fitz  # pyMuPDF里面的fitz包，不要与pip install fitz混淆
-            import numpy as np
-
-            ocr = get_rapid_ocr()
-            doc = fitz.open(filepath)
-            resp = ""
-
-            b_unit = tqdm.tqdm(
-                total=doc.page_count, desc="RapidOCRPDFLoader context page index: 0"
-            )
+    def _iter_pages(self, filepath) -> Iterator[Tuple[int, str]]:
+        """逐页提取原生文本与图片OCR文本
+
+        Yields:
+            Tuple[int, str]: 页码(从0开始)与该页文本
+        """
+        import fitz  # pyMuPDF里面的fitz包，不要与pip install fitz混淆
+
+        doc = fitz.open(filepath)
+        ocr_service = get_ocr_service()
+        # 整篇文档共用一个OCR截止时间, 超时后只保留原生文本
+        deadline = ocr_deadline()
+        ocr_pages, native_pages = 0, 0
+
+        b_unit = tqdm.tqdm(
+            total=doc.page_count, desc="RapidOCRPDFLoader context page index: 0"
+        )
+        try:
             for i, page in enumerate(doc):
                 b_unit.set_description("RapidOCRPDFLoader context page index: {}".format(i))
                 b_unit.refresh()
                 text = page.get_text("")
-                resp += text + "\n"
+                page_texts = [text]
 
                 img_list = page.get_image_info(xrefs=True)
+                # 文本层完整的页面不做OCR, 只有文本稀少或图片铺满页面(扫描页)时才识别图片
+                image_areas = [(img["bbox"][2] - img["bbox"][0]) * (img["bbox"][3] - img["bbox"][1]) for img in img_list]
+                if should_ocr_page(text, page.rect.width * page.rect.height, image_areas):
+                    ocr_pages += 1
+                else:
+                    native_pages += 1
+                    img_list = []
+                img_arrays = []
                 for img in img_list:
                     if xref := img.get("xref"):
                         bbox = img["bbox"]
@@ -93,33 +114,49 @@ class CustomizedOcrPdfLoader(UnstructuredFileLoader):
                         ) / (page.rect.height) < PDF_OCR_THRESHOLD[1]:
                             continue
                         pix = fitz.Pixmap(doc, xref)
-                        samples = pix.samples
                         if int(page.rotation) != 0:  # 如果Page有旋转角度，则旋转图片
                             img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
                                 pix.height, pix.width, -1
                             )
                             # tmp_img = Image.fromarray(img_array);
                             ori_img = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-                            rot_img = rotate_img(img=ori_img, angle=360 - page.rotation)
+                            rot_img = _rotate_img(img=ori_img, angle=360 - page.rotation)
                             img_array = cv2.cvtColor(rot_img, cv2.COLOR_RGB2BGR)
                         else:
                             img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
                                 pix.height, pix.width, -1
                             )
-                        result, _ = ocr(img_array)
-                        if result:
-                            # self._save_img(i, xref, img_array)
-                            ocr_result = [line[1] for line in result]
-                            resp += "\n".join(ocr_result)
+                        img_arrays.append(img_array)
+                # 同一页的图片一起交给OCR服务分批识别
+                for result in ocr_service.ocr(img_arrays, deadline):
+                    if result:
+                        # self._save_img(i, xref, img_array)
+                        ocr_result = [line[1] for line in result]
+                        page_texts.append("\n".join(ocr_result))
                 # 更新进度
                 b_unit.update(1)
-            return resp
+                yield i, "\n".join(page_texts)
+        finally:
+            b_unit.close()
+            doc.close()
+        record_ocr_pages(filepath, ocr_pages, native_pages)
 
-        text = pdf2text(self.file_path)
+    def _get_elements(self) -> List:
+        text = "\n".join(page_text for _, page_text in self._iter_pages(self.file_path))
         from unstructured.partition.text import partition_text
 
         return partition_text(text=text, **self.unstructured_kwargs)
 
+    def lazy_load(self) -> Iterator[Document]:
+        """逐页生成文档, 不在内存中拼接整篇文本"""
+        from unstructured.partition.text import partition_text
+
+        for i, page_text in self._iter_pages(self.file_path):
+            elements = partition_text(text=page_text, **self.unstructured_kwargs)
+            content = "\n\n".join(str(el) for el in elements)
+            if content:
+                yield Document(page_content=content, metadata={"source": self.file_path, "page": i})
+
     def _save_img(self, i, xref, img_array):
         # 保存图片到本地
         img_filename = f"page_{i}_img_{xref}.png"
@@ -1,5 +1,14 @@
+import math
+import multiprocessing
+import os
+import threading
+import time
 import warnings
-from typing import Any, Iterator, List, Mapping, Optional
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple, Union
 
 import numpy as np
 import pdfplumber.page
@@ -9,7 +18,13 @@ from langchain_community.document_loaders.blob_loaders import Blob
 from langchain_core.documents import Document
 from PIL import Image
 
-from rag.module.indexing.loader.utils.ocr import extract_from_images_with_rapidocr
+from rag.common.utils import logger
+from rag.module.indexing.loader.utils.ocr import (
+    extract_from_images_with_rapidocr,
+    ocr_deadline,
+    record_ocr_pages,
+    should_ocr_page,
+)
 
 _PDF_FILTER_WITH_LOSS = ["DCTDecode", "DCT", "JPXDecode"]
 _PDF_FILTER_WITHOUT_LOSS = [
@@ -27,6 +42,44 @@ _PDF_FILTER_WITHOUT_LOSS = [
     "CCF",
     "JBIG2Decode",
 ]
+# extract_text 参数中同样适用于 extract_words 的部分, 其余(layout 等)只影响版式文本的排布
+_WORD_KWARGS = (
+    "x_tolerance",
+    "x_tolerance_ratio",
+    "y_tolerance",
+    "keep_blank_chars",
+    "use_text_flow",
+    "horizontal_ltr",
+    "vertical_ttb",
+    "extra_attrs",
+    "split_at_punctuation",
+    "expand_ligatures",
+)
+# pdfplumber 默认的行聚合容差
+_DEFAULT_Y_TOLERANCE = 3
+
+# 分页并行解析共用的进程池, 第一次使用时按CPU核数创建, 之后所有文档复用, 避免每个文档重新spawn子进程
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # 使用 spawn 启动子进程, 避免 fork 继承服务进程中的线程与锁
+            _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+
+def _discard_process_pool(pool: ProcessPoolExecutor):
+    """子进程异常退出后进程池不可再用, 丢弃后下次使用时重新创建"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
 
 
 class CustomizedPDFPlumberLoader(PDFPlumberLoader):
@@ -36,20 +89,30 @@ class CustomizedPDFPlumberLoader(PDFPlumberLoader):
 
     Attributes:
         paged (bool): 是否对PDF文件进行分页处理。默认为False。
+        max_workers (Optional[int]): 分页并行解析的最大进程数, None 表示按 CPU 核数。
     """
 
     paged: bool = False
+    max_workers: Optional[int] = None
 
-    def load(self) -> List[Document]:
-        """Load file."""
-        parser = PDFPlumberParser(
+    def _parser(self) -> "PDFPlumberParser":
+        return PDFPlumberParser(
             text_kwargs=self.text_kwargs,
             dedupe=self.dedupe,
             extract_images=self.extract_images,
             paged=self.paged,
+            max_workers=self.max_workers,
         )
+
+    def load(self) -> List[Document]:
+        """Load file."""
         blob = Blob.from_path(self.file_path)  # type: ignore[attr-defined]
-        return parser.parse(blob)
+        return self._parser().parse(blob)
+
+    def lazy_load(self) -> Iterator[Document]:
+        """逐页生成文档, 不拼接整篇文本"""
+        blob = Blob.from_path(self.file_path)  # type: ignore[attr-defined]
+        yield from self._parser().lazy_parse(blob)
 
 
 class PDFPlumberParser(BaseBlobParser):
@@ -63,9 +126,13 @@ class PDFPlumberParser(BaseBlobParser):
         dedupe (bool): 是否去除重复字符
         extract_images (bool): 是否提取图片并进行OCR
         paged (bool): 是否按页返回文档
+        max_workers (Optional[int]): 分页并行解析的最大进程数, None 表示按 CPU 核数
+        min_pages_per_worker (int): 每个进程至少处理的页数, 页数不足时退化为串行解析
     """
 
     PDF_OCR_THRESHOLD = (0.4, 0.4)
+    # 每个进程分到的页区间数, 大于 1 可以平衡图片页 OCR 带来的负载不均
+    SHARDS_PER_WORKER = 2
 
     def __init__(
         self,
@@ -73,63 +140,204 @@ class PDFPlumberParser(BaseBlobParser):
         dedupe: bool = False,
         extract_images: bool = False,
         paged: bool = False,
+        max_workers: Optional[int] = None,
+        min_pages_per_worker: int = 16,
     ) -> None:
         """Initialize the parser.
 
         Args:
             text_kwargs: Keyword arguments to pass to ``pdfplumber.Page.extract_text()``
             dedupe: Avoiding the error of duplicate characters if `dedupe=True`.
+            max_workers: 分页并行解析的最大进程数, None 表示按 CPU 核数, 1 表示串行。
+            min_pages_per_worker: 每个进程至少处理的页数。
         """
         self.text_kwargs = text_kwargs or {}
         self.dedupe = dedupe
         self.extract_images = extract_images
         self.paged = paged
+        self.max_workers = max_workers
+        self.min_pages_per_worker = max(1, min_pages_per_worker)
+        self._word_kwargs = {k: v for k, v in self.text_kwargs.items() if k in _WORD_KWARGS}
+        self._y_tolerance = self.text_kwargs.get("y_tolerance", _DEFAULT_Y_TOLERANCE)
+
+    def _init_kwargs(self) -> Dict[str, Any]:
+        """子进程重建解析器所需的参数, 子进程内固定串行解析"""
+        return {
+            "text_kwargs": dict(self.text_kwargs),
+            "dedupe": self.dedupe,
+            "extract_images": self.extract_images,
+            "paged": self.paged,
+            "max_workers": 1,
+        }
+
+    def _num_workers(self, total_pages: int) -> int:
+        """按页数确定进程数: 每个进程至少 min_pages_per_worker 页, 且不超过 CPU 核数"""
+        max_workers = self.max_workers or os.cpu_count() or 1
+        return max(1, min(max_workers, math.ceil(total_pages / self.min_pages_per_worker)))
 
     def lazy_parse(self, blob: Blob) -> Iterator[Document]:  # type: ignore[valid-type]
         """Lazily parse the blob."""
         import pdfplumber
 
         with blob.as_bytes_io() as file_path:  # type: ignore[attr-defined]
-            # 打开PDF文档
-            doc = pdfplumber.open(file_path)
-
-            # 从第 i 页开始遍历
-            i = 1
-            for page in doc.pages[i - 1 :]:
-                # 获取页面的宽度和高度
-                width = page.width
-                # 通过分析文本框的数量来判断栏数
-                text_boxes = page.extract_words()
-                num_columns = self.determine_columns(text_boxes, width)
-                if num_columns == 2:  # 如果是双栏, 那就走我写的功能, 单栏就走
-                    content = self._process_double_column_page(page)
-                    # content = self._process_page_content(page)
-                    print(f"第{i}页: 双")
-                    # 提取页面内容和图片内容
-                else:
-                    content = self._process_page_content(page)
-                    print(f"第{i}页: 单")
-                i += 1
-                image_content = self._extract_images_from_page(page)
-
-                # 构建元数据
-                metadata = {
-                    "source": blob.source,  # type: ignore[attr-defined]
-                    "file_path": blob.source,  # type: ignore[attr-defined]
-                    "page": page.page_number - 1,
-                    "total_pages": len(doc.pages),
-                }
-
-                # 添加文档原始元数据中的字符串和整数类型数据
-                for key, value in doc.metadata.items():
-                    if isinstance(value, (str, int)):
-                        metadata[key] = value
-
-                # 生成文档对象
-                yield Document(page_content=content + "\n\n" + image_content, metadata=metadata)
+            with pdfplumber.open(file_path) as doc:
+                yield from self.lazy_parse_pdf(doc, blob)
+
+    def lazy_parse_pdf(self, doc: pdfplumber.PDF, blob: Blob) -> Iterator[Document]:  # type: ignore[valid-type]
+        """解析已经打开的PDF文档
+
+        页数足够多时按页区间分片, 由多个进程各自打开PDF并解析, 每个分片完成后按页序逐页输出;
+        否则直接在传入的文档对象上逐页解析, 调用方已经打开的句柄不会被重复打开。
+        并行解析中途失败时, 从第一个尚未输出的页开始串行解析。
+
+        Args:
+            doc: 已打开的PDF文档
+            blob: 文档对应的 Blob, 用于元数据和子进程重新打开文件
+        """
+        total_pages = len(doc.pages)
+        num_workers = self._num_workers(total_pages)
+        # 整篇文档共用一个OCR截止时间, 超时后的页面只保留原生文本
+        deadline = ocr_deadline() if self.extract_images else None
+        # 每页是否做了OCR的计数
+        ocr_stats: Counter = Counter()
+        # 已输出的页数, 并行解析失败时从这一页继续串行解析
+        emitted = 0
+        try:
+            if num_workers > 1:
+                pages = self._parallel_parse(blob, total_pages, num_workers, deadline, ocr_stats)
+                try:
+                    for page_doc in pages:
+                        yield page_doc
+                        emitted += 1
+                except Exception as e:
+                    msg = f"PDF分页并行解析失败, 从第{emitted + 1}页起回退为串行解析: {blob.source}"  # type: ignore[attr-defined]
+                    logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+                finally:
+                    # 消费方提前结束时立即取消尚未开始的分片
+                    pages.close()
+            for page in doc.pages[emitted:]:
+                yield self._parse_page(page, doc, blob.source, deadline, ocr_stats)  # type: ignore[attr-defined]
+        finally:
+            if self.extract_images:
+                record_ocr_pages(blob.source, ocr_stats["ocr"], ocr_stats["native"])  # type: ignore[attr-defined]
+
+    def _parallel_parse(
+        self,
+        blob: Blob,
+        total_pages: int,
+        num_workers: int,
+        deadline: Optional[float] = None,
+        ocr_stats: Optional[Counter] = None,
+    ) -> Iterator[Document]:
+        """将页码切成连续区间, 交给共用的进程池解析, 按区间顺序逐个输出分片内的页面
+
+        同时在途的分片不超过 num_workers + 1 个, 已完成但尚未被消费的分片只有这么多, 内存占用与总页数无关。
+        进程池由所有文档共用, 这里只提交和取消本文档的分片, 不关闭进程池。
+        """
+        num_shards = min(total_pages, num_workers * self.SHARDS_PER_WORKER)
+        shard_size = math.ceil(total_pages / num_shards)
+        ranges = [(start, min(start + shard_size, total_pages)) for start in range(0, total_pages, shard_size)]
+        # 有文件路径时子进程直接按路径打开, 避免在进程间传输整份文件
+        data: Union[str, bytes] = str(blob.path) if blob.data is None else blob.as_bytes()  # type: ignore[attr-defined]
+        logger.info(f"PDF分页并行解析: {blob.source}, 共{total_pages}页, {num_workers}个进程, {len(ranges)}个分片")  # type: ignore[attr-defined]
+
+        executor = _get_process_pool()
+        init_kwargs = self._init_kwargs()
+        shards = iter(ranges)
+        futures: deque = deque()
+
+        def submit_next() -> bool:
+            shard = next(shards, None)
+            if shard is None:
+                return False
+            futures.append(executor.submit(_parse_page_range, init_kwargs, data, blob.source,  # type: ignore[attr-defined]
+                                           shard[0], shard[1], deadline))
+            return True
+
+        try:
+            while len(futures) <= num_workers and submit_next():
+                pass
+            while futures:
+                shard_docs, shard_stats = futures.popleft().result()
+                submit_next()
+                if ocr_stats is not None:
+                    ocr_stats.update(shard_stats)
+                yield from shard_docs
+        except BrokenProcessPool:
+            _discard_process_pool(executor)
+            raise
+        finally:
+            # 消费方提前结束或解析失败时, 不再等待尚未开始的分片
+            for future in futures:
+                future.cancel()
+
+    def _parse_page(
+        self,
+        page: pdfplumber.page.Page,
+        doc: pdfplumber.PDF,
+        source: str,
+        deadline: Optional[float] = None,
+        ocr_stats: Optional[Counter] = None,
+    ) -> Document:
+        """解析单页: 判断栏数, 提取文本与图片OCR内容, 构建页面文档
+
+        Args:
+            page: PDF页面对象
+            doc: 页面所属的PDF文档
+            source: 文档来源, 写入元数据
+            deadline: 文档的OCR截止时间(time.time()), None 表示不限时
+            ocr_stats: 页面OCR决策计数, 本页计入 ocr 或 native
+        """
+        # 获取页面的宽度和高度
+        width = page.width
+        # 每页只提取一次单词框, 同时用于栏数判断和文本拼接
+        text_page = page.dedupe_chars() if self.dedupe else page
+        words = text_page.extract_words(**self._word_kwargs)
+        # 通过分析文本框的数量来判断栏数
+        num_columns = self.determine_columns(words, width)
+        if num_columns == 2:  # 如果是双栏, 那就走我写的功能, 单栏就走
+            content = self._process_double_column_page(page, words)
+            # content = self._process_page_content(page)
+            print(f"第{page.page_number}页: 双")
+            # 提取页面内容和图片内容
+        else:
+            content = self._process_page_content(text_page, words)
+            print(f"第{page.page_number}页: 单")
+        # 文本层完整的页面不做OCR, 只有文本稀少或图片铺满页面(扫描页)时才识别图片
+        image_content = ""
+        if self.extract_images:
+            image_areas = [(img["x1"] - img["x0"]) * (img["bottom"] - img["top"]) for img in page.images]
+            if should_ocr_page(content, page.width * page.height, image_areas):
+                image_content = self._extract_images_from_page(page, deadline)
+                if ocr_stats is not None:
+                    ocr_stats["ocr"] += 1
+            elif ocr_stats is not None:
+                ocr_stats["native"] += 1
+
+        # 构建元数据
+        metadata = {
+            "source": source,
+            "file_path": source,
+            "page": page.page_number - 1,
+            "total_pages": len(doc.pages),
+        }
+
+        # 添加文档原始元数据中的字符串和整数类型数据
+        for key, value in doc.metadata.items():
+            if isinstance(value, (str, int)):
+                metadata[key] = value
+
+        # 生成文档对象
+        return Document(page_content=content + "\n\n" + image_content, metadata=metadata)
 
     def parse(self, blob: Blob) -> List[Document]:
-        docs = list(self.lazy_parse(blob))
+        return self._combine(list(self.lazy_parse(blob)), blob)
+
+    def parse_pdf(self, doc: pdfplumber.PDF, blob: Blob) -> List[Document]:
+        """与 parse 相同, 但复用调用方已经打开的PDF文档"""
+        return self._combine(list(self.lazy_parse_pdf(doc, blob)), blob)
+
+    def _combine(self, docs: List[Document], blob: Blob) -> List[Document]:
         if self.paged:
             return docs
         else:
@@ -197,18 +405,18 @@ class PDFPlumberParser(BaseBlobParser):
             return 2
         return 1
 
-    def _process_double_column_page(self, page: pdfplumber.page.Page) -> str:
+    def _process_double_column_page(self, page: pdfplumber.page.Page, words: List[dict]) -> str:
         """处理双列页面内容。
 
         将页面分为左右两列, 分别提取文本后合并。
 
         Args:
             page: PDF页面对象
+            words: 页面中已提取的单词框
 
         Returns:
             str: 处理后的页面文本内容
         """
-        words = page.extract_words()
         left_words = []
         right_words = []
         mid_point = page.width / 2
@@ -217,60 +425,70 @@ class PDFPlumberParser(BaseBlobParser):
                 left_words.append(word)
             else:
                 right_words.append(word)
-        # 单词合并成列
-        left_lines = self._merge_words(left_words)
-        right_lines = self._merge_words(right_words)
+        # 单词合并成列: 双栏按固定的3pt与行首单词比较, 不使用单栏拼接时的 y_tolerance(SmartLoader默认为7),
+        # 栏内行距较小, 阈值过大或相邻比较会把相邻两行合成一行
+        left_lines = self._merge_words(left_words, _DEFAULT_Y_TOLERANCE, anchored=True)
+        right_lines = self._merge_words(right_words, _DEFAULT_Y_TOLERANCE, anchored=True)
         # 列合并成
         return "\n".join(left_lines + ["\n\n"] + right_lines)
 
-    def _merge_words(self, words) -> list:
+    def _merge_words(self, words: List[dict], y_threshold: float = _DEFAULT_Y_TOLERANCE,
+                     anchored: bool = False) -> list:
         """将单词合并成行。
 
-        基于垂直位置将属于同一行的单词组合在一起。
+        默认按 top 坐标排序后, 相邻单词的 top 差值超过阈值处断行(与 ``extract_text`` 的行聚合方式一致);
+        anchored 为True时按单词原有顺序, 与当前行第一个单词的 top 差值超过阈值处断行, 行内的 top 不会逐渐漂移。
+        行内再按 x 坐标排序。
 
         Args:
             words: 单词列表, 每个单词包含位置信息
+            y_threshold: 允许的y坐标差异阈值
+            anchored: 是否与行首单词比较
 
         Returns:
             list: 合并后的文本行列表
         """
-        lines = []
         if not words:
-            return lines
-
-        # 按y坐标排序
-        current_line = [words[0]]
-        y_threshold = 3  # 允许的y坐标差异阈值
-
-        for word in words[1:]:
-            # 如果当前单词与当前行第一个单词的y坐标差异在阈值内
-            if abs(word["top"] - current_line[0]["top"]) <= y_threshold:
-                current_line.append(word)
-            else:
-                # 按x坐标排序当前行的单词并加入到结果中
-                current_line.sort(key=lambda w: w["x0"])
-                line_text = " ".join(w["text"] for w in current_line)
-                lines.append(line_text)
-                current_line = [word]
-
-        # 处理最后一行
-        if current_line:
-            current_line.sort(key=lambda w: w["x0"])
-            line_text = " ".join(w["text"] for w in current_line)
-            lines.append(line_text)
+            return []
+
+        tops = np.fromiter((w["top"] for w in words), dtype=np.float64, count=len(words))
+        x0s = np.fromiter((w["x0"] for w in words), dtype=np.float64, count=len(words))
+        if anchored:
+            order = np.arange(len(words))
+            breaks, anchor = [], tops[0]
+            for i in range(1, len(tops)):
+                if abs(tops[i] - anchor) > y_threshold:
+                    breaks.append(i)
+                    anchor = tops[i]
+        else:
+            # 按y坐标排序, 相邻差值超过阈值的位置即为行边界
+            order = np.argsort(tops, kind="stable")
+            breaks = np.flatnonzero(np.diff(tops[order]) > y_threshold) + 1
 
+        lines = []
+        for line in np.split(order, breaks):
+            # 按x坐标排序当前行的单词
+            line = line[np.argsort(x0s[line], kind="stable")]
+            lines.append(" ".join(words[i]["text"] for i in line))
         return lines
 
-    def _process_page_content(self, page: pdfplumber.page.Page) -> str:
-        """Process the page content based on dedupe."""
-        if self.dedupe:
-            return page.dedupe_chars().extract_text(**self.text_kwargs)
-        return page.extract_text(**self.text_kwargs)
+    def _process_page_content(self, page: pdfplumber.page.Page, words: List[dict]) -> str:
+        """Process the page content based on dedupe.
 
-    def _extract_images_from_page(self, page: pdfplumber.page.Page) -> str:
+        非版式模式下直接由已提取的单词框拼接文本, 与 ``extract_text`` 的行聚合方式一致;
+        版式模式需要按坐标排布字符, 仍交给 ``extract_text`` 处理。
+        """
+        if self.text_kwargs.get("layout"):
+            return page.extract_text(**self.text_kwargs)
+        return "\n".join(self._merge_words(words, self._y_tolerance))
+
+    def _extract_images_from_page(self, page: pdfplumber.page.Page, deadline: Optional[float] = None) -> str:
         """Extract images from page and get the text with RapidOCR."""
         if not self.extract_images:
             return ""
+        if deadline is not None and time.time() >= deadline:
+            # 已超出文档的OCR时间预算, 不再解码图片
+            return ""
 
         images = []
         for img in page.images:
@@ -282,16 +500,17 @@ class PDFPlumberParser(BaseBlobParser):
                     filter_names = [img_filter.name]
 
                 try:
-                    img_data = img["stream"].get_data()
                     stream = img["stream"]
                     width = stream["Width"]
                     height = stream["Height"]
                     size = (width, height)
+                    # 先按尺寸过滤, 小图不必解码图片数据
                     if (
                         width / page.width < self.PDF_OCR_THRESHOLD[0]
                         or height / page.height < self.PDF_OCR_THRESHOLD[1]
                     ):
                         continue
+                    img_data = stream.get_data()
                     # 处理无损压缩的图片
                     if any(f in _PDF_FILTER_WITHOUT_LOSS for f in filter_names):
                         # 根据不同的色彩空间创建图片
@@ -328,4 +547,35 @@ class PDFPlumberParser(BaseBlobParser):
             except Exception as e:
                 warnings.warn(f"提取PDF页面图片时出错: {str(e)}")
                 continue
-        return extract_from_images_with_rapidocr(images)
+        return extract_from_images_with_rapidocr(images, deadline)
+
+
+def _parse_page_range(
+    parser_kwargs: Dict[str, Any],
+    data: Union[str, bytes],
+    source: str,
+    start: int,
+    end: int,
+    deadline: Optional[float] = None,
+) -> Tuple[List[Document], Counter]:
+    """子进程入口: 打开PDF并解析 [start, end) 区间内的页面
+
+    Args:
+        parser_kwargs: 构造 PDFPlumberParser 的参数
+        data: PDF文件路径或文件内容
+        source: 文档来源, 写入元数据
+        start: 起始页下标(包含)
+        end: 结束页下标(不包含)
+        deadline: 文档的OCR截止时间(time.time()), None 表示不限时
+
+    Returns:
+        Tuple[List[Document], Counter]: 按页序排列的页面文档, 以及这些页面的OCR决策计数
+    """
+    import pdfplumber
+
+    parser = PDFPlumberParser(**parser_kwargs)
+    file = BytesIO(data) if isinstance(data, bytes) else data
+    ocr_stats: Counter = Counter()
+    with pdfplumber.open(file) as doc:
+        docs = [parser._parse_page(page, doc, source, deadline, ocr_stats) for page in doc.pages[start:end]]
+    return docs, ocr_stats
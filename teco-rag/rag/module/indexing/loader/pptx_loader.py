@@ -4,7 +4,7 @@ from typing import Iterator, List
 from langchain_core.document_loaders import BaseLoader
 from langchain_core.documents import Document
 
-from rag.module.indexing.loader.utils.pptx import partition_pptx
+from rag.module.indexing.loader.utils.pptx import iter_pptx_elements
 
 
 class CustomizedPPTXLoader(BaseLoader):
@@ -29,13 +29,6 @@ class CustomizedPPTXLoader(BaseLoader):
         """
         self.file_path = file_path
         self.file_name = os.path.basename(file_path)
-        # 使用上下文管理器打开文件
-        with open(file_path, "rb") as f:
-            self.elements = partition_pptx(
-                file=f, 
-                include_metadata=True,
-                include_page_breaks=True
-            )
 
     def _process_element_text(self, element) -> str:
         """处理PPT元素文本.
@@ -55,36 +48,37 @@ class CustomizedPPTXLoader(BaseLoader):
         else:
             return f"{prefix}{element.category}"
 
-    def lazy_load(self) -> Iterator[Document]:
-        """惰性加载PPT内容.
-        
+    def _iter_pages(self) -> Iterator[Document]:
+        """逐页解析PPT, 文件只在迭代期间保持打开.
+
         Yields:
             Document: 包含PPT页面内容的文档对象
         """
         current_page = 0
         page_content = []  # 使用列表存储页面内容,避免频繁字符串拼接
-        
-        for element in self.elements:
-            if element.category == "PageBreak":
-                current_page += 1
-                content = "\n".join(page_content)
-                if len(content) > self.min_content_length:
-                    yield Document(
-                        content,
-                        metadata={
-                            "page_number": current_page, 
-                            "file_name": self.file_name
-                        }
-                    )
-                page_content = []
-                continue
-                
-            text = self._process_element_text(element)
-            if text:
-                # Title作为第一个元素时添加特殊前缀
-                if element.category == "Title" and not page_content:
-                    text = f"Title: {element.text}"
-                page_content.append(text)
+
+        with open(self.file_path, "rb") as f:
+            for element in iter_pptx_elements(file=f, include_page_breaks=True):
+                if element.category == "PageBreak":
+                    current_page += 1
+                    content = "\n".join(page_content)
+                    if len(content) > self.min_content_length:
+                        yield Document(
+                            content,
+                            metadata={
+                                "page_number": current_page, 
+                                "file_name": self.file_name
+                            }
+                        )
+                    page_content = []
+                    continue
+
+                text = self._process_element_text(element)
+                if text:
+                    # Title作为第一个元素时添加特殊前缀
+                    if element.category == "Title" and not page_content:
+                        text = f"Title: {element.text}"
+                    page_content.append(text)
 
         # 处理最后一页
         if page_content:
@@ -99,14 +93,27 @@ class CustomizedPPTXLoader(BaseLoader):
                     }
                 )
 
+    def lazy_load(self) -> Iterator[Document]:
+        """惰性加载PPT内容.
+
+        逐页生成文档, 只缓存一页用于判断最后一页是否内容过少.
+
+        Yields:
+            Document: 包含PPT页面内容的文档对象
+        """
+        last_doc = None
+        for doc in self._iter_pages():
+            if last_doc is not None:
+                yield last_doc
+            last_doc = doc
+        # 移除最后一页(如果内容过少)
+        if last_doc is not None and len(last_doc.page_content.strip()) >= self.min_content_length * 2:
+            yield last_doc
+
     def load(self) -> List[Document]:
         """加载完整PPT文件.
         
         Returns:
             List[Document]: 包含PPT内容的文档对象列表
         """
-        docs = list(self.lazy_load())
-        # 移除最后一页(如果内容过少)
-        if docs and len(docs[-1].page_content.strip()) < self.min_content_length * 2:
-            docs.pop()
-        return docs
+        return list(self.lazy_load())
@@ -1,5 +1,6 @@
-from typing import List, Optional, Type
+from typing import Iterator, List, Optional, Type
 
+from langchain_community.document_loaders.blob_loaders import Blob
 from langchain_core.document_loaders import BaseLoader
 from langchain_core.documents import Document
 
@@ -8,6 +9,7 @@ from rag.module.indexing.loader.converters.markdown_converter import (
     HandbookToMarkdownConverter,
     MarkdownPost,
     GovernmentPolicyPDFConverter,
+    SharedPDF,
     TablePDFConverter,
 )
 
@@ -20,8 +22,12 @@ class CustomizedSmartLoader(BaseLoader):
     - 政府政策文档 (Government Policy)
     - 表格文档 (Table)
     - 其他PDF文档
+
+    文件只打开一次: 分类时各转换器的规则都读取同一个共享句柄上的前几页文本探针,
+    选定转换器(或默认解析器)后在同一个句柄上完成整篇解析。
     """
 
+    # 分类规则表, 按顺序匹配, 第一个命中的转换器负责解析
     all_converter_classes: List[Type[BaseConverter]] = [
         HandbookToMarkdownConverter, 
         GovernmentPolicyPDFConverter, 
@@ -36,18 +42,27 @@ class CustomizedSmartLoader(BaseLoader):
         """
         self.file_path = file_path
 
-    def get_converter(self) -> Optional[BaseConverter]:
+    def get_converter(self, pdf: Optional[SharedPDF] = None) -> Optional[BaseConverter]:
         """获取适用于当前文件的转换器
         
+        Args:
+            pdf: 共享的PDF句柄, 不传时新建一个
+
         Returns:
             BaseConverter: 匹配的转换器实例,如果没有匹配则返回None
         """
+        pdf = pdf if pdf is not None else SharedPDF(self.file_path)
         for converter in self.all_converter_classes:
-            converter_instance = converter(self.file_path)
-            if converter_instance.is_my_file():
-                return converter_instance
+            if converter.match(self.file_path, pdf):
+                return converter(self.file_path, pdf=pdf)
         return None
 
+    def _default_parser(self):
+        """没有匹配的转换器时使用的默认PDF解析器"""
+        from rag.module.indexing.loader.plumber_pdf_loader import PDFPlumberParser
+
+        return PDFPlumberParser(extract_images=True, dedupe=True, text_kwargs={"layout": False, "y_tolerance": 7})
+
     def load(self) -> List[Document]:
         """加载文档并转换为统一的Document格式
         
@@ -56,17 +71,32 @@ class CustomizedSmartLoader(BaseLoader):
         Returns:
             List[Document]: 转换后的文档列表
         """
-        converter = self.get_converter()
-        if not converter:  # 默认就用我之前定义的pdf解析器
-            from rag.module.indexing.loader.plumber_pdf_loader import CustomizedPDFPlumberLoader
-
-            plumber_pdf_loader = CustomizedPDFPlumberLoader(self.file_path, extract_images=True, dedupe=True, text_kwargs={"layout": False, "y_tolerance": 7})
-            return plumber_pdf_loader.load()
-        # markdown统一转成有知识路径的
-        print(converter.__class__.__name__)
-        markdown_content = converter.convert_to_markdown()
+        with SharedPDF(self.file_path) as pdf:
+            converter = self.get_converter(pdf)
+            if not converter:  # 默认就用我之前定义的pdf解析器
+                return self._default_parser().parse_pdf(pdf.pdf, Blob.from_path(self.file_path))
+            # markdown统一转成有知识路径的
+            print(converter.__class__.__name__)
+            markdown_content = converter.convert_to_markdown()
         return self.__add_knowledge_path(markdown_content)
 
+    def lazy_load(self) -> Iterator[Document]:
+        """惰性加载文档
+
+        默认解析器逐页生成文档; 转换器需要完整的markdown才能确定标题层级, 转换后按知识路径分段生成。
+
+        Yields:
+            Document: 转换后的文档
+        """
+        with SharedPDF(self.file_path) as pdf:
+            converter = self.get_converter(pdf)
+            if not converter:
+                yield from self._default_parser().lazy_parse_pdf(pdf.pdf, Blob.from_path(self.file_path))
+                return
+            print(converter.__class__.__name__)
+            markdown_content = converter.convert_to_markdown()
+        yield from self.__add_knowledge_path(markdown_content)
+
     def __add_knowledge_path(self, markdown_content: str) -> List[Document]:
         """给markdown内容添加知识路径
         
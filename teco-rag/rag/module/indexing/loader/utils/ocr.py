@@ -25,12 +25,62 @@
 # OF SUCH DAMAGE.
 
 
+import hashlib
+import importlib.util
+import json
+import os
 import re
-from typing import Any, Optional
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from io import BytesIO
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+from rag.common.configuration import settings
+from rag.common.utils import logger
+from rag.connector.database.base import KB_ROOT_PATH
 
 # 全局变量用于缓存 RapidOCR 实例
 _rapid_ocr_instance: Optional[Any] = None
 
+# OCR结果缓存, 同一张图片(解码后内容相同)在整个语料中只识别一次
+OCR_CACHE_PATH = os.path.join(KB_ROOT_PATH, "ocr_cache.db")
+OCR_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# 进程内累计的页面OCR决策计数: ocr 为做了OCR的页数, native 为只用原生文本的页数
+_ocr_page_stats: Counter = Counter()
+_ocr_page_stats_lock = threading.Lock()
+
+
+def _ocr_engine() -> str:
+    """当前环境使用的 OCR 引擎, 优先使用 rapidocr_paddle"""
+    if importlib.util.find_spec("rapidocr_paddle") is not None:
+        return "rapidocr_paddle"
+    return "rapidocr_onnxruntime"
+
+
+def create_rapid_ocr(use_cuda: bool = True) -> Any:
+    """新建 RapidOCR 实例, 每个实例持有独立的推理会话
+
+    Args:
+        use_cuda (bool): 是否使用 CUDA 加速。默认为 True。
+
+    Returns:
+        Any: RapidOCR 实例对象
+    """
+    if _ocr_engine() == "rapidocr_paddle":
+        from rapidocr_paddle import RapidOCR
+
+        return RapidOCR(det_use_cuda=use_cuda, cls_use_cuda=use_cuda, rec_use_cuda=use_cuda)
+
+    from rapidocr_onnxruntime import RapidOCR
+
+    return RapidOCR()
+
 
 def get_rapid_ocr(use_cuda: bool = True) -> Any:
     """获取 RapidOCR 实例，支持 CUDA 加速
@@ -43,23 +93,229 @@ def get_rapid_ocr(use_cuda: bool = True) -> Any:
     """
     global _rapid_ocr_instance
 
-    if _rapid_ocr_instance is not None:
-        return _rapid_ocr_instance
+    if _rapid_ocr_instance is None:
+        _rapid_ocr_instance = create_rapid_ocr(use_cuda)
+    return _rapid_ocr_instance
+
+
+@lru_cache
+def get_ocr_cache():
+    """OCR结果的持久化缓存, 复用llm输出缓存的sqlite实现, 打开失败时不启用缓存"""
+    from rag.connector.llm.completion_cache import CompletionCache
 
     try:
-        from rapidocr_paddle import RapidOCR
+        return CompletionCache(path=OCR_CACHE_PATH, max_size=OCR_CACHE_MAX_SIZE)
+    except Exception as e:
+        logger.error(f"{e.__class__.__name__}: OCR缓存初始化失败, 不使用缓存", exc_info=e)
+        return None
 
-        _rapid_ocr_instance = RapidOCR(
-            det_use_cuda=use_cuda, cls_use_cuda=use_cuda, rec_use_cuda=use_cuda
-        )
-    except ImportError:
-        from rapidocr_onnxruntime import RapidOCR
 
-        _rapid_ocr_instance = RapidOCR()
+def _image_digest(img: Any) -> str:
+    """图片内容的sha256: 已编码的图片取原始字节, 其余按解码后的像素、形状和类型计算"""
+    if isinstance(img, (bytes, bytearray)):
+        return hashlib.sha256(img).hexdigest()
+    array = np.ascontiguousarray(np.asarray(img))
+    digest = hashlib.sha256(f"{array.shape}{array.dtype}".encode("utf-8"))
+    digest.update(array.tobytes())
+    return digest.hexdigest()
 
-    return _rapid_ocr_instance
+
+def downscale(img: Any, max_side: int) -> np.ndarray:
+    """解码图片并等比缩放, 使最长边不超过 max_side (max_side 为 0 时不缩放)"""
+    if isinstance(img, (bytes, bytearray)):
+        from PIL import Image
+
+        array = np.array(Image.open(BytesIO(img)).convert("RGB"))
+    else:
+        array = np.asarray(img)
+    height, width = array.shape[:2]
+    if max_side and max(height, width) > max_side:
+        import cv2
+
+        scale = max_side / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        array = cv2.resize(array, size, interpolation=cv2.INTER_AREA)
+    return array
 
 
+class OCRService:
+    """OCR服务层
+
+    图片先查缓存, 未命中的缩放到 max_side 以内后按 batch_size 分批交给 num_workers 个工作线程,
+    每个线程持有自己的 RapidOCR 实例(独立的推理会话, 推理时释放GIL, 可以并行)。
+    调用方可以传入截止时间, 超时未完成的图片返回 None, 由调用方回退为原生文本。
+
+    Args:
+        num_workers (int): OCR 工作线程数
+        batch_size (int): 每批交给一个工作线程的图片数
+        max_side (int): 识别前图片最长边的上限, 0 表示不缩放
+        use_cuda (bool): 是否使用 CUDA 加速
+    """
+
+    def __init__(self, num_workers: int = 2, batch_size: int = 8, max_side: int = 1600, use_cuda: bool = True):
+        self.num_workers = max(1, num_workers)
+        self.batch_size = max(1, batch_size)
+        self.max_side = max_side
+        self.use_cuda = use_cuda
+        # 参与缓存key, 换引擎或缩放尺寸后不会命中旧结果
+        self.settings = {"engine": _ocr_engine(), "use_cuda": use_cuda, "max_side": max_side}
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="ocr")
+
+    def _instance(self) -> Any:
+        """当前工作线程的 RapidOCR 实例"""
+        ocr = getattr(self._local, "ocr", None)
+        if ocr is None:
+            ocr = self._local.ocr = create_rapid_ocr(self.use_cuda)
+        return ocr
+
+    def _key(self, img: Any) -> str:
+        raw = json.dumps([self.settings, _image_digest(img)], sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _recognize(self, images: Sequence[Any], keys: Sequence[Optional[str]]) -> List[Optional[List[list]]]:
+        """在工作线程中识别一批图片并写入缓存, 超时后才完成的批次结果同样会被缓存"""
+        ocr = self._instance()
+        cache = get_ocr_cache()
+        results = []
+        for img, key in zip(images, keys):
+            try:
+                result, _ = ocr(downscale(img, self.max_side))
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: OCR识别失败", exc_info=e)
+                results.append(None)
+                continue
+            lines = [
+                [[[float(x), float(y)] for x, y in box], text, float(score)] for box, text, score in result or []
+            ]
+            if cache is not None and key is not None:
+                try:
+                    cache.set(key, json.dumps(lines, ensure_ascii=False))
+                except Exception as e:
+                    logger.error(f"{e.__class__.__name__}: 写入OCR缓存失败", exc_info=e)
+            results.append(lines)
+        return results
+
+    def ocr(self, images: Sequence[Any], deadline: Optional[float] = None) -> List[Optional[List[list]]]:
+        """识别一组图片
+
+        Args:
+            images: 图片列表, numpy数组、PIL图片或已编码的图片字节
+            deadline: 截止时间(time.time()), None 表示不限时
+
+        Returns:
+            List[Optional[List[list]]]: 与输入一一对应的识别结果, 每项为 [文本框坐标, 文本, 置信度] 的列表;
+                识别失败或截止时间前未完成的图片为 None
+        """
+        results: List[Optional[List[list]]] = [None] * len(images)
+        cache = get_ocr_cache()
+        keys: List[Optional[str]] = [self._key(img) if cache is not None else None for img in images]
+        pending = []
+        for i, key in enumerate(keys):
+            cached = None
+            if key is not None:
+                try:
+                    cached = cache.get(key)
+                except Exception as e:
+                    logger.error(f"{e.__class__.__name__}: 读取OCR缓存失败", exc_info=e)
+            if cached is not None:
+                results[i] = json.loads(cached)
+            else:
+                pending.append(i)
+        if not pending:
+            return results
+        if deadline is not None and time.time() >= deadline:
+            logger.warning(f"OCR超出时间预算, 跳过{len(pending)}张图片")
+            return results
+
+        futures = {}
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start : start + self.batch_size]
+            future = self._executor.submit(self._recognize, [images[i] for i in batch], [keys[i] for i in batch])
+            futures[future] = batch
+        timeout = None if deadline is None else max(0.0, deadline - time.time())
+        done, not_done = wait(futures, timeout=timeout)
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            skipped = sum(len(futures[future]) for future in not_done)
+            logger.warning(f"OCR超出时间预算, 跳过{skipped}张图片")
+        for future in done:
+            for i, lines in zip(futures[future], future.result()):
+                results[i] = lines
+        return results
+
+
+@lru_cache
+def get_ocr_service() -> OCRService:
+    """按 settings.ocr 创建进程内共享的OCR服务"""
+    return OCRService(
+        num_workers=settings.ocr.num_workers,
+        batch_size=settings.ocr.batch_size,
+        max_side=settings.ocr.max_side,
+    )
+
+
+def ocr_deadline() -> Optional[float]:
+    """按 settings.ocr.time_budget 计算一篇文档的OCR截止时间, 预算为0时不限时"""
+    if settings.ocr.time_budget and settings.ocr.time_budget > 0:
+        return time.time() + settings.ocr.time_budget
+    return None
+
+
+def should_ocr_page(text: str, page_area: float, image_areas: Sequence[float]) -> bool:
+    """判断页面是否需要OCR
+
+    页面没有图片时不需要; 最大的图片覆盖页面面积超过 settings.ocr.image_coverage_threshold (扫描页)时需要;
+    否则只在原生文本密度(每 100x100 pt 的非空白字符数)低于 settings.ocr.text_density_threshold 时需要,
+    文本层完整的页面上图片里的文字通常与正文重复。
+
+    Args:
+        text: 页面的原生文本
+        page_area: 页面面积 (pt²)
+        image_areas: 页面上各图片的显示面积 (pt²)
+
+    Returns:
+        bool: 是否需要OCR
+    """
+    if not image_areas or page_area <= 0:
+        return False
+    if max(image_areas) / page_area >= settings.ocr.image_coverage_threshold:
+        return True
+    text_density = len(re.sub(r"\s", "", text or "")) / page_area * 10000
+    return text_density < settings.ocr.text_density_threshold
+
+
+def record_ocr_pages(source: str, ocr_pages: int, native_pages: int):
+    """记录一篇文档的页面OCR决策, 并输出本文档及进程内累计的计数, 用于按语料调整阈值"""
+    with _ocr_page_stats_lock:
+        _ocr_page_stats["ocr"] += ocr_pages
+        _ocr_page_stats["native"] += native_pages
+        total_ocr, total_native = _ocr_page_stats["ocr"], _ocr_page_stats["native"]
+    logger.info(
+        f"{source}: OCR页数 {ocr_pages}, 原生文本页数 {native_pages}; "
+        f"累计OCR页数 {total_ocr}, 累计原生文本页数 {total_native}"
+    )
+
+
+def get_ocr_page_stats() -> dict:
+    """进程内累计的页面OCR决策计数"""
+    with _ocr_page_stats_lock:
+        return {"ocr": _ocr_page_stats["ocr"], "native": _ocr_page_stats["native"]}
+
+
+def ocr_image(img: Any, deadline: Optional[float] = None) -> List[list]:
+    """识别单张图片, 结果按图片内容和OCR设置缓存
+
+    Args:
+        img: 图片, numpy数组、PIL图片或已编码的图片字节
+        deadline: 截止时间(time.time()), None 表示不限时
+
+    Returns:
+        List[list]: 识别结果, 每项为 [文本框坐标, 文本, 置信度], 没有识别到文本或超时时为空列表
+    """
+    return get_ocr_service().ocr([img], deadline)[0] or []
+
 def filter_text(text: str, max_length: int = 30) -> bool:
     """过滤文本内容，对于长文本要求必须包含中文字符
 
@@ -75,11 +331,13 @@ def filter_text(text: str, max_length: int = 30) -> bool:
 
 def extract_from_images_with_rapidocr(
     images,
+    deadline: Optional[float] = None,
 ) -> str:
     """使用 RapidOCR 从图片中提取文本
 
     Args:
         images: 需要提取文本的图片列表
+        deadline: 截止时间(time.time()), 超时未识别的图片被跳过
 
     Returns:
         str: 从图片中提取的文本内容，多个文本片段以换行符分隔
@@ -94,17 +352,14 @@ def extract_from_images_with_rapidocr(
             "`rapidocr-onnxruntime` package not found, please install it with "
             "`pip install rapidocr-onnxruntime`"
         )
-    ocr = get_rapid_ocr()
     all_text = ""
-    for img in images:
-        try:
-            result, _ = ocr(img)
-            if result:
-                for res in result:
-                    _, text, score = res
-
-                    if score > 0.6 and filter_text(text):
-                        all_text += "\n" + text
-        except Exception as e:
-            print(e)
+    if not images:
+        return all_text
+    for result in get_ocr_service().ocr(images, deadline):
+        if result:
+            for res in result:
+                _, text, score = res
+
+                if score > 0.6 and filter_text(text):
+                    all_text += "\n" + text
     return all_text
@@ -143,6 +143,36 @@ def partition_pptx(
     return list(_PptxPartitioner.iter_presentation_elements(opts))
 
 
+def iter_pptx_elements(
+    filename: str | None = None,
+    *,
+    file: IO[bytes] | None = None,
+    include_page_breaks: bool = True,
+    include_slide_notes: bool | None = None,
+    infer_table_structure: bool = True,
+    starting_page_number: int = 1,
+    strategy: str = PartitionStrategy.FAST,
+) -> Iterator[Element]:
+    """按文档顺序逐个生成 PowerPoint (.pptx) 文档元素
+
+    与 partition_pptx 参数相同, 但不会一次性解析整个文件, 也不做文件级元数据补充和分块,
+    文件对象在迭代结束前需要保持打开。
+
+    Returns:
+        Iterator[Element]: 文档元素迭代器
+    """
+    opts = PptxPartitionerOptions(
+        file=file,
+        file_path=filename,
+        include_page_breaks=include_page_breaks,
+        include_slide_notes=include_slide_notes,
+        infer_table_structure=infer_table_structure,
+        strategy=strategy,
+        starting_page_number=starting_page_number,
+    )
+    return _PptxPartitioner.iter_presentation_elements(opts)
+
+
 class _PptxPartitioner:
     """Provides `.partition()` for PowerPoint 2007+ (.pptx) files."""
 
@@ -24,15 +24,84 @@
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
+import re
+import time
 import uuid
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
+import tqdm
 from langchain.prompts import PromptTemplate
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from rag.common.configuration import settings
 from rag.common.utils import logger
-from rag.connector.base import llm
+from rag.connector.base import batch_llm
+from rag.connector.llm.completion_cache import CompletionCache, get_completion_cache, llm_params
+from rag.module.indexing.splitter.utils import get_length_function
+
+
+def invoke_with_retry(prompt: str) -> str:
+    """调用llm, 失败时按1s、2s、4s...退避重试, 超过重试次数后抛出最后一次的异常
+
+    推理服务出错时llm会吞掉异常并返回空字符串, 因此空白输出同样视为失败并重试
+    """
+    max_retries = settings.llm.max_retries
+    for attempt in range(max_retries + 1):
+        try:
+            result = batch_llm.invoke(prompt)
+            if not result or not result.strip():
+                raise ValueError("llm返回空结果")
+            return result
+        except Exception as e:
+            if attempt == max_retries:
+                raise e
+            logger.warning(f"调用llm失败({e.__class__.__name__}: {e}), {2 ** attempt}s 后第{attempt + 1}次重试")
+            time.sleep(2 ** attempt)
+
+
+def batch_invoke(prompts: List[str], template: str, desc: str = "") -> List[Optional[str]]:
+    """并发调用llm, 同时在途的请求数不超过 settings.llm.max_concurrency, 返回结果与prompts顺序一致
+    命中磁盘缓存的prompt不再请求llm
+
+    Args:
+        prompts (List[str]): prompt列表
+        template (str): 生成prompt的模板, 参与缓存key
+        desc (str): 进度条描述
+
+    Returns:
+        List[Optional[str]]: llm输出列表, 重试后仍失败的prompt对应None, 不写入缓存
+    """
+    if not prompts:
+        return []
+    cache = get_completion_cache()
+    params = llm_params(batch_llm)
+    keys = [CompletionCache.make_key(params, template, prompt) for prompt in prompts]
+    results = [cache.get(key) for key in keys] if cache is not None else [None] * len(prompts)
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    with ThreadPoolExecutor(max_workers=max(1, settings.llm.max_concurrency)) as pool:
+        # pool.map按提交顺序返回结果, 进度按完成顺序更新
+        with tqdm.tqdm(total=len(missing), desc=desc) as b_unit:
+            def invoke(i):
+                try:
+                    result = invoke_with_retry(prompts[i])
+                except Exception as e:
+                    logger.error(f"{e.__class__.__name__}: {desc} 重试{settings.llm.max_retries}次后仍失败",
+                                 exc_info=e)
+                    result = None
+                if cache is not None and result is not None:
+                    cache.set(keys[i], result)
+                b_unit.update(1)
+                return result
+            for i, result in zip(missing, pool.map(invoke, missing)):
+                results[i] = result
+    if cache is not None:
+        cache.flush()
+    failed = sum(result is None for result in results)
+    logger.info(f"{desc} 完成, 共 {len(prompts)} 条, 命中缓存 {len(prompts) - len(missing)} 条, 失败 {failed} 条")
+    return results
 
 
 def split_smaller_chunks(documents: List[Document], smaller_chunk_size: int):
@@ -49,9 +118,9 @@ def split_smaller_chunks(documents: List[Document], smaller_chunk_size: int):
     doc_ids = [doc.metadata["id"] for doc in documents]
     tot_docs = []
 
-    # 创建一个新的分词器用于二次切分
+    # 创建一个新的分词器用于二次切分, 与一级切分使用相同的长度单位
     child_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=smaller_chunk_size, chunk_overlap=0
+        chunk_size=smaller_chunk_size, chunk_overlap=0, length_function=get_length_function()
     )
 
     # 遍历每个文档进行切分
@@ -80,13 +149,16 @@ TEXT_SUMMARY_TEMPLATE = """你是一位阅读能手，善于对总结归纳文
 
 def generate_text_summaries(documents: List[Document]):
     doc_ids = [doc.metadata["id"] for doc in documents]
+    template = PromptTemplate.from_template(TEXT_SUMMARY_TEMPLATE)
+    prompts = [template.format(text=doc.page_content) for doc in documents]
+    summaries = batch_invoke(prompts, TEXT_SUMMARY_TEMPLATE, desc="生成摘要")
     tot_docs = []
-    for i, doc in enumerate(documents):
-        prompt = PromptTemplate.from_template(TEXT_SUMMARY_TEMPLATE).format(
-            text=doc.page_content
-        )
+    for i, summary in enumerate(summaries):
+        # 生成失败的摘要不入库, 原文chunk仍可被检索
+        if summary is None:
+            continue
         parent_id = doc_ids[i]
-        summary_doc = Document(llm.invoke(prompt))
+        summary_doc = Document(summary)
         summary_doc.metadata["id"] = str(uuid.uuid4())
         summary_doc.metadata["parent_id"] = parent_id
         summary_doc.metadata["multi_vector_type"] = "text summary"
@@ -102,12 +174,14 @@ TABLE_SUMMARY_TEMPLATE = """你是一位阅读能手，善于对总结归纳文
 
 
 def generate_table_summaries(documents: List[Document]):
+    template = PromptTemplate.from_template(TABLE_SUMMARY_TEMPLATE)
+    prompts = [template.format(table=doc.page_content) for doc in documents]
+    summaries = batch_invoke(prompts, TABLE_SUMMARY_TEMPLATE, desc="生成表格摘要")
     tot_docs = []
-    for i, doc in enumerate(documents):
-        prompt = PromptTemplate.from_template(TABLE_SUMMARY_TEMPLATE).format(
-            table=doc.page_content
-        )
-        summary_doc = Document(llm.invoke(prompt))
+    for summary in summaries:
+        if summary is None:
+            continue
+        summary_doc = Document(summary)
         summary_doc.metadata["id"] = str(uuid.uuid4())
         summary_doc.metadata["multi_vector_type"] = "table summary"
         tot_docs.append(summary_doc)
@@ -129,32 +203,113 @@ CONTEXTUAL_TEMPLATE = """
 """
 
 
-def generate_contextual(chunks: List[Document]):
-    tot_docs = []
-    for i in range(len(chunks)):
-        # 获取当前chunk
-        current_chunk = chunks[i]
+CONTEXTUAL_WINDOW_TEMPLATE = """
+你的任务是为文档中的若干个chunk分别提供一个简短的上下文，以便改进这些chunk在rag的时候能够rag到
+<document>
+{document}
+</document>
+这是我们想要在整个文档中搜索的{n}个块
+{chunks}
+请为每个块分别提供一个简短的上下文，以在整个文档中检索到该块，每个上下文不超过50字，
+按如下格式逐行回答，而不用其他任何东西：
+{answer_format}
+"""
 
-        # 获取前后两个chunk
-        start_index = max(0, i - 2)
-        end_index = min(len(chunks), i + 3)
-        nearby_chunks = chunks[start_index:end_index]
+_CONTEXT_PATTERN = re.compile(r'<context id="(\d+)">(.*?)</context>', re.S)
 
-        # 将附近的chunk内容合并为total_text
-        total_text = "\n\n".join([chunk.page_content for chunk in nearby_chunks])
 
-        # 生成上下文
-        context_prompt = CONTEXTUAL_TEMPLATE.format(
-            total_text=total_text, chunk=current_chunk.page_content
-        )
+def _nearby_contextual_prompt(chunks: List[Document], i: int) -> str:
+    """以前后两个chunk作为文档内容, 为第i个chunk生成prompt"""
+    # 获取前后两个chunk
+    start_index = max(0, i - 2)
+    end_index = min(len(chunks), i + 3)
+    nearby_chunks = chunks[start_index:end_index]
 
-        # 这里可以调用llm.invoke来处理context_prompt并生成上下文文档
-        contextual = llm.invoke(context_prompt)
+    # 将附近的chunk内容合并为total_text
+    total_text = "\n\n".join([chunk.page_content for chunk in nearby_chunks])
+    return CONTEXTUAL_TEMPLATE.format(total_text=total_text, chunk=chunks[i].page_content)
 
+
+def _split_segments(chunks: List[Document], max_document_chars: int) -> List[range]:
+    """将连续的chunk按总字数不超过max_document_chars划分为文档片段, 每个片段至少包含一个chunk"""
+    segments, start, length = [], 0, 0
+    for i, chunk in enumerate(chunks):
+        if i > start and length + len(chunk.page_content) > max_document_chars:
+            segments.append(range(start, i))
+            start, length = i, 0
+        length += len(chunk.page_content)
+    if start < len(chunks):
+        segments.append(range(start, len(chunks)))
+    return segments
+
+
+def _generate_window_contextual(chunks: List[Document], window_size: int, max_document_chars: int):
+    """按窗口批量生成上下文
+
+    连续的chunk组成文档片段, 片段内每window_size个chunk发送一次请求, 同一片段的请求共享相同的
+    <document>前缀(可以命中推理服务的prefix cache), 每个chunk的文本只在所属片段中出现。
+
+    Returns:
+        List[str]: 每个chunk的上下文, 解析失败的为None
+    """
+    prompts, windows = [], []
+    for segment in _split_segments(chunks, max_document_chars):
+        document = "\n\n".join([chunks[i].page_content for i in segment])
+        for start in range(segment.start, segment.stop, window_size):
+            window = range(start, min(start + window_size, segment.stop))
+            chunk_text = "\n".join([f'<chunk id="{j + 1}">\n{chunks[i].page_content}\n</chunk>'
+                                    for j, i in enumerate(window)])
+            answer_format = "\n".join([f'<context id="{j + 1}">上下文</context>' for j in range(len(window))])
+            prompts.append(CONTEXTUAL_WINDOW_TEMPLATE.format(
+                document=document, n=len(window), chunks=chunk_text, answer_format=answer_format
+            ))
+            windows.append(window)
+
+    contextuals = [None] * len(chunks)
+    for window, response in zip(windows, batch_invoke(prompts, CONTEXTUAL_WINDOW_TEMPLATE,
+                                                      desc="按窗口生成chunk上下文")):
+        for chunk_id, contextual in _CONTEXT_PATTERN.findall(response or ""):
+            j = int(chunk_id) - 1
+            if 0 <= j < len(window) and contextual.strip():
+                contextuals[window[j]] = contextual.strip()
+    return contextuals
+
+
+def generate_contextual(chunks: List[Document], window_size: int = 0, max_document_chars: int = 4000):
+    """为每个chunk生成上下文并拼接到chunk内容前
+
+    Args:
+        chunks (List[Document]): 同一文件切分后的chunk列表, 按原文顺序排列
+        window_size (int): 大于0时开启文档级上下文, 每次请求为window_size个chunk生成上下文;
+            为0时每个chunk单独请求, 以前后两个chunk作为文档内容
+        max_document_chars (int): 文档级上下文中<document>的最大字数
+
+    Returns:
+        List[Document]: 拼接上下文后的chunk列表
+    """
+    if window_size > 0:
+        contextuals = _generate_window_contextual(chunks, window_size, max_document_chars)
+    else:
+        contextuals = [None] * len(chunks)
+
+    # 未开启窗口或窗口结果解析失败的chunk, 逐个请求
+    missing = [i for i, contextual in enumerate(contextuals) if contextual is None]
+    if window_size > 0 and missing:
+        logger.warning(f"{len(missing)} 个chunk的上下文解析失败, 改为逐个生成")
+    context_prompts = [_nearby_contextual_prompt(chunks, i) for i in missing]
+
+    # 并发调用llm生成每个chunk的上下文
+    for i, contextual in zip(missing, batch_invoke(context_prompts, CONTEXTUAL_TEMPLATE,
+                                                   desc="生成chunk上下文")):
+        contextuals[i] = contextual
+
+    tot_docs = []
+    for current_chunk, contextual in zip(chunks, contextuals):
         # 将contextual与当前chunk的page_content合并
-        logger.info(f"contextual: {contextual}")
-        logger.info(f"current_chunk.page_content: {current_chunk.page_content}")
-        combined_content = f"{contextual}:{current_chunk.page_content}"
+        logger.debug(f"contextual: {contextual}")
+        # 上下文生成失败时保留原始内容, 不拼接"None:"
+        combined_content = f"{contextual}:{current_chunk.page_content}" if contextual is not None \
+            else current_chunk.page_content
 
         # 创建新的Document对象
         context_doc = Document(page_content=combined_content)
@@ -26,33 +26,28 @@
 
 # -*- coding: utf-8 -*-
 import re
-from typing import List, Optional, Any, Iterable
+from typing import List, Optional, Any, Iterable, Pattern, Tuple
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 from rag.common.utils import nltk, logger
+from rag.module.indexing.splitter.utils import batch_lengths
 
+# 在 pos/endpos 窗口上匹配时, 这些语法会受窗口外字符或窗口起点的影响, 需要在子串上匹配
+_WINDOW_UNSAFE_SYNTAX = ("^", "\\A", "\\b", "\\B", "(?<")
+# 切分结果的最终清理: 合并连续空行
+_MULTI_NEWLINE = re.compile(r"\n{2,}")
 
-def _split_text_with_regex_from_end(
-        text: str, separator: str, keep_separator: bool
-) -> List[str]:
-    if separator:
-        if keep_separator:
-            # 根据分隔符对文本进行拆分, 并且保留分隔符
-            _splits = re.split(f"({separator})", text)
-            splits = [_splits[0]]
-            for i in range(1, len(_splits), 2):
-                split_char = _splits[i]
-                next_content = _splits[i + 1]
-                split = split_char + next_content
-                splits.append(split)
-        else:
-            splits = re.split(separator, text)
-    else:
-        splits = list(text)
-    return [s for s in splits if s != ""]
+_CompiledSeparator = Tuple[str, Optional[Pattern], bool]
 
 
 class ChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
+    """中文递归文本分割器
+
+    分隔符在初始化时编译一次。每一层递归只在当前片段的偏移区间 [start, end) 上匹配(pos/endpos),
+    选中分隔符后用一次 finditer 得到全部切分位置, 片段以原文中的偏移表示, 只有参与合并的片段才复制成字符串;
+    chunk 的 strip 与空行合并只在最外层做一次。输出与逐层 re.search/re.split 的实现一致。
+    """
+
     def __init__(
             self,
             separators: Optional[List[str]] = None,
@@ -75,45 +70,113 @@ class ChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
             # "\n"
         ]
         self._is_separator_regex = is_separator_regex
+        self._compiled_separators = self._compile_separators(self._separators)
+
+    def _compile_separators(self, separators: List[str]) -> List[_CompiledSeparator]:
+        """编译分隔符, 返回 (原始分隔符, 编译后的正则, 是否需要在子串上匹配)"""
+        compiled = []
+        for separator in separators:
+            if separator == "":
+                compiled.append((separator, None, False))
+                continue
+            pattern = separator if self._is_separator_regex else re.escape(separator)
+            unsafe = any(syntax in pattern for syntax in _WINDOW_UNSAFE_SYNTAX)
+            compiled.append((separator, re.compile(pattern), unsafe))
+        return compiled
 
     def _split_text(self, text: str, separators: List[str]) -> List[str]:
         """Split incoming text and return chunks."""
+        if separators is self._separators:
+            compiled = self._compiled_separators
+        else:
+            compiled = self._compile_separators(separators)
+        chunks = self._split_span(text, 0, len(text), compiled)
+        return [_MULTI_NEWLINE.sub("\n", chunk.strip()) for chunk in chunks if chunk.strip() != ""]
+
+    @staticmethod
+    def _finditer(
+            compiled: _CompiledSeparator, text: str, start: int, end: int
+    ) -> Iterable[Tuple[int, int]]:
+        """在 text[start:end] 中查找分隔符, 返回原文中的 (起点, 终点) 偏移"""
+        _, pattern, unsafe = compiled
+        if unsafe:
+            return ((m.start() + start, m.end() + start) for m in pattern.finditer(text[start:end]))
+        return (m.span() for m in pattern.finditer(text, start, end))
+
+    @staticmethod
+    def _search(compiled: _CompiledSeparator, text: str, start: int, end: int) -> bool:
+        _, pattern, unsafe = compiled
+        if unsafe:
+            return pattern.search(text[start:end]) is not None
+        return pattern.search(text, start, end) is not None
+
+    def _split_offsets(
+            self, text: str, start: int, end: int, compiled: _CompiledSeparator
+    ) -> List[Tuple[int, int]]:
+        """按分隔符把 [start, end) 切成若干非空区间, 保留分隔符时分隔符归入其后的片段"""
+        separator, pattern, _ = compiled
+        if separator == "":
+            return [(i, i + 1) for i in range(start, end)]
+        offsets = []
+        if self._keep_separator:
+            # 每个片段从分隔符的起点开始
+            prev = start
+            for match_start, _ in self._finditer(compiled, text, start, end):
+                offsets.append((prev, match_start))
+                prev = match_start
+            offsets.append((prev, end))
+        else:
+            prev = start
+            for match_start, match_end in self._finditer(compiled, text, start, end):
+                offsets.append((prev, match_start))
+                prev = match_end
+            offsets.append((prev, end))
+        return [(a, b) for a, b in offsets if a < b]
+
+    def _split_span(
+            self, text: str, start: int, end: int, separators: List[_CompiledSeparator]
+    ) -> List[str]:
+        """递归切分 text[start:end], 返回未清理的chunk"""
         final_chunks = []
-        # 取第一个为默认分隔符，剩余为候选分隔符
+        # 取第一个在区间内出现的分隔符，剩余为候选分隔符
         separator = separators[-1]
         new_separators = []
         for i, _s in enumerate(separators):
-            _separator = _s if self._is_separator_regex else re.escape(_s)
-            if _s == "":
+            if _s[0] == "":
                 separator = _s
                 break
-            if re.search(_separator, text):
+            if self._search(_s, text, start, end):
                 separator = _s
                 new_separators = separators[i + 1:]
                 break
 
-        _separator = separator if self._is_separator_regex else re.escape(separator)
-        splits = _split_text_with_regex_from_end(text, _separator, self._keep_separator)
-        
+        splits = self._split_offsets(text, start, end, separator)
+
         _good_splits = []
-        _separator = "" if self._keep_separator else separator
-        for s in splits:
-            if self._length_function(s) < self._chunk_size:
-                _good_splits.append(s)
+        _separator = "" if self._keep_separator else separator[0]
+        for (a, b), length in zip(splits, self._span_lengths(text, splits)):
+            if length < self._chunk_size:
+                _good_splits.append(text[a:b])
             else:
                 if _good_splits:
                     merged_text = self._merge_splits(_good_splits, _separator)
                     final_chunks.extend(merged_text)
                     _good_splits = []
                 if not new_separators:
-                    final_chunks.append(s)
+                    final_chunks.append(text[a:b])
                 else:
-                    other_info = self._split_text(s, new_separators)
+                    other_info = self._split_span(text, a, b, new_separators)
                     final_chunks.extend(other_info)
         if _good_splits:
             merged_text = self._merge_splits(_good_splits, _separator)
             final_chunks.extend(merged_text)
-        return [re.sub(r"\n{2,}", "\n", chunk.strip()) for chunk in final_chunks if chunk.strip()!=""]
+        return final_chunks
+
+    def _span_lengths(self, text: str, spans: List[Tuple[int, int]]) -> List[int]:
+        """计算各片段长度; 按字符计时直接用偏移相减, 否则一次批量计算(结果被缓存, 合并时不再重复编码)"""
+        if self._length_function is len:
+            return [b - a for a, b in spans]
+        return batch_lengths(self._length_function, [text[a:b] for a, b in spans])
 
     def split_documents(self, documents: Iterable[Document]) -> List[Document]:
         """Split documents."""
@@ -122,9 +185,3 @@ class ChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
             texts.append(doc.page_content)
             metadatas.append(doc.metadata)
         return self.create_documents(texts, metadatas=metadatas)
-
-
-
-
-
-
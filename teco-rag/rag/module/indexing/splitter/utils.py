@@ -25,21 +25,118 @@
 # OF SUCH DAMAGE.
 
 
-from typing import List
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
 from langchain_core.documents import Document
+from langchain_text_splitters import TextSplitter
+
+from rag.common.configuration import settings
+from rag.common.utils import logger
+
+
+class TokenLengthFunction:
+    """按tokenizer计算文本的token数, 作为分割器的 length_function
+
+    递归切分时同一片段会被多次计算长度(判断是否超长、合并时累计长度), 结果按文本缓存;
+    batch 一次编码多个未缓存的文本, fast tokenizer 批量编码比逐条调用快得多。
+    """
+
+    def __init__(self, tokenizer, cache_size: int = 100_000):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache: Dict[str, int] = {}
+        # 模型单次可编码的token数(去掉[CLS]/[SEP]等特殊token), 未配置最大长度的tokenizer返回极大的哨兵值
+        model_max_length = getattr(tokenizer, "model_max_length", 0) or 0
+        self.max_tokens: Optional[int] = None
+        if 0 < model_max_length < 1_000_000:
+            self.max_tokens = model_max_length - tokenizer.num_special_tokens_to_add()
+
+    def _store(self, text: str, length: int):
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[text] = length
+
+    def __call__(self, text: str) -> int:
+        length = self._cache.get(text)
+        if length is None:
+            length = len(self.tokenizer.encode(text, add_special_tokens=False))
+            self._store(text, length)
+        return length
+
+    def batch(self, texts: List[str]) -> List[int]:
+        """批量计算token数, 只编码未缓存的文本"""
+        lengths = {text: self._cache.get(text) for text in texts}
+        missing = [text for text, length in lengths.items() if length is None]
+        if missing:
+            input_ids = self.tokenizer(missing, add_special_tokens=False)["input_ids"]
+            for text, ids in zip(missing, input_ids):
+                lengths[text] = len(ids)
+                self._store(text, len(ids))
+        return [lengths[text] for text in texts]
+
+
+@lru_cache
+def get_length_function() -> Callable[[str], int]:
+    """按 settings.text_splitter.length_unit 返回分割器的长度函数
+
+    为 token 时加载embedding模型的tokenizer, 使chunk按embedding模型实际编码的长度切分;
+    加载失败时退化为按字符数。
+    """
+    if settings.text_splitter.length_unit == "token":
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(settings.embeddings.model_name_or_path)
+            return TokenLengthFunction(tokenizer)
+        except Exception as e:
+            msg = f"加载embedding模型tokenizer {settings.embeddings.model_name_or_path} 失败, 按字符数切分"
+            logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+    return len
+
+
+def batch_lengths(length_function: Callable[[str], int], texts: List[str]) -> List[int]:
+    """批量计算长度, 长度函数支持 batch 时一次计算全部文本"""
+    if length_function is len:
+        return [len(text) for text in texts]
+    batch = getattr(length_function, "batch", None)
+    if batch is not None:
+        return batch(texts)
+    return [length_function(text) for text in texts]
 
-def merge_small_chunks(chunks: List[Document], min_chunk_size: int = 80) -> List[Document]:
+
+def fit_chunk_size(chunk_size: int, chunk_overlap: int, length_function: Callable[[str], int]):
+    """按token切分时chunk_size不超过embedding模型的最大输入长度, 避免chunk在向量化时被截断"""
+    max_tokens = getattr(length_function, "max_tokens", None)
+    if max_tokens and chunk_size > max_tokens:
+        logger.warning(f"chunk_size {chunk_size} 超过embedding模型最大输入长度, 按 {max_tokens} 切分")
+        chunk_size = max_tokens
+        chunk_overlap = min(chunk_overlap, chunk_size // 2)
+    return chunk_size, chunk_overlap
+
+
+def merge_small_chunks(chunks: List[Document], min_chunk_size: int = 80,
+                       length_function: Callable[[str], int] = len,
+                       max_chunk_size: Optional[int] = None) -> List[Document]:
     """合并过小的文档块
 
     如果一个chunk内容太少(默认小于80字符),则将其与后续chunk合并,直到达到合适大小。
     这样可以避免过小的chunk缺乏足够语义信息。但是因为后面会添加知识路径和文件名进行embedding,所以可能会召回没有语义的小chunk
     Args:
         chunks: 待处理的文档块列表
-        min_chunk_size: 最小chunk大小,默认80字符
+        min_chunk_size: 最小chunk大小,默认80,单位与length_function一致
+        length_function: 与切分时相同的长度函数, 按token切分时传入 get_length_function() 的结果
+        max_chunk_size: 合并后的最大长度, 一般为切分时的chunk_size, 为None时不限制。
+            token数不满足可加性(拼接处可能合并或拆分token), 每次合并后按拼接后的文本重新计算长度
 
     Returns:
         List[Document]: 合并后的文档块列表
     """
+    def merged_length(text: str, other: str) -> int:
+        return length_function(text + "\n" + other)
+
+    def can_merge(text: str, other: str) -> bool:
+        return max_chunk_size is None or merged_length(text, other) <= max_chunk_size
+
     merged_chunks = []
     i = 0
 
@@ -47,9 +144,10 @@ def merge_small_chunks(chunks: List[Document], min_chunk_size: int = 80) -> List
         current_chunk = chunks[i]
 
         # 如果当前chunk太小且不是最后一个chunk
-        if len(current_chunk.page_content) < min_chunk_size:
-            # 合并当前chunk内容到下一个chunk，直到遇到一个足够大的chunk
-            while i < len(chunks) - 1 and len(current_chunk.page_content) < min_chunk_size * 2:
+        if length_function(current_chunk.page_content) < min_chunk_size:
+            # 合并当前chunk内容到下一个chunk，直到遇到一个足够大的chunk或合并后超过最大长度
+            while i < len(chunks) - 1 and length_function(current_chunk.page_content) < min_chunk_size * 2 \
+                    and can_merge(current_chunk.page_content, chunks[i + 1].page_content):
                 next_chunk = chunks[i + 1]
                 current_chunk.page_content += "\n" + next_chunk.page_content
                 i += 1
@@ -59,9 +157,48 @@ def merge_small_chunks(chunks: List[Document], min_chunk_size: int = 80) -> List
         i += 1
 
     # 处理最后一个chunk，如果它太小则合并到前一个
-    if len(merged_chunks) > 1 and len(merged_chunks[-1].page_content) < min_chunk_size:
+    if len(merged_chunks) > 1 and length_function(merged_chunks[-1].page_content) < min_chunk_size \
+            and can_merge(merged_chunks[-2].page_content, merged_chunks[-1].page_content):
         last_chunk = merged_chunks[-1]
         merged_chunks[-2].page_content += "\n" + last_chunk.page_content
         merged_chunks.pop()
 
     return merged_chunks
+
+
+def split_documents_stream(docs: Iterable[Document], text_splitter: TextSplitter) -> Iterator[Document]:
+    """流式切分文档
+
+    逐个消费加载器生成的页面/段落文档并输出chunk, 不需要先拼出整篇文本。
+    同一来源(metadata["source"])的相邻文档之间, 上一篇的最后一个chunk不立即输出, 而是与下一篇拼接后重新切分,
+    这样跨页的段落仍能落在同一个chunk中, 内存中始终只保留一页文本和一个未完成的chunk。
+
+    Args:
+        docs: 文档迭代器
+        text_splitter: 文本分割器
+
+    Yields:
+        Document: 切分后的文档块, 元数据取自chunk起始处所在的文档
+    """
+    carry_text, carry_metadata = None, None
+    for doc in docs:
+        source = doc.metadata.get("source")
+        if carry_text is not None and source is not None and source == carry_metadata.get("source"):
+            text = carry_text + "\n\n" + doc.page_content
+            first_metadata = carry_metadata
+        else:
+            if carry_text is not None:
+                yield Document(page_content=carry_text, metadata=dict(carry_metadata))
+            text, first_metadata = doc.page_content, doc.metadata
+
+        pieces = text_splitter.split_text(text)
+        if not pieces:
+            carry_text, carry_metadata = None, None
+            continue
+        for i, piece in enumerate(pieces[:-1]):
+            yield Document(page_content=piece, metadata=dict(first_metadata if i == 0 else doc.metadata))
+        carry_text = pieces[-1]
+        carry_metadata = first_metadata if len(pieces) == 1 else doc.metadata
+
+    if carry_text is not None:
+        yield Document(page_content=carry_text, metadata=dict(carry_metadata))
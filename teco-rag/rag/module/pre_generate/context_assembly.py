@@ -0,0 +1,138 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+按token预算组装问答上下文
+
+按召回(rerank)顺序依次放入文档，放不下的文档按句子截断，其余更靠后的文档丢弃；
+完全重复和高度相似的文档只保留排名最靠前的一个。
+"""
+
+import re
+from functools import lru_cache
+from typing import Callable, List, Tuple
+
+from langchain_core.documents import Document
+
+from rag.common.configuration import settings
+from rag.common.utils import logger
+
+_CJK_PATTERN = re.compile(r"[一-鿿　-〿＀-￯]")
+_SENTENCE_PATTERN = re.compile(r"[^。！？；!?;\n]*(?:[。！？；!?;\n]+|$)")
+
+
+def _estimate_tokens(text: str) -> int:
+    """未配置tokenizer时的估算: 中文字符按1个token, 其余按3个字符1个token"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 2) // 3
+
+
+@lru_cache
+def get_token_counter() -> Callable[[str], int]:
+    """按 settings.llm.tokenizer_path 加载目标模型的tokenizer, 加载失败时退化为按字符估算"""
+    if settings.llm.tokenizer_path:
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(settings.llm.tokenizer_path, trust_remote_code=True)
+            return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+        except Exception as e:
+            msg = f"加载tokenizer {settings.llm.tokenizer_path} 失败, 按字符数估算token数"
+            logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+    return _estimate_tokens
+
+
+def _shingles(text: str, n: int = 5) -> set:
+    text = re.sub(r"\s+", "", text)
+    return {text[i: i + n] for i in range(max(1, len(text) - n + 1))}
+
+
+def dedup_docs(docs: List[Document], threshold: float = 0.9) -> List[Document]:
+    """去除完全重复以及字符5-gram Jaccard相似度不低于threshold的文档, 保留排名靠前的"""
+    kept, kept_shingles, seen = [], [], set()
+    for doc in docs:
+        normalized = re.sub(r"\s+", "", doc.page_content)
+        if normalized in seen:
+            continue
+        shingles = _shingles(doc.page_content)
+        if any(len(shingles & s) >= threshold * len(shingles | s) for s in kept_shingles):
+            continue
+        seen.add(normalized)
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def _truncate_sentences(text: str, budget: int, count_tokens: Callable[[str], int]) -> str:
+    """按句子保留text的开头部分, 使其token数不超过budget"""
+    result, used = "", 0
+    for sentence in _SENTENCE_PATTERN.findall(text):
+        if not sentence:
+            continue
+        tokens = count_tokens(sentence)
+        if used + tokens > budget:
+            break
+        result += sentence
+        used += tokens
+    return result
+
+
+def assemble_context(docs: List[Document],
+                     budget: int,
+                     count_tokens: Callable[[str], int] = None,
+                     keep_top_content: bool = False) -> Tuple[str, int]:
+    """在budget个token内组装上下文
+
+    Args:
+        docs (List[Document]): 按相关性从高到低排列的文档
+        budget (int): 上下文可用的token数, 小于等于0时不限制
+        count_tokens: token计数函数, 默认使用 get_token_counter()
+        keep_top_content (bool): 是否在上下文开头额外保留最相关的文档
+
+    Returns:
+        Tuple[str, int]: 上下文及其token数
+    """
+    count_tokens = count_tokens or get_token_counter()
+    docs = dedup_docs(docs)
+    # (片段标题, 片段内容)
+    pieces = [(f"\n\n片段{i}:\n", doc.page_content) for i, doc in enumerate(docs, start=1)]
+    if keep_top_content and docs:  # 最相关的尽量保留因为可能其中的重要信息被删除
+        pieces.insert(0, ("", docs[0].page_content + "\n\n"))
+
+    context, used = "", 0
+    for i, (title, content) in enumerate(pieces):
+        tokens = count_tokens(title + content)
+        if budget <= 0 or used + tokens <= budget:
+            context += title + content
+            used += tokens
+            continue
+        # 放不下的文档按句子截断, 之后排名更低的文档全部丢弃
+        truncated = _truncate_sentences(content, budget - used - count_tokens(title), count_tokens)
+        if truncated.strip():
+            context += title + truncated
+            used += count_tokens(title + truncated)
+        logger.info(f"上下文超出 {budget} tokens, 截断第{i + 1}段, 丢弃其后的 {len(pieces) - i - 1} 段")
+        break
+    return context, used
@@ -24,12 +24,26 @@
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List
 
 from langchain_core.documents import Document
 from langchain_core.prompts.prompt import PromptTemplate
 
-from rag.connector.base import llm
+from rag.common.configuration import settings
+from rag.connector.base import llm, rewrite_llm
+from rag.module.pre_retrieval.rewrite_cache import normalize_query
+
+# 短于该长度的片段不再调用llm抽取, 直接使用原文
+SUMMARY_MIN_LENGTH = 200
+# 关键词缓存的问题数量上限
+KEYWORDS_CACHE_SIZE = 1024
+
+_executor = ThreadPoolExecutor(max_workers=max(1, settings.llm.max_concurrency))
+_keywords_lock = threading.Lock()
+_keywords_cache: "OrderedDict[str, Future]" = OrderedDict()  # normalized query: Future[keywords]
 
 # class SummeryContentOutput(BaseModel):
 #     content: str = Field(description="抽取后的信息")
@@ -59,12 +73,41 @@ KEYWORDS_PROMPT = """
 """
 
 
-def generate_query_keywords(query):
+def _generate_query_keywords(query):
     prompt = KEYWORDS_PROMPT.format(query=query)
-    response = llm.invoke(prompt)
+    response = rewrite_llm.invoke(prompt)
     return response.strip()
 
 
+def prefetch_query_keywords(query: str) -> Future:
+    """
+    在后台开始抽取关键词并按规范化后的问题缓存, 可以在检索之前调用, 与检索并行
+    """
+    key = normalize_query(query)
+    with _keywords_lock:
+        future = _keywords_cache.get(key)
+        if future is not None:
+            _keywords_cache.move_to_end(key)
+            return future
+        future = _executor.submit(_generate_query_keywords, query)
+        _keywords_cache[key] = future
+        while len(_keywords_cache) > KEYWORDS_CACHE_SIZE:
+            _keywords_cache.popitem(last=False)
+    return future
+
+
+def generate_query_keywords(query):
+    future = prefetch_query_keywords(query)
+    try:
+        return future.result()
+    except Exception:
+        # 失败的结果不缓存
+        with _keywords_lock:
+            if _keywords_cache.get(normalize_query(query)) is future:
+                del _keywords_cache[normalize_query(query)]
+        raise
+
+
 def _generate_summery_content(keywords, content):
     # 2. 进行总结抽取, 如果
     prompt = DEFAULT_SUMMARY_PROMPT.format(
@@ -79,13 +122,20 @@ def _generate_summery_content(keywords, content):
 def generate_summery_content(query: str, docs: List[Document]):
     """
     生成精简后的内容。
+    每个片段并行抽取, 短于 SUMMARY_MIN_LENGTH 的片段直接使用原文。
     """
     # Set up a parser
     # parser = PydanticOutputParser(pydantic_object=SummeryContentOutput)
-    # 1. 生成关键词
+    # 1. 生成关键词, 若请求开始时已调用prefetch_query_keywords, 这里直接取结果
     keywords = generate_query_keywords(query)
+    # 2. 逐个片段并行抽取
+    futures = [
+        _executor.submit(_generate_summery_content, keywords, doc.page_content)
+        if len(doc.page_content) >= SUMMARY_MIN_LENGTH else None
+        for doc in docs
+    ]
     total_context = ""
-    for i, doc in enumerate(docs, start=1):
-        total_context += f"\n\n片段{i}:\n{doc.page_content}"
-    summery_content = _generate_summery_content(keywords, total_context)
-    return summery_content.strip()
+    for i, (doc, future) in enumerate(zip(docs, futures), start=1):
+        content = future.result() if future is not None else doc.page_content
+        total_context += f"\n\n片段{i}:\n{content}"
+    return total_context.strip()
@@ -25,7 +25,10 @@
 # OF SUCH DAMAGE.
 
 from langchain_core.prompts.prompt import PromptTemplate
-from rag.connector.base import llm
+from rag.connector.base import rewrite_llm
+from rag.module.pre_retrieval.rewrite_cache import TTLCache, normalize_query
+
+_hyde_cache = TTLCache()
 
 # Default prompt
 DEFAULT_HYDE_PROMPT = PromptTemplate(
@@ -58,11 +61,22 @@ DEFAULT_HYDE_PROMPT = PromptTemplate(
 
 
 
+def generate_hyde_rewrites(question: str) -> str:
+    """
+    生成重写后的搜索信息, 按规范化后的问题缓存
+    """
+    key = normalize_query(question)
+    response = _hyde_cache.get(key)
+    if response is None:
+        prompt = DEFAULT_HYDE_PROMPT.format(question=question)
+        response = rewrite_llm.invoke(prompt).strip()  # type: ignore
+        if response:
+            _hyde_cache.set(key, response)
+    return response
+
+
 def generate_hyde(question: str) -> str:
     """
     hyde查询, 不是标准的hyde, 算是一种变体查询
     """
-    prompt = DEFAULT_HYDE_PROMPT.format(question=question)
-    response = llm.invoke(prompt)
-    return question + "\n" + response.strip() # type: ignore
-
+    return question + "\n" + generate_hyde_rewrites(question)
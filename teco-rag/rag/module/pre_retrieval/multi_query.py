@@ -25,7 +25,10 @@
 # OF SUCH DAMAGE.
 
 from langchain_core.prompts.prompt import PromptTemplate
-from rag.connector.base import llm
+from rag.connector.base import rewrite_llm
+from rag.module.pre_retrieval.rewrite_cache import TTLCache, normalize_query
+
+_queries_cache = TTLCache()
 
 # Default prompt
 DEFAULT_QUERY_PROMPT = PromptTemplate(
@@ -45,8 +48,14 @@ DEFAULT_QUERY_PROMPT = PromptTemplate(
 
 def generate_queries(question: str):
     """
-    生成多个查询变体。
+    生成多个查询变体。按规范化后的问题缓存
     """
-    prompt = DEFAULT_QUERY_PROMPT.format(question=question)
-    response = llm.invoke(prompt)
-    return response.strip().split("\n")
+    key = normalize_query(question)
+    queries = _queries_cache.get(key)
+    if queries is None:
+        prompt = DEFAULT_QUERY_PROMPT.format(question=question)
+        response = rewrite_llm.invoke(prompt)
+        queries = response.strip().split("\n")
+        if response.strip():
+            _queries_cache.set(key, queries)
+    return list(queries)
@@ -25,17 +25,82 @@
 # OF SUCH DAMAGE.
 
 import os
+import re
+import threading
+from collections import Counter, defaultdict
 from typing import List, Dict
 from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
-from rag.connector.base import llm
+from rag.connector.base import rewrite_llm
 from rag.connector.database.repository.knowledge_file_repository import list_files_from_db
 
+# 送入llm路由的候选文件数量上限
+ROUTE_CANDIDATES = 20
 
-def route_query_to_files(question, knowledge_base_name):
 
-    exist_files = [os.path.basename(f) for f in list_files_from_db(knowledge_base_name)]
+def _bigrams(text: str) -> set:
+    """去掉空白和标点后的字符bigram, 用于文件名与问题的字面匹配"""
+    text = re.sub(r"[\W_]+", "", text.lower())
+    return {text[i: i + 2] for i in range(len(text) - 1)} if len(text) > 1 else {text} - {""}
+
+
+class FileCatalogue:
+    """
+    知识库的文件目录: 文件名(路由时展示给llm)、入库时的文件名(检索过滤使用)及文件标题bigram倒排索引
+    """
+
+    def __init__(self, file_names: List[str]):
+        self.names = [os.path.basename(f) for f in file_names]
+        self.name2file = dict(zip(self.names, file_names))
+        self._index: Dict[str, List[int]] = defaultdict(list)  # bigram: [文件下标]
+        for i, name in enumerate(self.names):
+            for gram in _bigrams(os.path.splitext(name)[0]):
+                self._index[gram].append(i)
+
+    def shortlist(self, question: str, k: int = ROUTE_CANDIDATES) -> List[str]:
+        """按与问题共有的bigram数量取前k个文件名, 没有任何字面重合的文件不会入选"""
+        scores = Counter()
+        for gram in _bigrams(question):
+            for i in self._index.get(gram, ()):
+                scores[i] += 1
+        return [self.names[i] for i, _ in scores.most_common(k)]
+
+
+_catalogue_lock = threading.Lock()
+_catalogues: Dict[str, FileCatalogue] = {}  # knowledge_base_name: FileCatalogue
+_generations: Dict[str, int] = defaultdict(int)  # knowledge_base_name: 失效次数
+
+
+def get_file_catalogue(knowledge_base_name: str) -> FileCatalogue:
+    with _catalogue_lock:
+        catalogue = _catalogues.get(knowledge_base_name)
+        generation = _generations[knowledge_base_name]
+    if catalogue is None:
+        # 查询数据库不持有锁, 期间目录被失效时本次结果可能已过期, 只返回不缓存
+        catalogue = FileCatalogue(list_files_from_db(knowledge_base_name))
+        with _catalogue_lock:
+            if _generations[knowledge_base_name] == generation:
+                _catalogues[knowledge_base_name] = catalogue
+    return catalogue
+
+
+def invalidate_file_catalogue(knowledge_base_name: str):
+    """上传、删除文件或清空知识库后调用"""
+    with _catalogue_lock:
+        _generations[knowledge_base_name] += 1
+        _catalogues.pop(knowledge_base_name, None)
+
+
+def route_query_to_files(question, knowledge_base_name):
+    """
+    将问题路由到文件, 返回入库时的文件名列表, 可以直接作为向量检索的file_names过滤条件
+    先按文件名与问题的字面重合筛选候选文件, 没有字面重合的文件时(例如问题使用了同义词)将全部文件交给llm判断
+    """
+    catalogue = get_file_catalogue(knowledge_base_name)
+    exist_files = catalogue.shortlist(question) or catalogue.names
+    if not exist_files:
+        return []
     double_check_keys = ["重庆"]
 
     prompt = PromptTemplate(
@@ -51,7 +116,7 @@ def route_query_to_files(question, knowledge_base_name):
         input_variables=["file_list", "question"]
     )
 
-    question_router = prompt | llm | JsonOutputParser()
+    question_router = prompt | rewrite_llm | JsonOutputParser()
     res = question_router.invoke({"file_list": str(exist_files), "question": question})
 
     try:
@@ -61,7 +126,7 @@ def route_query_to_files(question, knowledge_base_name):
                 for key in double_check_keys:
                     if key in file_name and key not in question:
                         return []
-                return [file_name]
+                return [catalogue.name2file[file_name]]
         else:
             return []
     except Exception as e:
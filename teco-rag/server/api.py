@@ -27,7 +27,7 @@
 import uvicorn
 from fastapi import FastAPI
 
-from server.chat import knowledge_base_chat
+from server.chat import knowledge_base_chat, llm_metrics
 from server.knowledge import (
     clear_knowledge_base,
     create_knowledge_base,
@@ -98,6 +98,11 @@ def mount_app_routes(app: FastAPI, run_mode: str = None):
         knowledge_base_chat
     )
 
+    # 大模型调度状态
+    app.get("/llm/metrics", tags=["LLM"], response_model=BaseResponse, summary="大模型请求调度队列状态")(
+        llm_metrics
+    )
+
     # 开发接口
     app.post("/observability/trace_rag_pipeline", tags=["Tool"], summary="监控rag流程")(
         trace_rag_pipeline
@@ -34,8 +34,10 @@ from rag.chains.generate import GenerateChain
 from rag.chains.retrieval import RetrievalChain
 from rag.common.configuration import settings
 from rag.common.utils import logger
-from rag.connector.base import embedding_model, llm
+from rag.connector.base import embedding_model, llm, llm_scheduler
+from rag.connector.llm.scheduler import LLMOverloadedError
 from rag.connector.utils import get_vectorstore
+from rag.module.generate.answer_cache import get_answer_cache, stream_answer
 from server.knowledge import KBServiceFactory
 from server.utils import BaseResponse
 
@@ -58,12 +60,35 @@ async def knowledge_base_chat(
     if kb is None:
         return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
 
+    # 生成队列已满时直接拒绝, 不再执行检索
+    try:
+        llm_scheduler.check_admission("interactive")
+    except LLMOverloadedError as e:
+        return BaseResponse(code=503, msg=str(e))
+
+    # 语义答案缓存, 答案依赖历史对话, 仅对不带历史的问题生效
+    answer_cache = get_answer_cache(knowledge_base_name) if not history else None
+    if answer_cache is not None:
+        # 检索参数不同时召回的文档不同, 只命中参数相同的缓存
+        cache_params = {"score_threshold": score_threshold, "vectorstore_top_k": vectorstore_top_k,
+                        "rerank_top_k": rerank_top_k}
+        # 检索前记录版本号, 生成期间文件被重新入库时不写入过期的答案
+        cache_version = answer_cache.version()
+        query_embedding = embedding_model.embed_query(query)
+        cached = answer_cache.lookup(query_embedding, cache_params)
+        if cached is not None:
+            logger.info(f"问题 '{query}' 命中答案缓存: '{cached['query']}'")
+            return EventSourceResponse(_cached_iterator(cached, stream, return_docs))
+
     vector_store = get_vectorstore(
         knowledge_base_name=knowledge_base_name,
         vs_type=settings.vector_store.type,
         embed_model=embedding_model,
     )
 
+    generate_chain = GenerateChain(llm=llm, stream=stream)
+    generate_chain.prefetch(query)
+
     # 知识库召回上下文
     # keyword_retriever = KeywordRetriever(name=knowledge_base_name, k=rerank_top_k)
     retrieval_chain = RetrievalChain(
@@ -79,7 +104,6 @@ async def knowledge_base_chat(
     logger.info(f"Retrieved documents for query '{query}': {docs}")
 
     # LLM generate
-    generate_chain = GenerateChain(llm=llm, stream=stream)
     # 初始化返回结果字典
     results = {}
     llm_input_docs = []
@@ -118,9 +142,42 @@ async def knowledge_base_chat(
     if return_docs:
         results["docs"] = doc_results
     async def iterator():
-        res_generator = generate_chain.chain(query=query, docs=llm_input_docs, history=history)
-        for ans in res_generator:
-            results["result"] = ans
-            yield json.dumps(results, ensure_ascii=False)
+        # 客户端断开时该协程被取消, 取消会传递到大模型推理请求
+        res_generator = generate_chain.achain(query=query, docs=llm_input_docs, history=history)
+        ans = ""
+        try:
+            async for ans in res_generator:
+                results["result"] = ans
+                yield json.dumps(results, ensure_ascii=False)
+        except LLMOverloadedError as e:
+            logger.warning(str(e))
+            yield json.dumps({"code": 503, "msg": str(e)}, ensure_ascii=False)
+            return
+        if answer_cache is not None and ans:
+            answer_cache.add(query, query_embedding, ans, [doc["document"] for doc in docs],
+                             params=cache_params, version=cache_version)
 
     return EventSourceResponse(iterator())
+
+
+def llm_metrics() -> BaseResponse:
+    return BaseResponse(code=200, data=llm_scheduler.metrics())
+
+
+async def _cached_iterator(cached: dict, stream: bool, return_docs: bool):
+    """按与生成答案相同的格式返回缓存的答案"""
+    results = {}
+    if return_docs:
+        results["docs"] = [
+            {
+                "filename": doc.metadata.get("filename"),
+                "context": doc.page_content,
+                "similarity_score": getattr(doc, "score", None),
+            }
+            for doc in cached["docs"]
+        ]
+    answers = stream_answer(cached["answer"], settings.answer_cache.stream_chunk_size) if stream \
+        else [cached["answer"]]
+    for ans in answers:
+        results["result"] = ans
+        yield json.dumps(results, ensure_ascii=False)
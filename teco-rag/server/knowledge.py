@@ -44,6 +44,9 @@ from rag.connector.database.repository.knowledge_base_repository import (
 from rag.connector.database.repository.knowledge_file_repository import delete_files_from_db
 from rag.connector.database.utils import KnowledgeFile, get_file_path
 from rag.connector.utils import get_vectorstore
+from rag.module.generate.answer_cache import invalidate_answer_cache
+from rag.module.indexing.dedup import reset_chunk_index
+from rag.module.pre_retrieval.route_query import invalidate_file_catalogue
 from server.utils import BaseResponse, ListResponse
 
 
@@ -119,6 +122,9 @@ def delete_knowledge_base(knowledge_base_name: str = Body("test_kb")) -> BaseRes
         vs = kb  # 这里的kb指的是向量数据库
     try:
         vs.drop_vectorstore()
+        invalidate_answer_cache(knowledge_base_name)
+        invalidate_file_catalogue(knowledge_base_name)
+        reset_chunk_index(knowledge_base_name)
         status = delete_files_from_db(knowledge_base_name)
         status2 = delete_kb_from_db(knowledge_base_name)
         if status and status2:
@@ -145,6 +151,9 @@ def clear_knowledge_base(knowledge_base_name: str = Body("test_kb")) -> BaseResp
         vs = kb  # 这里的kb指的是向量数据库
     try:
         vs.clear_vectorstore()
+        invalidate_answer_cache(knowledge_base_name)
+        invalidate_file_catalogue(knowledge_base_name)
+        reset_chunk_index(knowledge_base_name)
         status = delete_files_from_db(knowledge_base_name)
         if status:
             return BaseResponse(code=200, msg=f"成功清空知识库 {knowledge_base_name}")
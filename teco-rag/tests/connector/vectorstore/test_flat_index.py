@@ -0,0 +1,127 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+FlatIndex 测试
+
+精确检索与numpy暴力计算的结果一致; 量化(SQ8/PQ)后按 recall_target 估计的候选倍数重打分, 召回率达到目标附近。
+量化索引按两种写入方式构建: load 与 MilvusVectorStore 加载镜像时一致, 按批量写入;
+incremental 模拟新建知识库, 先写入少量chunk再逐批写入。
+"""
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from rag.connector.vectorstore.flat_index import FlatIndex, l2_normalize
+from rag.connector.vectorstore.quantization import get_quantizer
+
+NUM_VECTORS = 6000
+NUM_QUERIES = 100
+DIM = 64
+TOP_K = 10
+BATCH_SIZE = 1000
+
+
+def synthetic_embeddings(n, dim, n_clusters=64, seed=0):
+    """带聚类结构的合成向量，比纯随机向量更接近真实embedding的分布"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    assign = rng.integers(0, n_clusters, size=n)
+    return (centers[assign] + 0.5 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def build_index(vectors, quantizer=None, first_batch=0, **kwargs):
+    index = FlatIndex(quantizer=quantizer, **kwargs)
+    ids = [str(i) for i in range(len(vectors))]
+    docs = [Document(page_content=i, metadata={"source": f"file{int(i) % 4}"}) for i in ids]
+    bounds = [0] + ([first_batch] if first_batch else []) + \
+        list(range(first_batch + BATCH_SIZE, len(vectors), BATCH_SIZE)) + [len(vectors)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        index.add(ids[start:end], vectors[start:end], docs[start:end])
+    return index
+
+
+def result_ids(results):
+    return [[doc.page_content for doc, _ in res] for res in results]
+
+
+@pytest.fixture(scope="module")
+def data():
+    embeddings = synthetic_embeddings(NUM_VECTORS + NUM_QUERIES, DIM)
+    return embeddings[:NUM_QUERIES], embeddings[NUM_QUERIES:]
+
+
+def test_exact_search_matches_brute_force(data):
+    queries, vectors = data
+    index = build_index(vectors, block_size=512)
+    scores = l2_normalize(queries) @ l2_normalize(vectors).T
+    expected = np.argsort(-scores, axis=1, kind="stable")[:, :TOP_K]
+
+    results = index.search(queries, TOP_K)
+    assert result_ids(results) == [[str(i) for i in row] for row in expected.tolist()]
+    np.testing.assert_allclose([[score for _, score in res] for res in results],
+                               np.take_along_axis(scores, expected, axis=1), rtol=1e-5)
+
+
+def test_group_filter(data):
+    queries, vectors = data
+    index = build_index(vectors)
+    for res in index.search(queries, TOP_K, groups=["file1"]):
+        assert len(res) == TOP_K
+        assert all(doc.metadata["source"] == "file1" for doc, _ in res)
+
+    # 指定ids时这些向量与分组取并集参与检索
+    results = index.search(vectors[:2], 1, groups=["file1"], ids=["0", "2"])
+    assert result_ids(results) == [["0"], ["1"]]
+
+
+def test_delete(data):
+    queries, vectors = data
+    index = build_index(vectors)
+    top = result_ids(index.search(queries[:1], TOP_K))[0]
+    assert index.delete(top[:3] + ["missing"]) == 3
+    assert len(index) == NUM_VECTORS - 3
+    assert result_ids(index.search(queries[:1], TOP_K - 3))[0] == top[3:]
+
+
+@pytest.mark.parametrize("config", [{"type": "sq8"}, {"type": "pq", "m": 8}])
+@pytest.mark.parametrize("first_batch", [0, 8])
+def test_quantized_rescore_recall(data, config, first_batch):
+    queries, vectors = data
+    ground_truth = [set(ids) for ids in result_ids(build_index(vectors).search(queries, TOP_K))]
+    index = build_index(vectors, get_quantizer(config), first_batch, train_size=2048, recall_target=0.95)
+    assert index._trained_size > 0
+    assert index._vectors.dtype == np.uint8
+
+    results = index.search(queries, TOP_K)
+    recall = np.mean([len(set(ids) & gt) / TOP_K for ids, gt in zip(result_ids(results), ground_truth)])
+    # 候选倍数在写入的向量上估计, query与写入的向量同分布, 实际召回率应接近 recall_target
+    assert recall >= 0.9
+    # 重打分后返回的是全精度余弦相似度
+    for res in results:
+        scores = [score for _, score in res]
+        assert scores == sorted(scores, reverse=True)
@@ -0,0 +1,154 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+ChineseRecursiveTextSplitter 等价性测试
+
+新实现按偏移区间匹配预编译的分隔符, 输出必须与逐层 re.search/re.split 的原实现完全一致。
+用随机文本、随机参数(chunk_size、chunk_overlap、keep_separator、自定义分隔符、非len的长度函数)
+和长文档对比两种实现的切分结果。
+"""
+
+import random
+import re
+from typing import List
+
+import pytest
+
+from rag.module.indexing.splitter.chinese_recursive_text_splitter import ChineseRecursiveTextSplitter
+
+NUM_CASES = 500
+MAX_LENGTH = 3000
+
+
+def _split_text_with_regex_from_end(text: str, separator: str, keep_separator: bool) -> List[str]:
+    if separator:
+        if keep_separator:
+            _splits = re.split(f"({separator})", text)
+            splits = [_splits[0]]
+            for i in range(1, len(_splits), 2):
+                splits.append(_splits[i] + _splits[i + 1])
+        else:
+            splits = re.split(separator, text)
+    else:
+        splits = list(text)
+    return [s for s in splits if s != ""]
+
+
+class ReferenceChineseRecursiveTextSplitter(ChineseRecursiveTextSplitter):
+    """原实现: 每层对子串做 re.search 选分隔符, 再用 re.split 切分, 每个chunk单独清理"""
+
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        final_chunks = []
+        separator = separators[-1]
+        new_separators = []
+        for i, _s in enumerate(separators):
+            _separator = _s if self._is_separator_regex else re.escape(_s)
+            if _s == "":
+                separator = _s
+                break
+            if re.search(_separator, text):
+                separator = _s
+                new_separators = separators[i + 1:]
+                break
+
+        _separator = separator if self._is_separator_regex else re.escape(separator)
+        splits = _split_text_with_regex_from_end(text, _separator, self._keep_separator)
+
+        _good_splits = []
+        _separator = "" if self._keep_separator else separator
+        for s in splits:
+            if self._length_function(s) < self._chunk_size:
+                _good_splits.append(s)
+            else:
+                if _good_splits:
+                    final_chunks.extend(self._merge_splits(_good_splits, _separator))
+                    _good_splits = []
+                if not new_separators:
+                    final_chunks.append(s)
+                else:
+                    final_chunks.extend(self._split_text(s, new_separators))
+        if _good_splits:
+            final_chunks.extend(self._merge_splits(_good_splits, _separator))
+        return [re.sub(r"\n{2,}", "\n", chunk.strip()) for chunk in final_chunks if chunk.strip() != ""]
+
+
+class BatchLength:
+    """非len的长度函数(按utf-8字节数), 带 batch 方法, 覆盖新实现的批量计长路径"""
+
+    def __call__(self, text: str) -> int:
+        return len(text.encode("utf-8"))
+
+    def batch(self, texts: List[str]) -> List[int]:
+        return [self(text) for text in texts]
+
+
+ALPHABET = list("的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种"
+                "。！？；，,. ;?!\n \n\n0123456789（）、")
+SEPARATOR_SNIPPETS = ["\n一、标题\n", "\n （二）", "01 ", "\n\n", "\n1.", ". ", "; ", ", "]
+CUSTOM_SEPARATORS = [["\n\n", "。", ""], [r"\b\w{3}\b", "，"], ["^x", "；"], ["zz", "qq"]]
+
+
+def random_text(rng: random.Random, n: int) -> str:
+    return "".join(rng.choice(SEPARATOR_SNIPPETS) if rng.random() < 0.05 else rng.choice(ALPHABET)
+                   for _ in range(n))
+
+
+def random_case(seed: int):
+    """每个用例一个种子, 失败时可以单独复现"""
+    rng = random.Random(seed)
+    text = random_text(rng, rng.randint(0, MAX_LENGTH))
+    chunk_size = rng.choice([50, 100, 250, 500])
+    kwargs = dict(chunk_size=chunk_size, chunk_overlap=min(rng.choice([0, 10, 30]), chunk_size - 1),
+                  keep_separator=rng.choice([True, False]))
+    if rng.random() < 0.2:
+        kwargs["separators"] = rng.choice(CUSTOM_SEPARATORS)
+    if rng.random() < 0.3:
+        kwargs["length_function"] = BatchLength()
+    return text, kwargs
+
+
+@pytest.mark.parametrize("seed", range(NUM_CASES))
+def test_random_text_matches_reference(seed):
+    text, kwargs = random_case(seed)
+    expected = ReferenceChineseRecursiveTextSplitter(**kwargs).split_text(text)
+    assert ChineseRecursiveTextSplitter(**kwargs).split_text(text) == expected
+
+
+def test_long_text_matches_reference():
+    rng = random.Random(0)
+    text = random_text(rng, 100000)
+    expected = ReferenceChineseRecursiveTextSplitter(chunk_size=500, chunk_overlap=50).split_text(text)
+    assert ChineseRecursiveTextSplitter(chunk_size=500, chunk_overlap=50).split_text(text) == expected
+
+
+def test_single_separator_text_matches_reference():
+    """只有逗号和句号, 前面的分隔符都不存在, 每层都要扫描整段文本"""
+    rng = random.Random(0)
+    text = ("".join(rng.choice("天地玄黄宇宙洪荒日月盈昃辰宿列张") for _ in range(60)) + "，") * 8 + "。"
+    text = text * 200
+    expected = ReferenceChineseRecursiveTextSplitter(chunk_size=500, chunk_overlap=50).split_text(text)
+    assert ChineseRecursiveTextSplitter(chunk_size=500, chunk_overlap=50).split_text(text) == expected
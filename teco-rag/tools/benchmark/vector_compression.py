@@ -0,0 +1,130 @@
+# BSD 3- Clause License Copyright (c) 2023, Tecorigin Co., Ltd. All rights
+# reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+"""
+向量压缩召回率基准测试
+
+对比 FlatIndex 精确检索与量化(SQ8/PQ) + 全精度重打分两种方式的 recall@k、内存占用和检索耗时。
+量化索引按两种写入方式构建：load 与 MilvusVectorStore 加载镜像时一致，按 batch_size 批量写入；
+incremental 模拟新建知识库，先写入 first_batch 条（第一个文件的少量chunk），其余再按 batch_size 写入。
+向量可以来自真实知识库导出的 .npy 文件（形如 (n, dim) 的float32矩阵），不提供时使用合成的聚类数据。
+
+用法（在项目根目录执行）：
+    python -m tools.benchmark.vector_compression --embeddings_path vectors.npy --top_k 10 --factors 1 2 4 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+from rag.connector.vectorstore.flat_index import FlatIndex
+from rag.connector.vectorstore.quantization import get_quantizer
+
+parser = argparse.ArgumentParser(prog='Teco-rag-vector-compression-benchmark',
+                                 description='')
+parser.add_argument("--embeddings_path", default=None, type=str)
+parser.add_argument("--num_vectors", default=50000, type=int)
+parser.add_argument("--dim", default=1024, type=int)
+parser.add_argument("--num_queries", default=200, type=int)
+parser.add_argument("--top_k", default=10, type=int)
+parser.add_argument("--factors", default=[1, 2, 4, 8], type=int, nargs="+")
+parser.add_argument("--pq_m", default=64, type=int)
+parser.add_argument("--train_size", default=20000, type=int)
+parser.add_argument("--first_batch", default=8, type=int)
+parser.add_argument("--batch_size", default=1000, type=int)
+
+args = parser.parse_args()
+
+
+def synthetic_embeddings(n, dim, n_clusters=256, seed=0):
+    """带聚类结构的合成向量，比纯随机向量更接近真实embedding的分布"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    assign = rng.integers(0, n_clusters, size=n)
+    return (centers[assign] + 0.5 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def build_index(vectors, quantizer, first_batch=0):
+    index = FlatIndex(quantizer=quantizer, train_size=args.train_size)
+    ids = [str(i) for i in range(len(vectors))]
+    docs = [Document(page_content=i) for i in ids]
+    bounds = [0] + ([first_batch] if first_batch else []) + \
+        list(range(first_batch + args.batch_size, len(vectors), args.batch_size)) + [len(vectors)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        index.add(ids[start:end], vectors[start:end], docs[start:end])
+    return index
+
+
+def recall(results, ground_truth):
+    hits = [len({d.page_content for d, _ in res} & gt) / len(gt)
+            for res, gt in zip(results, ground_truth)]
+    return float(np.mean(hits))
+
+
+########################################################
+# Step 1. 准备向量和query
+########################################################
+if args.embeddings_path:
+    data = np.load(args.embeddings_path).astype(np.float32)
+else:
+    data = synthetic_embeddings(args.num_vectors + args.num_queries, args.dim)
+queries, vectors = data[:args.num_queries], data[args.num_queries:]
+print(f"向量数: {len(vectors)}, 维度: {vectors.shape[1]}, query数: {len(queries)}")
+
+########################################################
+# Step 2. 精确检索作为ground truth
+########################################################
+exact_index = build_index(vectors, None)
+start = time.time()
+exact_results = exact_index.search(queries, args.top_k)
+exact_time = time.time() - start
+ground_truth = [{d.page_content for d, _ in res} for res in exact_results]
+print(f"{'flat':<8}{'build':>12}{'factor':>10}{'recall@' + str(args.top_k):>12}{'MB':>10}{'ms/query':>10}")
+print(f"{'float32':<8}{'-':>12}{'-':>10}{1.0:>12.4f}{exact_index._vectors[:len(vectors)].nbytes / 2**20:>10.1f}"
+      f"{exact_time * 1000 / len(queries):>10.2f}")
+
+########################################################
+# Step 3. 量化索引 + 重打分
+########################################################
+for config in [{"type": "sq8"}, {"type": "pq", "m": args.pq_m}]:
+    for build, first_batch in [("load", 0), ("incremental", args.first_batch)]:
+        index = build_index(vectors, get_quantizer(config), first_batch)
+        memory = index._vectors[:len(vectors)].nbytes / 2**20
+        start = time.time()
+        results = index.search(queries, args.top_k, rescore=False)
+        cost = time.time() - start
+        print(f"{config['type']:<8}{build:>12}{'none':>10}{recall(results, ground_truth):>12.4f}{memory:>10.1f}"
+              f"{cost * 1000 / len(queries):>10.2f}")
+        # auto: 训练后按 recall_target 估计的候选倍数
+        for factor in args.factors + [None]:
+            start = time.time()
+            results = index.search(queries, args.top_k, rescore_factor=factor)
+            cost = time.time() - start
+            factor = factor or f"auto({index._scaled_rescore_factor()})"
+            print(f"{config['type']:<8}{build:>12}{factor:>10}{recall(results, ground_truth):>12.4f}{memory:>10.1f}"
+                  f"{cost * 1000 / len(queries):>10.2f}")